@@ -1,19 +1,34 @@
 import os
-import io
+import json
+import asyncio
 import mimetypes
-import time
 import logging
 import openai
-from flask import Flask, request, jsonify, send_file, abort
+from quart import Quart, Response, request, jsonify, abort
+from azure.core import MatchConditions
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from ingestion.ingest import Ingest
+from ingestion.jobs import IngestionJobs
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from retrieval import RetrievalCache
+from localsearch import LocalSearchIndex, LocalSearchClient, AsyncLocalSearchClient
+from vectorstore import VectorStore, HybridSearchClient, AsyncHybridSearchClient
+from cache import TTLCache
+from blobcache import BlobDiskCache
+from prompt import PromptBudget
+from tracing import Trace, histograms, trace_request, trace_stream
+from credentials import OPENAI_SCOPE, SEARCH_SCOPE, STORAGE_SCOPE, AsyncTokenRefresher, TokenRefresher
+from langchainadapters import set_openai_key
 
 
 # Replace these with your own values, either in environment variables or directly here
@@ -26,121 +41,354 @@ AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT") or "
 AZURE_OPENAI_CHATGPT_DEPLOYMENT = (
     os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT") or "chat"
 )
+# Model behind the ChatGPT deployment, it sets the context window the chat prompts are fitted in
+AZURE_OPENAI_CHATGPT_MODEL = os.environ.get("AZURE_OPENAI_CHATGPT_MODEL") or "gpt-35-turbo"
+
+# Endpoints and keys default to the services above and the current user identity, they can point to other endpoints
+# (e.g. the local stand-ins of scripts/benchmarks/loadtest.py) that take keys instead
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT") or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
+AZURE_SEARCH_ENDPOINT = os.environ.get("AZURE_SEARCH_ENDPOINT") or f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+AZURE_SEARCH_KEY = os.environ.get("AZURE_SEARCH_KEY")
 
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
 
+# Search results are cached in memory, set RETRIEVAL_CACHE_SIZE to 0 to disable the cache
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE") or 1024)
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL") or 300)
+RETRIEVAL_CACHE_CHECK_INTERVAL = float(os.environ.get("RETRIEVAL_CACHE_CHECK_INTERVAL") or 30)
+# Search queries generated from the chat history are cached too, set QUERY_CACHE_SIZE to 0 to disable
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE") or 1024)
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL") or 3600)
+# Content files are streamed in chunks of this size, and optionally cached on local disk when CONTENT_CACHE_DIR is set
+CONTENT_CHUNK_SIZE = int(os.environ.get("CONTENT_CHUNK_SIZE") or 1024 * 1024)
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR")
+CONTENT_CACHE_SIZE = int(os.environ.get("CONTENT_CACHE_SIZE") or 512 * 1024 * 1024)
+# Number of processes parsing documents and of threads uploading blobs and index batches during /ingest
+INGESTION_WORKERS = int(os.environ.get("INGESTION_WORKERS") or 1)
+INGESTION_CONCURRENCY = int(os.environ.get("INGESTION_CONCURRENCY") or 1)
+# Number of page blobs of a file uploaded in parallel
+INGESTION_PAGE_CONCURRENCY = int(os.environ.get("INGESTION_PAGE_CONCURRENCY") or 4)
+# Number of index batches of a file sent to the search service in parallel
+INGESTION_INDEX_CONCURRENCY = int(os.environ.get("INGESTION_INDEX_CONCURRENCY") or 2)
+# When set, the approaches search the local index in this directory (built with prepdocs.py --localindex) instead of
+# Azure Cognitive Search, ingestion still goes to Azure Cognitive Search
+LOCAL_SEARCH_INDEX = os.environ.get("LOCAL_SEARCH_INDEX")
+# When set, search results are fused with the sections closest to the query in the embedding store in this directory
+# (built with prepdocs.py --embeddings), queries are embedded with the embedder the store was built with
+EMBEDDINGS_STORE = os.environ.get("EMBEDDINGS_STORE")
+# When set, /ingest only processes files that changed since the last run, tracked in this manifest file
+INGESTION_MANIFEST = os.environ.get("INGESTION_MANIFEST")
+# Seconds the agent approaches (rrr, rda) have to answer, requests can lower it with the "max_seconds" override. When
+# another step wouldn't be done in time they answer with what they found so far.
+AGENT_MAX_SECONDS = float(os.environ.get("AGENT_MAX_SECONDS") or 30)
+
 # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
 # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
 # keys for each service
 # If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
-azure_credential = DefaultAzureCredential()
+# Tokens are cached and renewed in the background ahead of expiry (see credentials.py), requests never wait on them
+azure_credential = TokenRefresher(DefaultAzureCredential())
+# The async clients used on the request path share the same tokens, they are created once the event loop is running
+async_azure_credential = None
 
 # Used by the OpenAI SDK
 openai.api_type = "azure"
-openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+openai.api_base = AZURE_OPENAI_ENDPOINT
 openai.api_version = "2022-12-01"
 
-# Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead
-openai.api_type = "azure_ad"
-openai_token = azure_credential.get_token(
-    "https://cognitiveservices.azure.com/.default"
-)
-openai.api_key = openai_token.token
+# Set AZURE_OPENAI_KEY to use a key instead of the current user identity, the Azure AD token is kept up to date in
+# openai.api_key, which the Langchain based approaches read on each call too
+if AZURE_OPENAI_KEY:
+    openai.api_key = AZURE_OPENAI_KEY
+else:
+    openai.api_type = "azure_ad"
+    azure_credential.subscribe(OPENAI_SCOPE, lambda token: set_openai_key(token.token))
+search_credential = AzureKeyCredential(AZURE_SEARCH_KEY) if AZURE_SEARCH_KEY else azure_credential
 
-# Set up clients for Cognitive Search, Storage and Index
+# Set up clients for Cognitive Search, Storage and Index. The synchronous clients are used by ingestion and by the
+# Langchain based approaches, which run on worker threads; the async ones are created in setup_clients() below
 search_client = SearchClient(
-    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+    endpoint=AZURE_SEARCH_ENDPOINT,
     index_name=AZURE_SEARCH_INDEX,
-    credential=azure_credential,
+    credential=search_credential,
 )
 search_index_client = SearchIndexClient(
-    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net/",
-    credential=azure_credential,
+    endpoint=AZURE_SEARCH_ENDPOINT,
+    credential=search_credential,
 )
 blob_client = BlobServiceClient(
     account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
     credential=azure_credential,
 )
 blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+local_search_index = LocalSearchIndex.load(LOCAL_SEARCH_INDEX) if LOCAL_SEARCH_INDEX else None
+local_search_client = LocalSearchClient(local_search_index) if local_search_index else None
+retrieval_search_client = local_search_client or search_client
+vector_store = VectorStore.load(EMBEDDINGS_STORE) if EMBEDDINGS_STORE else None
+if vector_store:
+    retrieval_search_client = HybridSearchClient(retrieval_search_client, vector_store)
+async_search_client = None
+async_local_search_client = None
+async_blob_container = None
+retrieval_cache = RetrievalCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+query_cache = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+content_cache = BlobDiskCache(CONTENT_CACHE_DIR, CONTENT_CACHE_SIZE) if CONTENT_CACHE_DIR else None
+index_watcher = None
 
 # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
 # or some derivative, here we include several for exploration purposes
 ask_approaches = {
-    "rtr": RetrieveThenReadApproach(
-        search_client,
-        AZURE_OPENAI_GPT_DEPLOYMENT,
-        KB_FIELDS_SOURCEPAGE,
-        KB_FIELDS_CONTENT,
-    ),
     "rrr": ReadRetrieveReadApproach(
-        search_client,
+        retrieval_search_client,
         AZURE_OPENAI_GPT_DEPLOYMENT,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        retrieval_cache,
+        AGENT_MAX_SECONDS,
     ),
     "rda": ReadDecomposeAsk(
-        search_client,
+        retrieval_search_client,
         AZURE_OPENAI_GPT_DEPLOYMENT,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        retrieval_cache,
+        AGENT_MAX_SECONDS,
     ),
 }
 
-chat_approaches = {
-    "rrr": ChatReadRetrieveReadApproach(
-        search_client,
+chat_approaches = {}
+
+ingestion = Ingest(
+    AZURE_SEARCH_INDEX, search_index_client, blob_container, search_client, retrieval_cache, INGESTION_MANIFEST,
+    INGESTION_INDEX_CONCURRENCY
+)
+
+# Ingestion runs in the background, one job at a time, /ingest returns as soon as the job is queued
+ingestion_jobs = IngestionJobs(
+    lambda job: ingestion.run(INGESTION_WORKERS, INGESTION_CONCURRENCY, INGESTION_PAGE_CONCURRENCY, progress=job)
+)
+
+app = Quart(__name__)
+
+
+@app.before_serving
+async def setup_clients():
+    global async_azure_credential, async_search_client, async_local_search_client, async_blob_container, index_watcher
+    # Tokens for Search and Storage are fetched ahead of the first requests too
+    azure_credential.start(STORAGE_SCOPE, *([] if AZURE_SEARCH_KEY else [SEARCH_SCOPE]))
+    async_azure_credential = AsyncTokenRefresher(azure_credential)
+    if local_search_index:
+        async_local_search_client = AsyncLocalSearchClient(local_search_index)
+        async_search_client = async_local_search_client
+    else:
+        async_search_client = AsyncSearchClient(
+            endpoint=AZURE_SEARCH_ENDPOINT,
+            index_name=AZURE_SEARCH_INDEX,
+            credential=AzureKeyCredential(AZURE_SEARCH_KEY) if AZURE_SEARCH_KEY else async_azure_credential,
+        )
+    if vector_store:
+        async_search_client = AsyncHybridSearchClient(async_search_client, vector_store)
+    async_blob_container = AsyncBlobServiceClient(
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=async_azure_credential,
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
+    ).get_container_client(AZURE_STORAGE_CONTAINER)
+
+    ask_approaches["rtr"] = RetrieveThenReadApproach(
+        async_search_client,
+        AZURE_OPENAI_GPT_DEPLOYMENT,
+        KB_FIELDS_SOURCEPAGE,
+        KB_FIELDS_CONTENT,
+        retrieval_cache,
+    )
+    chat_approaches["rrr"] = ChatReadRetrieveReadApproach(
+        async_search_client,
         AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         AZURE_OPENAI_GPT_DEPLOYMENT,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        retrieval_cache,
+        query_cache,
+        PromptBudget(AZURE_OPENAI_CHATGPT_MODEL),
     )
-}
 
-ingestion = Ingest(
-    AZURE_SEARCH_INDEX, search_index_client, blob_container, search_client
-)
+    index_watcher = asyncio.create_task(watch_index_changes())
 
-app = Flask(__name__)
+
+# The index can be updated by other processes (e.g. prepdocs.py), poll the index statistics and drop cached
+# search results when they change. The local search index and the embedding store are rewritten in place by
+# prepdocs.py, they are reloaded when their files change.
+async def watch_index_changes():
+    local_version = None
+    while True:
+        try:
+            version = local_files_version()
+            if local_version is not None and version != local_version:
+                await asyncio.to_thread(reload_local_files)
+            local_version = version
+            if not local_search_index:
+                stats = await asyncio.to_thread(search_index_client.get_index_statistics, AZURE_SEARCH_INDEX)
+                version += (stats["document_count"], stats["storage_size"])
+            retrieval_cache.set_index_version(version)
+        except Exception:
+            logging.exception("Failed to check for search index changes")
+        await asyncio.sleep(RETRIEVAL_CACHE_CHECK_INTERVAL)
+
+
+def local_files_version():
+    return tuple(os.stat(os.path.join(path, "meta.json")).st_mtime_ns for path in (LOCAL_SEARCH_INDEX, EMBEDDINGS_STORE) if path)
+
+
+# The old files are unmapped once the requests still using them are done with them
+def reload_local_files():
+    global local_search_index, vector_store
+    if LOCAL_SEARCH_INDEX:
+        local_search_index = LocalSearchIndex.load(LOCAL_SEARCH_INDEX)
+        local_search_client.index = local_search_index
+        async_local_search_client.client.index = local_search_index
+    if EMBEDDINGS_STORE:
+        vector_store = VectorStore.load(EMBEDDINGS_STORE)
+        retrieval_search_client.store = vector_store
+        async_search_client.store = vector_store
+
+
+@app.after_serving
+async def close_clients():
+    index_watcher.cancel()
+    await async_search_client.close()
+    await async_blob_container.close()
+    await async_azure_credential.close()
+    ingestion_jobs.shutdown()
+    azure_credential.close()
 
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
-def static_file(path):
-    return app.send_static_file(path)
+async def static_file(path):
+    return await app.send_static_file(path)
 
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Blobs are streamed in chunks so memory use doesn't depend on the blob size, single
+# byte ranges and conditional requests (If-None-Match) are supported so browsers can reuse what they already have.
 @app.route("/content/<path>")
-def content_file(path):
-    blob = blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or "content_settings" not in blob.properties:
+async def content_file(path):
+    blob_client = async_blob_container.get_blob_client(path)
+    try:
+        properties = await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    mime_type = properties.content_settings.content_type
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    blob.readinto(blob_file)
-    blob_file.seek(0)
-    return send_file(
-        blob_file, mimetype=mime_type, as_attachment=False, download_name=path
-    )
+    etag = properties.etag if properties.etag.startswith('"') else f'"{properties.etag}"'
+    size = properties.size
+    headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(b"", status=304, headers=headers)
+
+    status = 200
+    offset, length = 0, size
+    if_range = request.headers.get("If-Range")
+    if not if_range or if_range == etag:
+        try:
+            byte_range = parse_range(request.headers.get("Range"), size)
+        except ValueError:
+            return Response(b"", status=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            status = 206
+            offset, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+            headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+    headers["Content-Length"] = str(length)
+
+    # A blob evicted from the cache since it was last served is a cache miss, it's downloaded and cached again
+    cached_file = await asyncio.to_thread(content_cache.open, path, etag) if content_cache else None
+    if cached_file:
+        body = stream_file(cached_file, offset, length)
+    else:
+        # Only complete downloads are added to the cache
+        cache = content_cache if content_cache and status == 200 and content_cache.cacheable(size) else None
+        body = stream_blob(blob_client, path, etag, offset, length, cache)
+    return Response(body, status=status, headers=headers, mimetype=mime_type)
+
+
+# Parses a single range "Range: bytes=start-end" header into an inclusive (start, end) tuple. Returns None if there's
+# no range, if it's invalid (e.g. "bytes=500-100") or if it can't be served as a single range, then the whole content
+# is sent. Raises ValueError if the range is valid but not satisfiable, i.e. it starts past the end of the content.
+def parse_range(header, size):
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if start:
+            if end and int(end) < int(start):
+                return None
+            start, end = int(start), (int(end) if end else size - 1)
+        else:
+            start, end = size - int(end), size - 1
+    except ValueError:
+        return None
+    start, end = max(start, 0), min(end, size - 1)
+    if start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+# Streams the blob, adding it to the cache as it goes when a cache is given. The cache file is only created once the
+# body is being sent, and it's removed unless the whole blob was written to it, e.g. when the client disconnects.
+async def stream_blob(blob_client, path, etag, offset, length, cache=None):
+    cache_writer = None
+    try:
+        if cache:
+            cache_writer = await asyncio.to_thread(cache.writer, path, etag)
+        # Fail instead of mixing content if the blob changes after its properties were read
+        downloader = await blob_client.download_blob(offset=offset, length=length, etag=etag, match_condition=MatchConditions.IfNotModified)
+        async for chunk in downloader.chunks():
+            if cache_writer:
+                await asyncio.to_thread(cache_writer.write, chunk)
+            yield chunk
+        if cache_writer:
+            await asyncio.to_thread(cache_writer.commit)
+            cache_writer = None
+    finally:
+        if cache_writer:
+            await asyncio.to_thread(cache_writer.discard)
+
+
+async def stream_file(f, offset, length):
+    with f:
+        await asyncio.to_thread(f.seek, offset)
+        while length > 0:
+            chunk = await asyncio.to_thread(f.read, min(CONTENT_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
 
 
 @app.route("/ask", methods=["POST"])
-def ask():
-    ensure_openai_token()
-    if not request.json:
+async def ask():
+    request_json = await request.get_json()
+    if not request_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    approach = request_json["approach"]
     try:
         impl = ask_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
+        if request_json.get("stream"):
+            trace = Trace(f"ask.{approach}")
+            return Response(format_as_ndjson(trace_stream(trace, impl.arun_stream(request_json["question"], request_json.get("overrides") or {}))), mimetype="application/x-ndjson")
+        with trace_request(f"ask.{approach}") as trace:
+            r = await impl.arun(request_json["question"], request_json.get("overrides") or {})
+        r["timings"] = trace.timings()
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /ask")
@@ -148,37 +396,62 @@ def ask():
 
 
 @app.route("/chat", methods=["POST"])
-def chat():
-    ensure_openai_token()
-    if not request.json:
+async def chat():
+    request_json = await request.get_json()
+    if not request_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    approach = request_json["approach"]
     try:
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
+        if request_json.get("stream"):
+            trace = Trace(f"chat.{approach}")
+            return Response(format_as_ndjson(trace_stream(trace, impl.arun_stream(request_json["history"], request_json.get("overrides") or {}))), mimetype="application/x-ndjson")
+        with trace_request(f"chat.{approach}") as trace:
+            r = await impl.arun(request_json["history"], request_json.get("overrides") or {})
+        r["timings"] = trace.timings()
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/ingest")
-def ingest():
-    ingestion.run()
+# Latency histograms of the request stages ("search", "openai.completion", "agent.llm", ...) and of whole requests
+# ("ask.rtr", "chat.rrr", ...) since the process started, in the Prometheus text format. With OpenTelemetry installed
+# and configured they're also exported through it, along with the spans of each request.
+@app.route("/metrics")
+async def metrics():
+    return Response(histograms.prometheus(), mimetype="text/plain; version=0.0.4")
 
-    return jsonify({"message": "ingesting"})
 
+# Streamed responses are sent as newline delimited JSON, one partial response object per line. Errors raised
+# after the response has started can't change the status code anymore, so they are reported as a last line instead
+async def format_as_ndjson(r):
+    try:
+        async for event in r:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    except Exception as e:
+        logging.exception("Exception while streaming response")
+        yield json.dumps({"error": str(e)}) + "\n"
 
-def ensure_openai_token():
-    global openai_token
-    if openai_token.expires_on < int(time.time()) - 60:
-        openai_token = azure_credential.get_token(
-            "https://cognitiveservices.azure.com/.default"
-        )
-        openai.api_key = openai_token.token
+
+# Queues an ingestion job and returns right away with its id, a request made while a job is already waiting to start
+# gets that job instead of a new one. Progress is reported by /ingest/<job_id> (or /ingest/latest).
+@app.route("/ingest", methods=["GET", "POST"])
+async def ingest():
+    job, created = ingestion_jobs.submit()
+    return jsonify({"message": "ingesting" if created else "ingestion already queued", **job.to_dict(files=False)}), 202, {"Location": f"/ingest/{job.id}"}
+
+
+@app.route("/ingest/<job_id>")
+async def ingest_status(job_id):
+    job = ingestion_jobs.latest() if job_id == "latest" else ingestion_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "unknown ingestion job"}), 404
+    return jsonify(job.to_dict())
 
 
+# For production, serve the app with an ASGI server, e.g. "gunicorn app:app" using the settings in gunicorn.conf.py
 if __name__ == "__main__":
     app.run()
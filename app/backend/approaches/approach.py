@@ -1,6 +1,21 @@
-from typing import Any
+import asyncio
+from typing import Any, AsyncGenerator
 
 
 class Approach:
     def run(self, q: str, overrides: dict[str, Any]) -> Any:
         raise NotImplementedError
+
+    # Async entry point used by the web app. Approaches that talk to the async Search/OpenAI clients override this,
+    # synchronous approaches (e.g. the Langchain based ones) keep implementing run() and are executed on a worker
+    # thread so they don't block the event loop while waiting on the network.
+    async def arun(self, q: Any, overrides: dict[str, Any]) -> Any:
+        return await asyncio.to_thread(self.run, q, overrides)
+
+    # Streaming variant, yields partial responses: the data points first, then chunks of the answer as they are
+    # generated and finally the thoughts. Approaches that can't stream fall back to sending the whole answer at once.
+    async def arun_stream(self, q: Any, overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        r = await self.arun(q, overrides)
+        yield {"data_points": r["data_points"]}
+        yield {"answer": r["answer"]}
+        yield {"thoughts": r["thoughts"]}
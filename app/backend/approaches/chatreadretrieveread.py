@@ -1,10 +1,17 @@
-from typing import Any, Sequence
+import asyncio
+import hashlib
+import re
+import time
+from typing import Any, AsyncGenerator, Optional, Sequence
 
 import openai
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from azure.search.documents.aio import SearchClient
 from approaches.approach import Approach
 from text import nonewlines
+from retrieval import RetrievalCache, asearch
+from cache import TTLCache
+from prompt import PromptBudget
+from tracing import span
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
 # top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion 
@@ -43,74 +50,116 @@ Question:
 Search query:
 """
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str, retrieval_cache: Optional[RetrievalCache] = None, query_cache: Optional[TTLCache] = None, prompt_budget: Optional[PromptBudget] = None):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.gpt_deployment = gpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.retrieval_cache = retrieval_cache
+        self.query_cache = query_cache
+        self.prompt_budget = prompt_budget or PromptBudget()
 
-    def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+    async def retrieve_and_prompt(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> tuple[str, list[str], str]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        prompt = self.query_prompt_template.format(chat_history=self.get_chat_history_as_text(history, include_last_turn=False), question=history[-1]["user"])
-        completion = openai.Completion.create(
-            engine=self.gpt_deployment, 
-            prompt=prompt, 
-            temperature=0.0, 
-            max_tokens=32, 
-            n=1, 
-            stop=["\n"])
-        q = completion.choices[0].text
+        q = await self.generate_query(history)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+        r = await asearch(self.search_client, q, overrides, self.retrieval_cache)
         if use_semantic_captions:
             results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
             results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
-        content = "\n".join(results)
 
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
         
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
-        if prompt_override is None:
-            prompt = self.prompt_prefix.format(injected_prompt="", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        elif prompt_override.startswith(">>>"):
-            prompt = self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        else:
-            prompt = prompt_override.format(sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+        def make_prompt(sources: str, chat_history: str) -> str:
+            if prompt_override is None:
+                return self.prompt_prefix.format(injected_prompt="", sources=sources, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+            elif prompt_override.startswith(">>>"):
+                return self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=sources, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+            else:
+                return prompt_override.format(sources=sources, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        completion = openai.Completion.create(
+        # Keep the prompt within the model's context window: the chat history gets its share first (oldest turns are
+        # dropped), then the sources get what's left (lowest ranked are dropped)
+        with span("prompt"):
+            available = self.prompt_budget.available(make_prompt("", ""))
+            chat_history = self.get_chat_history_as_text(history, max_tokens=min(self.prompt_budget.max_history_tokens, available))
+            results = self.prompt_budget.fit_sources(results, available - self.prompt_budget.count(chat_history))
+            prompt = make_prompt("\n".join(results), chat_history)
+
+        return q, results, prompt
+
+    # The query rewrite only depends on the conversation so far, so repeated and templated conversations reuse the
+    # query generated the first time instead of making another completion call
+    async def generate_query(self, history: Sequence[dict[str, str]]) -> str:
+        chat_history = self.get_chat_history_as_text(history, include_last_turn=False)
+        question = history[-1]["user"]
+        key = hashlib.sha256((" ".join(chat_history.split()) + "\0" + " ".join(question.lower().split())).encode("utf-8")).hexdigest()
+        with span("openai.query_rewrite", cached=True) as attributes:
+            q = self.query_cache.get(key) if self.query_cache is not None else None
+            if q is None:
+                attributes["cached"] = False
+                prompt = self.query_prompt_template.format(chat_history=chat_history, question=question)
+                completion = await openai.Completion.acreate(
+                    engine=self.gpt_deployment, 
+                    prompt=prompt, 
+                    temperature=0.0, 
+                    max_tokens=32, 
+                    n=1, 
+                    stop=["\n"])
+                q = completion.choices[0].text
+                if self.query_cache is not None:
+                    self.query_cache.put(key, q)
+        return q
+
+    def completion_args(self, prompt: str, overrides: dict[str, Any]) -> dict[str, Any]:
+        return dict(
             engine=self.chatgpt_deployment, 
             prompt=prompt, 
             temperature=overrides.get("temperature") or 0.7, 
-            max_tokens=1024, 
+            max_tokens=self.prompt_budget.completion_tokens(prompt), 
             n=1, 
             stop=["<|im_end|>", "<|im_start|>"])
 
+    # Synchronous entry point kept for callers that aren't running an event loop (scripts, notebooks), the web app
+    # calls arun
+    def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        return asyncio.run(self.arun(history, overrides))
+
+    async def arun(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        q, results, prompt = await self.retrieve_and_prompt(history, overrides)
+
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+        with span("openai.completion"):
+            completion = await openai.Completion.acreate(**self.completion_args(prompt, overrides))
+
         return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+
+    async def arun_stream(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        q, results, prompt = await self.retrieve_and_prompt(history, overrides)
+        yield {"data_points": results}
+
+        # STEP 3, streamed: forward answer tokens as they are generated, follow-up questions are only complete at the end
+        answer = ""
+        with span("openai.completion", stream=True) as attributes:
+            start = time.perf_counter()
+            async for chunk in await openai.Completion.acreate(**self.completion_args(prompt, overrides), stream=True):
+                if chunk.choices and chunk.choices[0].text:
+                    attributes.setdefault("first_token_ms", round((time.perf_counter() - start) * 1000, 1))
+                    answer += chunk.choices[0].text
+                    yield {"answer": chunk.choices[0].text}
+
+        yield {"thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'),
+               "follow_up_questions": re.findall(r"<<([^>]+)>>", answer)}
     
-    def get_chat_history_as_text(self, history: Sequence[dict[str, str]], include_last_turn: bool=True, approx_max_tokens: int=1000) -> str:
-        history_text = ""
-        for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = """<|im_start|>user""" + "\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot", "") + """<|im_end|>""" if h.get("bot") else "") + "\n" + history_text
-            if len(history_text) > approx_max_tokens*4:
-                break
-        return history_text
\ No newline at end of file
+    # Turns are added from the most recent one until max_tokens (counted with the model's tokenizer) is reached
+    def get_chat_history_as_text(self, history: Sequence[dict[str, str]], include_last_turn: bool=True, max_tokens: Optional[int]=None) -> str:
+        turns = ["""<|im_start|>user""" + "\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot", "") + """<|im_end|>""" if h.get("bot") else "") + "\n"
+                 for h in (history if include_last_turn else history[:-1])]
+        return "".join(self.prompt_budget.fit_history(turns, max_tokens))
@@ -1,100 +1,200 @@
-import openai
+import contextvars
 import re
+from concurrent.futures import ThreadPoolExecutor
 from approaches.approach import Approach
 from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
-from langchain.prompts import PromptTemplate, BasePromptTemplate
+from langchain.prompts import PromptTemplate
 from langchain.callbacks.manager import CallbackManager
-from langchain.agents import Tool, AgentExecutor
+from langchain.chains import LLMChain
+from langchain.agents import Tool
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
+from langchain.agents.react.output_parser import ReActOutputParser
+from langchain.schema import AgentAction, AgentFinish, OutputParserException
+from langchainadapters import AgentRunCallbackHandler, AzureOpenAI, BudgetedAgentExecutor, PartialAnswerMixin, TracingCallbackHandler, agent_run, current_agent_run
+from cache import TTLCache
 from text import nonewlines
-from typing import Any, List, Optional
+from retrieval import RetrievalCache, search
+from tracing import span
+from typing import Any, Callable, List, Optional, Tuple, Union
 
 class ReadDecomposeAsk(Approach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str, retrieval_cache: Optional[RetrievalCache] = None,
+                 max_seconds: Optional[float] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.retrieval_cache = retrieval_cache
+        # Time limit of a run, see AgentRun
+        self.max_seconds = max_seconds
+        # Agents built so far, by the overrides they're built from, they're shared by all the requests using them
+        self.agents = TTLCache(maxsize=32, ttl=float("inf"))
+        # Runs the searches and lookups of the agents ahead of them, see prefetch
+        self.tool_threads = ThreadPoolExecutor(max_workers=16, thread_name_prefix="rda-tools")
 
-    def search(self, q: str, overrides: dict[str, Any]) -> str:
+    def search(self, q: str, overrides: dict[str, Any]) -> tuple[str, list[str]]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        if overrides.get("semantic_ranker"):
+        r = search(self.search_client, q, overrides, self.retrieval_cache)
+        if use_semantic_captions:
+            results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
+        else:
+            results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
+        return "\n".join(results), results
+
+    def lookup(self, q: str) -> Optional[str]:
+        key = RetrievalCache.key(q, {"query_answer": "extractive|count-1"})
+        with span("search.lookup", cached=True) as attributes:
+            answer = self.retrieval_cache.get(key) if self.retrieval_cache is not None else None
+            if answer is not None:
+                return answer
+            attributes["cached"] = False
             r = self.search_client.search(q,
-                                          filter=filter,
+                                          top = 1,
+                                          include_total_count=True,
                                           query_type=QueryType.SEMANTIC, 
                                           query_language="en-us", 
                                           query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
+                                          semantic_configuration_name="default",
+                                          query_answer="extractive|count-1",
+                                          query_caption="extractive|highlight-false")
+            
+            answers = r.get_answers()
+            if answers and len(answers) > 0:
+                answer = answers[0].text
+            elif r.get_count() > 0:
+                answer = "\n".join(d['content'] for d in r)
+            if answer is not None and self.retrieval_cache is not None:
+                self.retrieval_cache.put(key, answer)
+            return answer
+
+    # Starts the tool calls of a step on the tool threads as soon as the agent asked for them, so the calls of a step
+    # run at the same time and the tools only wait for their results. In parallel mode every Search is followed by a
+    # speculative Lookup of the same term, in case the agent asks for it in the next step.
+    def prefetch(self, actions: List[AgentAction]):
+        run = current_agent_run.get()
+        calls = [(action.tool, action.tool_input) for action in actions]
+        if run.overrides.get("parallel_search"):
+            calls += [("Lookup", action.tool_input) for action in actions if action.tool == "Search"]
+        # Speculative lookups the agent didn't ask for are dropped, unless they've started
+        for call in [call for call in run.pending if call not in calls]:
+            run.pending.pop(call).cancel()
+        for tool, q in calls:
+            if (tool, q) not in run.pending and tool in ("Search", "Lookup"):
+                func: Callable[[], Any] = (lambda q=q: self.search(q, run.overrides)) if tool == "Search" else (lambda q=q: self.lookup(q))
+                run.pending[(tool, q)] = self.tool_threads.submit(contextvars.copy_context().run, func)
+
+    def run_search(self, q: str) -> str:
+        run = current_agent_run.get()
+        future = run.pending.pop(("Search", q), None)
+        if future is not None:
+            content, results = run.wait(future)
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
-        return "\n".join(self.results)
+            run.check_deadline()
+            content, results = self.search(q, run.overrides)
+        # The data points are the results of the searches of the last step that searched
+        if run.results_step != run.step:
+            run.results, run.results_step = [], run.step
+        run.results = run.results + results
+        return content
 
-    def lookup(self, q: str) -> Optional[str]:
-        r = self.search_client.search(q,
-                                      top = 1,
-                                      include_total_count=True,
-                                      query_type=QueryType.SEMANTIC, 
-                                      query_language="en-us", 
-                                      query_speller="lexicon", 
-                                      semantic_configuration_name="default",
-                                      query_answer="extractive|count-1",
-                                      query_caption="extractive|highlight-false")
-        
-        answers = r.get_answers()
-        if answers and len(answers) > 0:
-            return answers[0].text
-        if r.get_count() > 0:
-            return "\n".join(d['content'] for d in r)
-        return None
+    def run_lookup(self, q: str) -> Optional[str]:
+        run = current_agent_run.get()
+        future = run.pending.pop(("Lookup", q), None)
+        if future is not None:
+            return run.wait(future)
+        run.check_deadline()
+        return self.lookup(q)
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    # The agent for the prompt, temperature and mode of the overrides, the rest of the overrides and the results of a
+    # run are in the current AgentRun
+    def agent(self, overrides: dict[str, Any]) -> BudgetedAgentExecutor:
+        prompt_prefix = overrides.get("prompt_template")
+        temperature = overrides.get("temperature") or 0.3
+        parallel = bool(overrides.get("parallel_search"))
+        key = (prompt_prefix, temperature, parallel)
+        chain = self.agents.get(key)
+        if chain is None:
+            # Use to capture thought process during iterations
+            cb_manager = CallbackManager(handlers=[AgentRunCallbackHandler()])
 
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+            llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=temperature)
+            tools = [
+                Tool(name="Search", func=self.run_search, description="useful for when you need to ask with search", callbacks=cb_manager),
+                Tool(name="Lookup", func=self.run_lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
+            ]
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
-        tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides), description="useful for when you need to ask with search", callbacks=cb_manager),
-            Tool(name="Lookup", func=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
-        ]
+            prefix = PARALLEL_PREFIX if parallel else PREFIX
+            prompt = PromptTemplate.from_examples(
+                PARALLEL_EXAMPLES if parallel else EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + prefix if prompt_prefix else prefix)
 
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
-        prompt_prefix = overrides.get("prompt_template")
-        prompt = PromptTemplate.from_examples(
-            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+            ReAct._validate_tools(tools)
+            agent = ReAct(llm_chain=LLMChain(llm=llm, prompt=prompt), allowed_tools=[tool.name for tool in tools], prefetch=self.prefetch,
+                          output_parser=ParallelReActOutputParser() if parallel else ReActOutputParser())
+            chain = BudgetedAgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
+            self.agents.put(key, chain)
+        return chain
 
-        agent = ReAct.from_llm_and_tools(llm, tools)
-        chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        chain = self.agent(overrides)
+        # Passed to the run so the agent's completions and tools, which run as child chains, report to it too
+        tracing_handler = TracingCallbackHandler()
+        with agent_run(overrides, self.max_seconds) as run, span("agent") as attributes:
+            try:
+                result = chain.run(q, callbacks=[tracing_handler])
+            finally:
+                for future in run.pending.values():
+                    future.cancel()
+            attributes["steps"] = tracing_handler.steps
 
         # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid 
         # generalizing too much and disrupt HTML snippets if present
         result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
-    
-class ReAct(ReActDocstoreAgent):
-    @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
-    
+        return {"data_points": run.results, "answer": result, "thoughts": run.html}
+
+# ReAct agent starting the tool calls it asks for as soon as it has parsed them (see ReadDecomposeAsk.prefetch). With
+# ParallelReActOutputParser a step can ask for several calls, their observations are put together in the scratchpad.
+# Stopped before it finished, it answers with what it found so far (see PartialAnswerMixin).
+class ReAct(PartialAnswerMixin, ReActDocstoreAgent):
+    prefetch: Callable[[List[AgentAction]], None]
+
+    def plan(self, intermediate_steps: List[Tuple[AgentAction, str]], callbacks: Any = None, **kwargs: Any) -> Union[AgentAction, List[AgentAction], AgentFinish]:
+        output = super().plan(intermediate_steps, callbacks, **kwargs)
+        if not isinstance(output, AgentFinish):
+            self.prefetch(output if isinstance(output, list) else [output])
+        return output
+
+    # The actions of a step share the completion's log, which is written once followed by all their observations
+    def _construct_scratchpad(self, intermediate_steps: List[Tuple[AgentAction, str]]) -> str:
+        steps: list[list[Tuple[AgentAction, str]]] = []
+        for action, observation in intermediate_steps:
+            if steps and action.log is steps[-1][0][0].log:
+                steps[-1].append((action, observation))
+            else:
+                steps.append([(action, observation)])
+        thoughts = ""
+        for step in steps:
+            thoughts += step[0][0].log
+            observation = step[0][1] if len(step) == 1 else "\n".join(f"{action.tool}[{action.tool_input}]: {observation}" for action, observation in step)
+            thoughts += f"\n{self.observation_prefix}{observation}\n{self.llm_prefix}"
+        return thoughts
+
+# Parses "Action: Search[a] | Search[b]" into actions run in the same step, a Finish ends the run
+class ParallelReActOutputParser(ReActOutputParser):
+    def parse(self, text: str) -> Union[AgentAction, List[AgentAction], AgentFinish]:
+        action_block = text.strip().split("\n")[-1]
+        if not action_block.startswith("Action: "):
+            raise OutputParserException(f"Could not parse LLM Output: {text}")
+        actions = re.findall(r"\s*(.*?)\[(.*?)\]\s*(?:\||$)", action_block[len("Action: "):])
+        if len(actions) <= 1:
+            return super().parse(text)
+        for action, action_input in actions:
+            if action == "Finish":
+                return AgentFinish({"output": action_input}, text)
+        return [AgentAction(action, action_input, text) for action, action_input in actions]
+
 # Modified version of langchain's ReAct prompt that includes instructions and examples for how to cite information sources
 EXAMPLES = [
     """Question: What is the elevation range for the area that the eastern sector of the
@@ -208,3 +308,34 @@ PREFIX = "Answer questions as shown in the following examples, by splitting the
 "Observations are prefixed by their source name in angled brackets, source names MUST be included with the actions in the answers." \
 "All questions must be answered from the results from search or look up actions, only facts resulting from those can be used in an answer. "
 "Answer questions as truthfully as possible, and ONLY answer the questions using the information from observations, do not speculate or your own knowledge."
+
+# Parallel mode: searches that don't depend on each other are asked for in the same action, two of the examples are
+# rewritten that way
+PARALLEL_PREFIX = PREFIX + "When several searches or lookups don't depend on each other's results, ask for them in a single action " \
+"separated by \" | \", e.g. \"Action: Search[first] | Search[second]\", the observation then has the result of each of them."
+PARALLEL_EXAMPLES = EXAMPLES[:3] + [
+    """Question: What profession does Nicholas Ray and Elia Kazan have in common?
+Thought: I need to search Nicholas Ray and Elia Kazan, find their professions, then
+find the profession they have in common. The two searches are independent.
+Action: Search[Nicholas Ray] | Search[Elia Kazan]
+Observation: Search[Nicholas Ray]: <files-987.png> Nicholas Ray (born Raymond Nicholas Kienzle Jr., August 7, 1911 - June 16,
+1979) was an American film director, screenwriter, and actor best known for
+the 1955 film Rebel Without a Cause.
+Search[Elia Kazan]: <files-654.txt> Elia Kazan was an American film and theatre director, producer, screenwriter
+and actor.
+Thought: Professions of Nicholas Ray are director, screenwriter, and actor. Professions
+of Elia Kazan are director, producer, screenwriter, and actor. So profession Nicholas
+Ray and Elia Kazan have in common is director, screenwriter, and actor.
+Action: Finish[director, screenwriter, actor <files-987.png><files-654.txt>]""",
+    """Question: Which magazine was started first Arthur's Magazine or First for Women?
+Thought: I need to search Arthur's Magazine and First for Women, and find which was
+started first. The two searches are independent.
+Action: Search[Arthur's Magazine] | Search[First for Women]
+Observation: Search[Arthur's Magazine]: <magazines-1850.pdf> Arthur's Magazine (1844-1846) was an American literary periodical published
+in Philadelphia in the 19th century.
+Search[First for Women]: <magazines-1900.pdf> First for Women is a woman's magazine published by Bauer Media Group in the
+USA.[1] The magazine was started in 1989.
+Thought: Arthur's Magazine was started in 1844 and First for Women in 1989. 1844 (Arthur's
+Magazine) < 1989 (First for Women), so Arthur's Magazine was started first.
+Action: Finish[Arthur's Magazine <magazines-1850.pdf><magazines-1900.pdf>]""",
+] + EXAMPLES[5:]
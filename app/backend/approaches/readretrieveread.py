@@ -1,16 +1,15 @@
-import openai
 from approaches.approach import Approach
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
 from langchain.callbacks.manager import CallbackManager, Callbacks
 from langchain.chains import LLMChain
-from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchain.llms.openai import AzureOpenAI
-from langchainadapters import HtmlCallbackHandler
+from langchain.agents import Tool, ZeroShotAgent
+from langchainadapters import AgentRun, AgentRunCallbackHandler, AzureOpenAI, BudgetedAgentExecutor, PartialAnswerMixin, TracingCallbackHandler, agent_run, current_agent_run
+from cache import TTLCache
 from text import nonewlines
+from retrieval import RetrievalCache, search
 from lookuptool import CsvLookupTool
-from typing import Any
+from tracing import span
+from typing import Any, Optional
 
 # Attempt to answer questions by iteratively evaluating the question to see what information is missing, and once all information
 # is present then formulate an answer. Each iteration consists of two parts: first use GPT to see if we need more information, 
@@ -40,69 +39,79 @@ Thought: {agent_scratchpad}"""
 
     CognitiveSearchToolDescription = "useful for searching the Microsoft employee benefits information such as healthcare plans, retirement plans, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str, retrieval_cache: Optional[RetrievalCache] = None,
+                 max_seconds: Optional[float] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.retrieval_cache = retrieval_cache
+        # Time limit of a run, see AgentRun
+        self.max_seconds = max_seconds
+        # Agents built so far, by the overrides they're built from, they're shared by all the requests using them
+        self.agents = TTLCache(maxsize=32, ttl=float("inf"))
 
-    def retrieve(self, q: str, overrides: dict[str, Any]) -> Any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+    def retrieve(self, q: str, run: AgentRun) -> Any:
+        run.check_deadline()
+        use_semantic_captions = True if run.overrides.get("semantic_captions") else False
+
+        r = search(self.search_client, q, run.overrides, self.retrieval_cache)
         if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            run.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
-        content = "\n".join(self.results)
+            run.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
+        content = "\n".join(run.results)
         return content
-        
+
+    # The agent for the prompt and temperature of the overrides, the rest of the overrides and the results of a run are
+    # in the current AgentRun
+    def agent(self, overrides: dict[str, Any]) -> BudgetedAgentExecutor:
+        prefix = overrides.get("prompt_template_prefix") or self.template_prefix
+        suffix = overrides.get("prompt_template_suffix") or self.template_suffix
+        temperature = overrides.get("temperature") or 0.3
+        key = (prefix, suffix, temperature)
+        agent_exec = self.agents.get(key)
+        if agent_exec is None:
+            # Use to capture thought process during iterations
+            cb_manager = CallbackManager(handlers=[AgentRunCallbackHandler()])
+
+            acs_tool = Tool(name="CognitiveSearch",
+                            func=lambda q: self.retrieve(q, current_agent_run.get()),
+                            description=self.CognitiveSearchToolDescription,
+                            callbacks=cb_manager)
+            employee_tool = EmployeeInfoTool("Employee1", callbacks=cb_manager)
+            tools = [acs_tool, employee_tool]
+
+            prompt = ZeroShotAgent.create_prompt(
+                tools=tools,
+                prefix=prefix,
+                suffix=suffix,
+                input_variables = ["input", "agent_scratchpad"])
+            llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=temperature)
+            chain = LLMChain(llm = llm, prompt = prompt)
+            agent_exec = BudgetedAgentExecutor.from_agent_and_tools(
+                agent = PartialAnswerZeroShotAgent(llm_chain = chain, tools = tools),
+                tools = tools,
+                verbose = True,
+                callback_manager = cb_manager)
+            self.agents.put(key, agent_exec)
+        return agent_exec
+
     def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
-
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-        
-        acs_tool = Tool(name="CognitiveSearch", 
-                        func=lambda q: self.retrieve(q, overrides), 
-                        description=self.CognitiveSearchToolDescription,
-                        callbacks=cb_manager)
-        employee_tool = EmployeeInfoTool("Employee1", callbacks=cb_manager)
-        tools = [acs_tool, employee_tool]
-
-        prompt = ZeroShotAgent.create_prompt(
-            tools=tools,
-            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
-            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
-            input_variables = ["input", "agent_scratchpad"])
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
-        chain = LLMChain(llm = llm, prompt = prompt)
-        agent_exec = AgentExecutor.from_agent_and_tools(
-            agent = ZeroShotAgent(llm_chain = chain, tools = tools),
-            tools = tools, 
-            verbose = True, 
-            callback_manager = cb_manager)
-        result = agent_exec.run(q)
-                
+        agent_exec = self.agent(overrides)
+        # Passed to the run so the agent's completions and tools, which run as child chains, report to it too
+        tracing_handler = TracingCallbackHandler()
+        with agent_run(overrides, self.max_seconds) as run, span("agent") as attributes:
+            result = agent_exec.run(q, callbacks=[tracing_handler])
+            attributes["steps"] = tracing_handler.steps
+
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": run.results, "answer": result, "thoughts": run.html}
+
+class PartialAnswerZeroShotAgent(PartialAnswerMixin, ZeroShotAgent):
+    pass
 
 class EmployeeInfoTool(CsvLookupTool):
     employee_name: str = ""
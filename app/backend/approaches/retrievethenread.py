@@ -1,9 +1,12 @@
+import asyncio
+import time
 import openai
 from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from azure.search.documents.aio import SearchClient
 from text import nonewlines
-from typing import Any
+from retrieval import RetrievalCache, asearch
+from tracing import span
+from typing import Any, AsyncGenerator, Optional
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
 # top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion 
@@ -40,29 +43,17 @@ Sources:
 Answer:
 """
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str, retrieval_cache: Optional[RetrievalCache] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.retrieval_cache = retrieval_cache
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+    async def retrieve_and_prompt(self, q: str, overrides: dict[str, Any]) -> tuple[list[str], str]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+
+        r = await asearch(self.search_client, q, overrides, self.retrieval_cache)
         if use_semantic_captions:
             results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
@@ -70,7 +61,10 @@ Answer:
         content = "\n".join(results)
 
         prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
-        completion = openai.Completion.create(
+        return results, prompt
+
+    def completion_args(self, prompt: str, overrides: dict[str, Any]) -> dict[str, Any]:
+        return dict(
             engine=self.openai_deployment, 
             prompt=prompt, 
             temperature=overrides.get("temperature") or 0.3, 
@@ -78,4 +72,27 @@ Answer:
             n=1, 
             stop=["\n"])
 
+    # Synchronous entry point kept for callers that aren't running an event loop (scripts, notebooks), the web app
+    # calls arun
+    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        return asyncio.run(self.arun(q, overrides))
+
+    async def arun(self, q: str, overrides: dict[str, Any]) -> Any:
+        results, prompt = await self.retrieve_and_prompt(q, overrides)
+        with span("openai.completion"):
+            completion = await openai.Completion.acreate(**self.completion_args(prompt, overrides))
+
         return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+
+    async def arun_stream(self, q: str, overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        results, prompt = await self.retrieve_and_prompt(q, overrides)
+        yield {"data_points": results}
+
+        with span("openai.completion", stream=True) as attributes:
+            start = time.perf_counter()
+            async for chunk in await openai.Completion.acreate(**self.completion_args(prompt, overrides), stream=True):
+                if chunk.choices and chunk.choices[0].text:
+                    attributes.setdefault("first_token_ms", round((time.perf_counter() - start) * 1000, 1))
+                    yield {"answer": chunk.choices[0].text}
+
+        yield {"thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
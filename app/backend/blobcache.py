@@ -0,0 +1,84 @@
+import hashlib
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Optional
+
+# Bounded local disk cache for content blobs. Entries are keyed on blob name and ETag, so a changed blob is never
+# served from a stale copy. When the total size goes over max_bytes the least recently used files are removed.
+class BlobDiskCache:
+    def __init__(self, directory: str, max_bytes: int, max_entry_bytes: Optional[int] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 10
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str, etag: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(f"{name}\0{etag}".encode("utf-8")).hexdigest())
+
+    # Opens the cached copy of a blob, or returns None if there's none. Entries can be evicted by other requests at any
+    # time, so the file is opened here rather than returning its path: an open file stays readable once it's removed.
+    # Blocking, call it from a worker thread.
+    def open(self, name: str, etag: str) -> Optional[BinaryIO]:
+        path = self.path(name, etag)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            # The modification time doubles as the last access time for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted since it was opened, it can still be read
+            pass
+        return f
+
+    def cacheable(self, size: int) -> bool:
+        return size <= self.max_entry_bytes
+
+    def writer(self, name: str, etag: str) -> "BlobDiskCacheWriter":
+        return BlobDiskCacheWriter(self, self.path(name, etag))
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(e[1] for e in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except PermissionError:
+                    # Still open for reading on platforms that don't allow removing open files, it'll go next time
+                    continue
+                total -= size
+
+# Writes a blob to a temporary file as it's being streamed, and only moves it into the cache once complete
+class BlobDiskCacheWriter:
+    def __init__(self, cache: BlobDiskCache, path: str):
+        self.cache = cache
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        self.cache.evict()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
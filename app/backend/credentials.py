@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from azure.core.credentials import AccessToken, TokenCredential
+
+OPENAI_SCOPE = "https://cognitiveservices.azure.com/.default"
+SEARCH_SCOPE = "https://search.azure.com/.default"
+STORAGE_SCOPE = "https://storage.azure.com/.default"
+
+# Credential that hands out cached access tokens and renews them on a background thread before they expire, so
+# requests never wait on Azure AD. It wraps another credential (e.g. DefaultAzureCredential) and can be passed to the
+# Azure SDK clients in its place; AsyncTokenRefresher does the same for the async clients.
+#
+# Tokens are renewed refresh_margin seconds before they expire (or half way through their lifetime for short lived
+# ones), which is before the Azure SDK clients ask for a new one (they do 5 minutes before expiry). Only one thread
+# renews a given token at a time, the others keep using the current one. If renewing fails it's retried every
+# retry_interval seconds while the current token is still valid. Reading a token doesn't take a lock, the cache is
+# only ever replaced as a whole.
+class TokenRefresher(TokenCredential):
+    # Seconds a token must still be valid for to be handed out
+    min_validity = 30
+
+    def __init__(self, credential: TokenCredential, refresh_margin: float = 600, retry_interval: float = 30):
+        self.credential = credential
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._tokens: dict[tuple[str, ...], AccessToken] = {}
+        # When each token is due for renewal, pushed back by retry_interval after a failure
+        self._refresh_at: dict[tuple[str, ...], float] = {}
+        self._listeners: dict[tuple[str, ...], list[Callable[[AccessToken], None]]] = {}
+        self._locks: dict[tuple[str, ...], threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get_token(self, *scopes: str, claims: Optional[str] = None, tenant_id: Optional[str] = None, **kwargs) -> AccessToken:
+        # Claims challenges and other tenants need a token made for them, they aren't cached
+        if claims or tenant_id:
+            return self.credential.get_token(*scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+        token = self.cached_token(scopes)
+        return token if token is not None else self.refresh(scopes)
+
+    # The cached token for scopes if it's still valid, None otherwise
+    def cached_token(self, scopes: tuple[str, ...]) -> Optional[AccessToken]:
+        token = self._tokens.get(scopes)
+        return token if token is not None and token.expires_on > time.time() + self.min_validity else None
+
+    # Gets a new token for scopes unless another thread did while this one waited for the lock. Renewals ahead of
+    # expiry (ahead=True) are skipped when the token isn't due yet, otherwise only a valid token is kept.
+    def refresh(self, scopes: tuple[str, ...], ahead: bool = False) -> AccessToken:
+        with self._locks_lock:
+            lock = self._locks.setdefault(scopes, threading.Lock())
+        with lock:
+            token = self.cached_token(scopes)
+            if token is not None and (not ahead or time.time() < self._refresh_at[scopes]):
+                return token
+            token = self.credential.get_token(*scopes)
+            now = time.time()
+            self._refresh_at[scopes] = max(token.expires_on - self.refresh_margin, now + (token.expires_on - now) / 2)
+            self._tokens = {**self._tokens, scopes: token}
+            listeners = list(self._listeners.get(scopes, []))
+        for listener in listeners:
+            listener(token)
+        # The background thread may have to wake up earlier for this token
+        self._wake.set()
+        return token
+
+    # Calls listener with the token for scope now and whenever it's renewed, e.g. to update a library's global key
+    def subscribe(self, scope: str, listener: Callable[[AccessToken], None]):
+        self._listeners.setdefault((scope,), []).append(listener)
+        token = self.cached_token((scope,))
+        if token is not None:
+            listener(token)
+        else:
+            self.refresh((scope,))
+
+    # Starts renewing the cached tokens in the background, getting the tokens for scopes first so the first requests
+    # using them don't wait either
+    def start(self, *scopes: str):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, args=(scopes,), name="token-refresher", daemon=True)
+            self._thread.start()
+
+    def _run(self, scopes: tuple[str, ...]):
+        for scope in scopes:
+            self._refresh_ahead((scope,))
+        while not self._stopped.is_set():
+            self._wake.clear()
+            for s, at in list(self._refresh_at.items()):
+                if at <= time.time():
+                    self._refresh_ahead(s)
+            next_at = min(list(self._refresh_at.values()), default=time.time() + 3600)
+            self._wake.wait(min(max(next_at - time.time(), 1), 3600))
+
+    def _refresh_ahead(self, scopes: tuple[str, ...]):
+        try:
+            self.refresh(scopes, ahead=True)
+        except Exception:
+            logging.exception("Failed to renew the access token for %s, retrying in %ss", " ".join(scopes), self.retry_interval)
+            self._refresh_at[scopes] = time.time() + self.retry_interval
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Async credential for the async Azure SDK clients, handing out the tokens of a TokenRefresher. Closing it leaves the
+# TokenRefresher running, it's shared with the synchronous clients.
+class AsyncTokenRefresher:
+    def __init__(self, refresher: TokenRefresher):
+        self.refresher = refresher
+
+    async def get_token(self, *scopes: str, claims: Optional[str] = None, tenant_id: Optional[str] = None, **kwargs) -> AccessToken:
+        token = None if claims or tenant_id else self.refresher.cached_token(scopes)
+        if token is None:
+            token = await asyncio.to_thread(self.refresher.get_token, *scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+        return token
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
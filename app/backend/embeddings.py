@@ -0,0 +1,90 @@
+import asyncio
+import functools
+import hashlib
+
+import numpy as np
+import openai
+
+from localsearch import tokenize
+from prompt import count_tokens
+
+# Turns texts into unit length float32 vectors, so the dot product of two embeddings is their cosine similarity.
+# Embedders are named, the name is recorded in the embedding store and create_embedder(name) builds the same embedder
+# again to embed queries at serving time.
+class Embedder:
+    name: str
+    dimensions: int
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    # Size of a text for the embedder's input limits, used to batch texts
+    def count_tokens(self, text: str) -> int:
+        raise NotImplementedError
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        return await asyncio.to_thread(self.embed, texts)
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+@functools.lru_cache(maxsize=65536)
+def feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+# Deterministic embedder that runs locally: words and pairs of adjacent words are hashed into dimensions buckets with
+# a random sign (the hashing trick). It doesn't know about synonyms, but it's fast, needs no service and always gives
+# the same vectors, so it's meant for tests, benchmarks and offline runs.
+class HashingEmbedder(Embedder):
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = tokenize(text)
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                h = feature_hash(feature)
+                vectors[i, h % self.dimensions] += 1.0 if h >> 63 else -1.0
+        return normalize(vectors)
+
+    def count_tokens(self, text: str) -> int:
+        return len(tokenize(text))
+
+# Embeddings deployment of Azure OpenAI (e.g. text-embedding-ada-002), using the openai module configuration. The
+# service takes a limited number of inputs per request, larger lists are sent in several requests.
+class OpenAIEmbedder(Embedder):
+    def __init__(self, deployment: str, dimensions: int = 1536, batch_size: int = 16):
+        self.deployment = deployment
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.name = f"openai:{deployment}"
+
+    def count_tokens(self, text: str) -> int:
+        # Tokenizer of the OpenAI embedding models
+        return count_tokens("cl100k_base", text)
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            response = openai.Embedding.create(engine=self.deployment, input=texts[i:i + self.batch_size])
+            vectors.extend(d["embedding"] for d in sorted(response["data"], key=lambda d: d["index"]))
+        return normalize(np.array(vectors, dtype=np.float32).reshape(len(texts), self.dimensions))
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            response = await openai.Embedding.acreate(engine=self.deployment, input=texts[i:i + self.batch_size])
+            vectors.extend(d["embedding"] for d in sorted(response["data"], key=lambda d: d["index"]))
+        return normalize(np.array(vectors, dtype=np.float32).reshape(len(texts), self.dimensions))
+
+# "hashing-<dimensions>" for HashingEmbedder, "openai:<deployment>" for OpenAIEmbedder
+def create_embedder(name: str) -> Embedder:
+    if name.startswith("hashing-") and name[len("hashing-"):].isdigit():
+        return HashingEmbedder(int(name[len("hashing-"):]))
+    if name.startswith("openai:") and len(name) > len("openai:"):
+        return OpenAIEmbedder(name[len("openai:"):])
+    raise ValueError(f"Unknown embedder '{name}', use hashing-<dimensions> or openai:<deployment>")
@@ -0,0 +1,12 @@
+import multiprocessing
+
+# Each worker runs an asyncio event loop, so a handful of workers can hold many concurrent requests while
+# they wait on Cognitive Search and OpenAI
+max_requests = 1000
+max_requests_jitter = 50
+log_file = "-"
+bind = "0.0.0.0:8000"
+
+workers = (multiprocessing.cpu_count() * 2) + 1
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 120
@@ -0,0 +1,115 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional
+
+import numpy as np
+
+from embeddings import Embedder
+
+# Azure OpenAI embeddings deployments take up to 16 inputs per request, batches are also kept under a number of
+# tokens so a single request doesn't use up the tokens per minute quota
+MAX_BATCH_COUNT = 16
+MAX_BATCH_TOKENS = 8000
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Embeddings computed so far, keyed on the embedder name and the hash of the text, in a SQLite database so they
+# survive between runs. Connections are shared between threads, access goes through a lock.
+class EmbeddingCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))")
+        self.db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, model: str, hashes: list[str]) -> dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            # SQLite limits the number of parameters of a statement
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                rows = self.db.execute(f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                                       [model, *chunk])
+                found.update((h, np.frombuffer(vector, dtype=np.float32)) for h, vector in rows)
+        return found
+
+    def put(self, model: str, vectors: dict[str, np.ndarray]):
+        with self._lock:
+            self.db.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                                [(model, h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in vectors.items()])
+            self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+# Embeds texts with few calls to the embedder: identical texts are embedded once, texts already in the cache aren't
+# embedded again, and the rest are sent in batches of up to max_batch_count texts and max_batch_tokens tokens. Each
+# batch reports its throughput, and the totals are kept for a summary at the end of a run.
+class BatchEmbedder:
+    def __init__(self, embedder: Embedder, cache: Optional[EmbeddingCache] = None, max_batch_count: int = MAX_BATCH_COUNT,
+                 max_batch_tokens: int = MAX_BATCH_TOKENS, verbose: bool = True):
+        self.embedder = embedder
+        self.cache = cache
+        self.max_batch_count = max(1, max_batch_count)
+        self.max_batch_tokens = max_batch_tokens
+        self.verbose = verbose
+        self.texts = 0
+        self.embedded = 0
+        self.cached = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    # Returns one embedding per text, in order
+    def embed(self, texts: list[str]) -> np.ndarray:
+        hashes = [text_hash(t) for t in texts]
+        unique = dict(zip(hashes, texts))
+        vectors = self.cache.get(self.embedder.name, list(unique)) if self.cache else {}
+        cached = len(vectors)
+        missing = [(h, t) for h, t in unique.items() if h not in vectors]
+        for batch in self.batches(missing):
+            start = time.perf_counter()
+            batch_vectors = dict(zip((h for h, _ in batch), self.embedder.embed([t for _, t in batch])))
+            elapsed = time.perf_counter() - start
+            if self.cache:
+                self.cache.put(self.embedder.name, batch_vectors)
+            vectors.update(batch_vectors)
+            with self._lock:
+                self.embedded += len(batch)
+                self.seconds += elapsed
+            if self.verbose: print(f"\tEmbedded {len(batch)} sections in {elapsed:.2f}s ({len(batch) / max(elapsed, 1e-6):.0f} embeddings/s)")
+        with self._lock:
+            self.texts += len(texts)
+            self.cached += cached
+        if self.verbose and cached: print(f"\t{cached} embeddings from cache")
+        if not texts:
+            return np.zeros((0, self.embedder.dimensions), dtype=np.float32)
+        return np.stack([vectors[h] for h in hashes])
+
+    def batches(self, items: list[tuple[str, str]]) -> Iterator[list[tuple[str, str]]]:
+        batch = []
+        batch_tokens = 0
+        for h, text in items:
+            tokens = self.embedder.count_tokens(text)
+            if batch and (len(batch) >= self.max_batch_count or batch_tokens + tokens > self.max_batch_tokens):
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append((h, text))
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def summary(self) -> str:
+        with self._lock:
+            rate = self.embedded / self.seconds if self.seconds else 0.0
+            return (f"{self.texts} sections: {self.embedded} embedded ({rate:.0f} embeddings/s), {self.cached} from cache, "
+                    f"{self.texts - self.embedded - self.cached} duplicates")
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
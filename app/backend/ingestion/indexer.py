@@ -0,0 +1,102 @@
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+from azure.core.exceptions import HttpResponseError
+
+# Azure Cognitive Search accepts up to 1000 documents and 16 MB per indexing request, batches are kept well under the
+# size limit since large table HTML sections add up quickly
+MAX_BATCH_COUNT = 1000
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+# Status codes of throttled or temporarily unavailable requests, and of documents that can be sent again
+RETRY_STATUS_CODES = (429, 503)
+RETRY_DOCUMENT_STATUS_CODES = (409, 422, 429, 503)
+
+# Uploads sections to (or deletes them from) the search index in batches limited both by number of documents and by
+# size, keeping up to concurrency batches in flight. Throttled batches and documents that failed with a transient
+# error are sent again with exponential backoff, batches rejected for being too large are split in two. Each batch
+# reports its throughput, to tune the batch size and concurrency for the search service tier.
+class SectionIndexer:
+    def __init__(self, search_client, concurrency: int = 2, max_batch_count: int = MAX_BATCH_COUNT, max_batch_bytes: int = MAX_BATCH_BYTES,
+                 max_retries: int = 5, backoff: float = 1.0, verbose: bool = True):
+        self.search_client = search_client
+        self.concurrency = max(1, concurrency)
+        self.max_batch_count = max_batch_count
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.verbose = verbose
+
+    # Returns the number of sections indexed successfully
+    def index(self, sections: Iterable[dict]) -> int:
+        return self.run(self.batches(sections), delete=False)
+
+    # Deletes sections by key, returns the number of sections deleted successfully
+    def delete(self, section_ids: Iterable[str]) -> int:
+        return self.run(self.batches({"id": i} for i in section_ids), delete=True)
+
+    def run(self, batches: Iterator[list], delete: bool) -> int:
+        if self.concurrency == 1:
+            return sum(self.send(batch, delete) for batch in batches)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return sum(executor.map(lambda batch: self.send(batch, delete), batches))
+
+    def batches(self, sections: Iterable[dict]) -> Iterator[list]:
+        batch = []
+        batch_bytes = 0
+        for s in sections:
+            size = len(json.dumps(s, ensure_ascii=False).encode("utf-8"))
+            if batch and (len(batch) >= self.max_batch_count or batch_bytes + size > self.max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(s)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def send(self, batch: list, delete: bool = False) -> int:
+        operation = self.search_client.delete_documents if delete else self.search_client.upload_documents
+        succeeded = 0
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                results = operation(documents=batch)
+            except HttpResponseError as e:
+                if e.status_code == 413 and len(batch) > 1:
+                    # Too large after all, send each half on its own
+                    return self.send(batch[:len(batch) // 2], delete) + self.send(batch[len(batch) // 2:], delete)
+                if e.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    raise
+                self.wait(attempt, e.response.headers.get("Retry-After") if e.response is not None else None)
+                continue
+            elapsed = time.perf_counter() - start
+
+            batch_succeeded = sum(1 for r in results if r.succeeded)
+            succeeded += batch_succeeded
+            if self.verbose:
+                kb = sum(len(json.dumps(s, ensure_ascii=False).encode("utf-8")) for s in batch) / 1024
+                print(f"\t{'Removed' if delete else 'Indexed'} {len(results)} sections, {batch_succeeded} succeeded ({kb:.0f} KB in {elapsed:.2f}s, {len(results) / max(elapsed, 1e-6):.0f} sections/s)")
+
+            retry_keys = set(r.key for r in results if not r.succeeded and r.status_code in RETRY_DOCUMENT_STATUS_CODES)
+            failed = [r for r in results if not r.succeeded and r.key not in retry_keys]
+            for r in failed:
+                print(f"\tFailed to {'remove' if delete else 'index'} section {r.key}: {r.error_message}")
+            if not retry_keys:
+                return succeeded
+            if attempt == self.max_retries:
+                print(f"\tGiving up on {len(retry_keys)} sections after {self.max_retries} retries")
+                return succeeded
+            batch = [s for s in batch if s["id"] in retry_keys]
+            self.wait(attempt)
+        return succeeded
+
+    def wait(self, attempt: int, retry_after=None):
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            # Exponential backoff with jitter, so batches throttled together don't come back together
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+        time.sleep(delay)
@@ -1,28 +1,34 @@
 import os
 import re
-import io
 import glob
 from azure.search.documents.indexes.models import *
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from pypdf import PdfReader, PdfWriter
+from pypdf import PdfReader
 
-MAX_SECTION_LENGTH = 1000
-SENTENCE_SEARCH_LIMIT = 100
-SECTION_OVERLAP = 100
+from ingestion.pipeline import IngestionPipeline, ParsedFile
+from ingestion.pages import PageUploader, delete_blobs, page_pdfs
+from ingestion.indexer import SectionIndexer
+from ingestion.manifest import IngestionManifest
+from ingestion.textsplit import MAX_SECTION_LENGTH, SECTION_OVERLAP, split_text
 
 
 class Ingest:
     def __init__(
-        self, AZURE_SEARCH_INDEX, search_index_client, blob_container, search_client
+        self, AZURE_SEARCH_INDEX, search_index_client, blob_container, search_client, retrieval_cache=None, manifest_path=None,
+        index_concurrency=2
     ) -> None:
         self.index = AZURE_SEARCH_INDEX
         self.search_index_client = search_index_client
         self.blob_container = blob_container
         self.search_client = search_client
+        self.retrieval_cache = retrieval_cache
+        self.manifest_path = manifest_path
+        self.indexer = SectionIndexer(search_client, index_concurrency)
 
-    def blob_name_from_file_page(self, filename, page=0):
+    @staticmethod
+    def blob_name_from_file_page(filename, page=0):
         if os.path.splitext(filename)[1].lower() == ".pdf":
             return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".pdf"
         else:
@@ -77,42 +83,20 @@ class Ingest:
         else:
             print(f"Search index {self.index} already exists")
 
-    def upload_blobs(self, filename):
-        if not self.blob_container.exists():
-            self.blob_container.create_container()
-
-        if os.path.splitext(filename)[1].lower() == ".pdf":
-            reader = PdfReader(filename)
-            pages = reader.pages
-            for i in range(len(pages)):
-                blob_name = self.blob_name_from_file_page(filename, i)
-                print(f"\tUploading blob for page {i} -> {blob_name}")
-                f = io.BytesIO()
-                writer = PdfWriter()
-                writer.add_page(pages[i])
-                writer.write(f)
-                f.seek(0)
-                self.blob_container.upload_blob(blob_name, f, overwrite=True)
-        else:
-            blob_name = self.blob_name_from_file_page(filename)
-            with open(filename, "rb") as data:
-                self.blob_container.upload_blob(blob_name, data, overwrite=True)
-
-    def get_document_text(self, filename):
+    @staticmethod
+    def get_document_text(reader):
         offset = 0
         page_map = []
 
-        if os.path.splitext(filename)[1].lower() == ".pdf":
-            reader = PdfReader(filename)
-            pages = reader.pages
-            for page_num, p in enumerate(pages):
-                page_text = p.extract_text()
-                page_map.append((page_num, offset, page_text))
-                offset += len(page_text)
+        for page_num, p in enumerate(reader.pages):
+            page_text = p.extract_text()
+            page_map.append((page_num, offset, page_text))
+            offset += len(page_text)
 
         return page_map
 
-    def create_sections(self, filename, page_map):
+    @staticmethod
+    def create_sections(filename, page_map):
         print(f"Splitting '{filename}' into sections")
 
         for i, (section, pagenum) in enumerate(split_text(page_map)):
@@ -120,7 +104,7 @@ class Ingest:
                 "id": re.sub("[^0-9a-zA-Z_-]", "_", f"{filename}-{i}"),
                 "content": section,
                 "category": "",
-                "sourcepage": self.blob_name_from_file_page(filename, pagenum),
+                "sourcepage": Ingest.blob_name_from_file_page(filename, pagenum),
                 "sourcefile": filename
             }
 
@@ -149,91 +133,88 @@ class Ingest:
 
     def index_sections(self, filename, sections):
         print(f"Indexing sections from '{filename}' into search index '{self.index}'")
-        i = 0
-        batch = []
-
-        for s in sections:
-            batch.append(s)
-            i += 1
-            if i % 1000 == 0:
-                results = self.search_client.upload_documents(documents=batch)
-                succeeded = sum([1 for r in results if r.succeeded])
-                print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-                batch = []
-
-        if len(batch) > 0:
-            results = self.search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-
-    def run(self):
-        self.create_search_index()
+        self.indexer.index(sections)
 
-        print(f"Processing files...")
-        for filename in glob.glob("data/*"):
-            print(f"Processing '{filename}'")
-            self.upload_blobs(filename)
-            page_map = self.get_document_text(filename)
-            sections = self.create_sections(os.path.basename(filename), page_map)
-            self.index_sections(os.path.basename(filename), sections)
+    # Extracts the text, splits it into sections and splits PDFs into page blobs, runs on the pipeline's worker processes.
+    # The PDF is only read once for both.
+    @staticmethod
+    def parse_file(filename):
+        print(f"Processing '{filename}'")
+        if os.path.splitext(filename)[1].lower() == ".pdf":
+            reader = PdfReader(filename)
+            page_map = Ingest.get_document_text(reader)
+            pages = {Ingest.blob_name_from_file_page(filename, i): data for i, data in enumerate(page_pdfs(reader))}
+        else:
+            page_map = []
+            with open(filename, "rb") as f:
+                pages = {Ingest.blob_name_from_file_page(filename): f.read()}
+        return ParsedFile(list(Ingest.create_sections(os.path.basename(filename), page_map)), pages)
 
+    def remove_sections(self, section_ids):
+        self.indexer.delete(section_ids)
 
-def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+    def remove_blobs(self, blob_names):
+        delete_blobs(self.blob_container, blob_names)
 
-    def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
+    # Incremental runs only process the files that changed since the last run, according to the manifest, and remove
+    # what's left of files that shrank or were deleted. progress (an IngestionJob) is told which files are processed and
+    # when each of their stages completes.
+    def run(self, workers=1, concurrency=1, page_concurrency=4, progress=None):
+        self.create_search_index()
+        if not self.blob_container.exists():
+            self.blob_container.create_container()
 
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
+        filenames = glob.glob("data/*")
+        manifest = None
+        hashes = {}
+        if self.manifest_path:
+            manifest = IngestionManifest(self.manifest_path, target=f"{self.blob_container.account_name}/{self.blob_container.container_name}/{self.index}")
+            for name in manifest.removed_files(filenames, "data/*"):
+                print(f"Removing '{name}'")
+                self.remove_sections(manifest.sections(name))
+                self.remove_blobs(manifest.blobs(name))
+                manifest.remove(name)
+            hashes = {filename: IngestionManifest.file_hash(filename) for filename in filenames}
+            filenames = [filename for filename in filenames if manifest.has_changed(filename, hashes[filename])]
+
+        if progress:
+            progress.start(filenames)
+        uploader = PageUploader(self.blob_container, page_concurrency)
+
+        def upload(filename, pages):
+            blobs = uploader.upload(pages)
+            if manifest:
+                self.remove_blobs(manifest.set_blobs(filename, blobs))
+
+        def index(filename, sections):
+            self.index_sections(os.path.basename(filename), sections)
+            if manifest:
+                orphans = manifest.set_sections(filename, [s["id"] for s in sections])
+                if orphans:
+                    self.remove_sections(orphans)
 
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[
-                end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word  # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[
-            start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
+        def done(filename):
+            if manifest:
+                manifest.set_hash(filename, hashes[filename])
+            if progress:
+                progress.file_done(filename)
 
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+        print(f"Processing files...")
+        pipeline = IngestionPipeline(
+            parse=Ingest.parse_file,
+            upload=upload,
+            index=index,
+            workers=workers,
+            concurrency=concurrency,
+            done=done,
+            on_stage=progress.stage_done if progress else None,
+        )
+        try:
+            pipeline.run(filenames)
+        finally:
+            if manifest:
+                manifest.save()
+
+            # Cached search results may be stale now
+            if self.retrieval_cache is not None:
+                self.retrieval_cache.clear()
@@ -0,0 +1,133 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+STAGES = ("parse", "upload", "index")
+
+# Progress of one ingestion run: the state of the job, the stages completed for each file and, for each stage, how
+# many files, items (sections or pages) and seconds it took so far. It's updated from the pipeline threads and read by
+# the status endpoint, so all access goes through a lock.
+class IngestionJob:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.files_total = 0
+        self.files_done = 0
+        self.files: dict[str, dict[str, Any]] = {}
+        self.stages = {stage: {"files": 0, "items": 0, "seconds": 0.0} for stage in STAGES}
+        self._lock = threading.Lock()
+
+    # Called by Ingest.run once it knows which files it's going to process
+    def start(self, filenames: list[str]):
+        with self._lock:
+            self.files_total = len(filenames)
+            self.files = {os.path.basename(f): {"status": "pending", "stages": {}} for f in filenames}
+
+    def stage_done(self, filename: str, stage: str, seconds: float, items: int):
+        with self._lock:
+            entry = self.files.setdefault(os.path.basename(filename), {"status": "pending", "stages": {}})
+            entry["status"] = "running"
+            entry["stages"][stage] = {"seconds": round(seconds, 3), "items": items}
+            totals = self.stages.setdefault(stage, {"files": 0, "items": 0, "seconds": 0.0})
+            totals["files"] += 1
+            totals["items"] += items
+            totals["seconds"] += seconds
+
+    def file_done(self, filename: str):
+        with self._lock:
+            self.files.setdefault(os.path.basename(filename), {"stages": {}})["status"] = "done"
+            self.files_done += 1
+
+    def to_dict(self, files: bool = True) -> dict[str, Any]:
+        with self._lock:
+            end = self.finished or time.time()
+            elapsed = end - self.started if self.started else 0.0
+            result = {
+                "id": self.id,
+                "status": self.status,
+                "error": self.error,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished,
+                "elapsed": round(elapsed, 3),
+                "files_total": self.files_total,
+                "files_done": self.files_done,
+                "files_per_second": round(self.files_done / elapsed, 3) if elapsed else 0.0,
+                # Stages run in parallel, so items per second is measured against the time spent in each stage
+                "stages": {stage: {**totals, "seconds": round(totals["seconds"], 3),
+                                   "items_per_second": round(totals["items"] / totals["seconds"], 3) if totals["seconds"] else 0.0}
+                           for stage, totals in self.stages.items()},
+            }
+            if files:
+                result["files"] = {name: {"status": entry["status"], "stages": dict(entry["stages"])} for name, entry in self.files.items()}
+            return result
+
+# Runs ingestion jobs one at a time on a dedicated thread, so the request that starts a job returns right away and
+# ingestion doesn't hold a web worker. Requests for a new run while one is already waiting to start are coalesced
+# into the waiting job; while a job runs, a single follow-up job is queued so changes made during the run are picked
+# up. The last max_history jobs are kept for the status endpoint.
+#
+# Jobs only exist in the process that started them, when serving with several worker processes each one has its own.
+class IngestionJobs:
+    def __init__(self, run: Callable[[IngestionJob], None], max_history: int = 20):
+        self.run = run
+        self.max_history = max_history
+        self._jobs: OrderedDict[str, IngestionJob] = OrderedDict()
+        self._queued: Optional[IngestionJob] = None
+        self._ids = itertools.count(1)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="ingestion")
+        self._lock = threading.Lock()
+
+    # Returns the job that will pick up the request, and whether it's a new one
+    def submit(self) -> tuple[IngestionJob, bool]:
+        with self._lock:
+            if self._queued is not None:
+                return self._queued, False
+            job = IngestionJob(f"{int(time.time())}-{next(self._ids)}")
+            self._queued = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_history:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.status in ("queued", "running"):
+                    break
+                self._jobs.popitem(last=False)
+        self._executor.submit(self._run, job)
+        return job, True
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def latest(self) -> Optional[IngestionJob]:
+        with self._lock:
+            return next(reversed(self._jobs.values()), None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job: IngestionJob):
+        with self._lock:
+            if self._queued is job:
+                self._queued = None
+        with job._lock:
+            job.status = "running"
+            job.started = time.time()
+        try:
+            self.run(job)
+            status, error = "succeeded", None
+        except Exception as e:
+            logging.exception("Ingestion job %s failed", job.id)
+            status, error = "failed", str(e)
+        with job._lock:
+            job.status = status
+            job.error = error
+            job.finished = time.time()
@@ -0,0 +1,71 @@
+import html
+
+# Builds the page map (page number, offset of the page in the document text, page text) from the result of the Azure
+# Form Recognizer "prebuilt-layout" model. The text of each page is copied from the document content, except for the
+# table spans which are replaced by the HTML of the table, where the table starts.
+#
+# Each page is assembled from slices of the content between the table spans, instead of character by character, and
+# the tables are grouped by page once for the whole document. The page text is the same as building it character by
+# character: where spans of several tables overlap the later table wins, and a table with no characters left on the
+# page is left out.
+def layout_page_map(form_recognizer_results):
+    content = form_recognizer_results.content
+    tables_by_page = {}
+    for table in form_recognizer_results.tables:
+        tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
+
+    offset = 0
+    page_map = []
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = tables_by_page.get(page_num + 1, [])
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+
+        # table spans as (start, end, table_id) intervals relative to the page
+        intervals = []
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                start = max(0, span.offset - page_offset)
+                end = min(page_length, span.offset - page_offset + span.length)
+                if start < end:
+                    intervals.append((start, end, table_id))
+
+        parts = []
+        added_tables = set()
+        if intervals:
+            bounds = sorted({0, page_length}.union(b for start, end, _ in intervals for b in (start, end)))
+            for start, end in zip(bounds, bounds[1:]):
+                table_id = max((t for s, e, t in intervals if s <= start and end <= e), default=-1)
+                if table_id == -1:
+                    parts.append(content[page_offset + start:page_offset + end])
+                elif table_id not in added_tables:
+                    parts.append(table_to_html(tables_on_page[table_id]))
+                    added_tables.add(table_id)
+        else:
+            parts.append(content[page_offset:page_offset + page_length])
+
+        parts.append(" ")
+        page_text = "".join(parts)
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+
+    return page_map
+
+def table_to_html(table):
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+
+    table_html = ["<table>"]
+    for row_cells in rows:
+        table_html.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
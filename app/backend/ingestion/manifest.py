@@ -0,0 +1,87 @@
+import fnmatch
+import hashlib
+import json
+import os
+import threading
+from typing import Iterable, Optional
+
+# Keeps track of what was ingested from each file: a hash of its content, the ids of the sections indexed and the
+# page blobs uploaded (with a hash of each page). It's used to only process files that changed since the last run,
+# and to delete the sections and blobs left behind when a file shrinks or is removed.
+#
+# The manifest is tied to a target (e.g. storage account, container and index), a manifest written for another target
+# is ignored so switching environments doesn't skip files that were never ingested there.
+class IngestionManifest:
+    def __init__(self, path: str, target: str = ""):
+        self.path = path
+        self.target = target
+        self.files: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("target") == target:
+                self.files = data.get("files", {})
+
+    @staticmethod
+    def file_hash(filename: str, extra: str = "") -> str:
+        h = hashlib.sha256(extra.encode("utf-8"))
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def has_changed(self, filename: str, file_hash: str) -> bool:
+        entry = self.files.get(os.path.basename(filename))
+        return entry is None or entry.get("hash") != file_hash
+
+    # Files ingested from a path matching the pattern that are not in the current list of files
+    def removed_files(self, filenames: Iterable[str], pattern: Optional[str] = None) -> list[str]:
+        current = set(os.path.basename(f) for f in filenames)
+        return [name for name, entry in self.files.items()
+                if name not in current and (pattern is None or fnmatch.fnmatch(entry.get("path", ""), pattern))]
+
+    def sections(self, filename: str) -> list[str]:
+        return self.files.get(os.path.basename(filename), {}).get("sections", [])
+
+    def blobs(self, filename: str) -> dict[str, str]:
+        return self.files.get(os.path.basename(filename), {}).get("blobs", {})
+
+    # Records the sections of a file, returns the ids of the sections indexed before that don't exist anymore
+    def set_sections(self, filename: str, section_ids: list[str]) -> list[str]:
+        with self._lock:
+            entry = self._entry(filename)
+            current = set(section_ids)
+            orphans = [i for i in entry.get("sections", []) if i not in current]
+            entry["sections"] = section_ids
+        return orphans
+
+    # Records the page blobs of a file and their hashes, returns the blobs uploaded before that don't exist anymore
+    def set_blobs(self, filename: str, blobs: dict[str, str]) -> list[str]:
+        with self._lock:
+            entry = self._entry(filename)
+            orphans = [b for b in entry.get("blobs", {}) if b not in blobs]
+            entry["blobs"] = blobs
+        return orphans
+
+    # Only called once all the stages for the file succeeded, so a failed file is processed again on the next run
+    def set_hash(self, filename: str, file_hash: str):
+        with self._lock:
+            self._entry(filename)["hash"] = file_hash
+
+    def remove(self, filename: str):
+        with self._lock:
+            self.files.pop(os.path.basename(filename), None)
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({"target": self.target, "files": self.files}, indent=1)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+    def _entry(self, filename: str) -> dict:
+        entry = self.files.setdefault(os.path.basename(filename), {})
+        entry["path"] = filename
+        return entry
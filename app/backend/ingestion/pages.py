@@ -0,0 +1,83 @@
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pypdf import PdfWriter
+
+# Blob metadata entry holding the SHA-256 of the blob content, pages whose hash matches the blob in storage are not
+# uploaded again
+HASH_METADATA = "content_sha256"
+
+# Writes every page of an already opened PdfReader as a PDF of its own, so the same reader can be used to extract the
+# text and the file is only parsed once
+def page_pdfs(reader) -> list[bytes]:
+    pages = []
+    for page in reader.pages:
+        f = io.BytesIO()
+        writer = PdfWriter()
+        writer.add_page(page)
+        writer.write(f)
+        pages.append(f.getvalue())
+    return pages
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+# Uploads the page blobs of a file, up to concurrency at a time. The hashes of the blobs already in storage are read
+# from their metadata with a single listing, and blobs with the same content are skipped.
+class PageUploader:
+    def __init__(self, blob_container, concurrency: int = 4, verbose: bool = True):
+        self.blob_container = blob_container
+        self.concurrency = max(1, concurrency)
+        self.verbose = verbose
+
+    # Returns the hash of every blob, uploaded or not
+    def upload(self, blobs: dict[str, bytes]) -> dict[str, str]:
+        hashes = {name: content_hash(data) for name, data in blobs.items()}
+        if not blobs:
+            return hashes
+
+        prefix = os.path.commonprefix(list(blobs))
+        existing = {b.name: (b.metadata or {}).get(HASH_METADATA)
+                    for b in self.blob_container.list_blobs(name_starts_with=prefix, include=["metadata"]) if b.name in blobs}
+        changed = [name for name in blobs if existing.get(name) != hashes[name]]
+        if self.verbose and len(changed) < len(blobs):
+            print(f"\tSkipping {len(blobs) - len(changed)} unchanged blobs")
+
+        def upload_blob(name):
+            if self.verbose: print(f"\tUploading blob {name}")
+            self.blob_container.upload_blob(name, blobs[name], overwrite=True, metadata={HASH_METADATA: hashes[name]})
+
+        if len(changed) <= 1 or self.concurrency == 1:
+            for name in changed:
+                upload_blob(name)
+        else:
+            with ThreadPoolExecutor(min(self.concurrency, len(changed))) as executor:
+                # list() so the first failed upload is raised here
+                list(executor.map(upload_blob, changed))
+        return hashes
+
+# Blob Storage accepts up to 256 subrequests in a batch
+MAX_DELETE_BATCH = 256
+
+# Deletes blobs in batches, up to concurrency batches at a time. Blobs that don't exist anymore are ignored, returns the
+# number of blobs deleted.
+def delete_blobs(blob_container, blob_names, concurrency: int = 4, verbose: bool = True) -> int:
+    blob_names = list(blob_names)
+    batches = [blob_names[i:i + MAX_DELETE_BATCH] for i in range(0, len(blob_names), MAX_DELETE_BATCH)]
+
+    def delete_batch(batch):
+        deleted = 0
+        for name, response in zip(batch, blob_container.delete_blobs(*batch, raise_on_any_failure=False)):
+            if response.status_code < 300:
+                deleted += 1
+            elif response.status_code != 404:
+                print(f"\tFailed to remove blob {name}: {response.status_code} {response.reason}")
+        if verbose: print(f"\tRemoved {deleted} blobs")
+        return deleted
+
+    if len(batches) <= 1 or concurrency <= 1:
+        return sum(delete_batch(batch) for batch in batches)
+    with ThreadPoolExecutor(min(concurrency, len(batches))) as executor:
+        return sum(executor.map(delete_batch, batches))
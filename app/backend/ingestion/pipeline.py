@@ -0,0 +1,149 @@
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, NamedTuple, Optional
+
+# What the parse stage produces for a file: the sections to index and the page blobs to upload (blob name -> content)
+class ParsedFile(NamedTuple):
+    sections: list
+    pages: dict[str, bytes]
+
+# Runs the ingestion stages for many files at once. Parsing (PDF text extraction, splitting into sections and into
+# page PDFs) is CPU bound and runs on a pool of worker processes, uploading page blobs, embedding and indexing
+# sections wait on the network and run on a thread pool. At most max_pending files are in flight, so memory stays
+# bounded on large corpora.
+#
+# parse(filename) must return a ParsedFile, and when running on worker processes it has to be a module level function
+# (or static method) so it can be pickled. Each file is only parsed once, upload(filename, pages), embed(filename,
+# sections) and index(filename, sections) run in threads of this process once it's parsed. The sections produced for
+# each file are the same as when processing files one at a time. done(filename) is called once all the stages for a
+# file succeeded. on_stage(filename, stage, seconds, items) is called as each stage ("parse", "upload", "embed" or
+# "index") of a file completes, with the time it took and the number of sections or pages it handled.
+class IngestionPipeline:
+    def __init__(self, parse: Callable[[str], ParsedFile], index: Callable[[str, list], None], upload: Optional[Callable[[str, dict], None]] = None,
+                 workers: int = 1, concurrency: int = 1, max_pending: Optional[int] = None, use_processes: bool = True,
+                 done: Optional[Callable[[str], None]] = None, on_stage: Optional[Callable[[str, str, float, int], None]] = None,
+                 embed: Optional[Callable[[str, list], None]] = None):
+        self.parse = parse
+        self.index = index
+        self.upload = upload
+        self.embed = embed
+        self.done = done
+        self.on_stage = on_stage
+        self.workers = max(1, workers)
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max_pending or 2 * max(self.workers, self.concurrency)
+        self.use_processes = use_processes
+
+    def run(self, filenames: Iterable[str]):
+        if self.workers == 1 and self.concurrency == 1:
+            for filename in filenames:
+                self.process_file(filename)
+            return
+
+        parse_pool: Executor = ProcessPoolExecutor(self.workers) if self.use_processes and self.workers > 1 else ThreadPoolExecutor(self.workers)
+        io_pool = ThreadPoolExecutor(self.concurrency)
+        pending = threading.BoundedSemaphore(self.max_pending)
+        errors: list[BaseException] = []
+        lock = threading.Lock()
+
+        def file_done(filename: str, remaining: list, future: Future, stage: str, items: int = 0):
+            error = future.exception()
+            if error is None and self.on_stage:
+                # Reported before the stage counts as done, so the file's stages are all reported when done() runs
+                try:
+                    self.on_stage(filename, stage, future.result()[1], items)
+                except BaseException as e:
+                    error = e
+            with lock:
+                if error is not None:
+                    errors.append(error)
+                    remaining[1] = True
+                remaining[0] -= 1
+                completed = remaining[0] == 0
+            if completed:
+                try:
+                    if self.done and not remaining[1]:
+                        self.done(filename)
+                except BaseException as e:
+                    errors.append(e)
+                finally:
+                    pending.release()
+
+        # The stage is counted before it's submitted, the file's parse stage isn't counted as done yet so the file can't
+        # complete meanwhile. A stage that can't be submitted (e.g. the pool is shut down) is a failure of the file.
+        def submit(filename: str, remaining: list, stage: str, f: Callable, items):
+            with lock:
+                remaining[0] += 1
+            try:
+                io_pool.submit(timed, f, filename, items).add_done_callback(
+                    lambda future: file_done(filename, remaining, future, stage, len(items)))
+            except BaseException as e:
+                with lock:
+                    errors.append(e)
+                    remaining[1] = True
+                    remaining[0] -= 1
+
+        def parsed(filename: str, remaining: list, future: Future):
+            parsed_file = None
+            try:
+                if future.exception() is None:
+                    parsed_file = future.result()[0]
+                    if self.upload:
+                        submit(filename, remaining, "upload", self.upload, parsed_file.pages)
+                    if self.embed:
+                        submit(filename, remaining, "embed", self.embed, parsed_file.sections)
+                    submit(filename, remaining, "index", self.index, parsed_file.sections)
+            finally:
+                # Always reached so the file completes and its place is released, whatever happened above
+                file_done(filename, remaining, future, "parse", len(parsed_file.sections) if parsed_file else 0)
+
+        try:
+            for filename in filenames:
+                pending.acquire()
+                if errors:
+                    pending.release()
+                    break
+                # Number of stages still running for this file, and whether any of them failed. Uploading, embedding
+                # and indexing are added once the file is parsed.
+                remaining = [1, False]
+                try:
+                    parse_pool.submit(timed, self.parse, filename).add_done_callback(lambda f, n=filename, r=remaining: parsed(n, r, f))
+                except BaseException:
+                    remaining[0] = -1
+                    pending.release()
+                    raise
+        finally:
+            # Wait for all files in flight before shutting down the pools, index tasks are submitted from parse callbacks
+            for _ in range(self.max_pending):
+                pending.acquire()
+            parse_pool.shutdown()
+            io_pool.shutdown()
+
+        if errors:
+            raise errors[0]
+
+    def process_file(self, filename: str):
+        parsed_file, seconds = timed(self.parse, filename)
+        if self.on_stage:
+            self.on_stage(filename, "parse", seconds, len(parsed_file.sections))
+        if self.upload:
+            _, seconds = timed(self.upload, filename, parsed_file.pages)
+            if self.on_stage:
+                self.on_stage(filename, "upload", seconds, len(parsed_file.pages))
+        if self.embed:
+            _, seconds = timed(self.embed, filename, parsed_file.sections)
+            if self.on_stage:
+                self.on_stage(filename, "embed", seconds, len(parsed_file.sections))
+        _, seconds = timed(self.index, filename, parsed_file.sections)
+        if self.on_stage:
+            self.on_stage(filename, "index", seconds, len(parsed_file.sections))
+        if self.done:
+            self.done(filename)
+
+# Runs a stage and returns its result with the time it took, it's a module level function so it can wrap the parse
+# stage on worker processes
+def timed(f: Callable, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
@@ -0,0 +1,78 @@
+import bisect
+import re
+
+MAX_SECTION_LENGTH = 1000
+SENTENCE_SEARCH_LIMIT = 100
+SECTION_OVERLAP = 100
+
+SENTENCE_ENDINGS = frozenset([".", "!", "?"])
+WORDS_BREAKS = frozenset([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"])
+SENTENCE_ENDINGS_RE = re.compile("[" + re.escape("".join(sorted(SENTENCE_ENDINGS))) + "]")
+WORDS_BREAKS_RE = re.compile("[" + re.escape("".join(sorted(WORDS_BREAKS))) + "]")
+
+# Splits the text of a document into overlapping sections of about MAX_SECTION_LENGTH characters, trying to end
+# sections at the end of a sentence (or at least of a word) and not to cut tables in half. page_map is a list of
+# (page number, offset of the page in the document text, page text) tuples, and each section is returned with the
+# index of the page it starts on.
+#
+# Boundaries are searched with regular expressions and str.rfind instead of character by character, and pages are
+# looked up with a binary search over the page offsets, the sections are the same as the original scan.
+def split_text(page_map, verbose=False):
+    offsets = [p[1] for p in page_map]
+
+    def find_page(offset):
+        i = bisect.bisect_right(offsets, offset) - 1
+        return i if i >= 0 else len(page_map) - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence, or fall back to at least keeping a whole word
+            limit = min(length, start + MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT)
+            sentence_end = SENTENCE_ENDINGS_RE.search(all_text, end, limit)
+            if sentence_end:
+                end = sentence_end.start()
+            else:
+                last_word = max(all_text.rfind(c, end, limit) for c in WORDS_BREAKS)
+                end = limit
+                if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                    end = last_word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        bound = max(0, end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT)
+        if start > bound:
+            sentence_start = max(all_text.rfind(c, bound + 1, start + 1) for c in SENTENCE_ENDINGS)
+            if sentence_start >= 0:
+                start = sentence_start
+            else:
+                first_word = WORDS_BREAKS_RE.search(all_text, bound + 1, start + 1)
+                start = bound
+                if all_text[start] not in SENTENCE_ENDINGS and first_word:
+                    start = first_word.start()
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            # If the section ends with an unclosed table, we need to start the next section with the table.
+            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
+            # If last table starts inside SECTION_OVERLAP, keep overlapping
+            if verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
@@ -1,6 +1,67 @@
-from typing import Any, Dict, List, Optional, Union
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+import concurrent.futures
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from uuid import UUID
+import openai
+from langchain import llms
+from langchain.agents import AgentExecutor
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
+from tracing import Span
+
+# Langchain's AzureOpenAI sets openai.api_key to the key it's created with and then relies on the global. This one
+# sends the current openai.api_key with every call instead, so instances keep working after the Azure AD token they
+# were created with is renewed. Creating one and replacing the key (set_openai_key) hold a lock, so an older token
+# can't be put back in the global; reading the key on each call doesn't need it.
+openai_key_lock = threading.Lock()
+
+def set_openai_key(key: str):
+    with openai_key_lock:
+        openai.api_key = key
+
+class AzureOpenAI(llms.AzureOpenAI):
+    def __init__(self, **kwargs: Any):
+        with openai_key_lock:
+            super().__init__(openai_api_key=openai.api_key, **kwargs)
+        self.client = DeadlineCompletion
+
+    @property
+    def _invocation_params(self) -> Dict[str, Any]:
+        return {**super()._invocation_params, "api_key": openai.api_key}
+
+# Raised by the completions and tools of an agent run once its deadline has passed, or when a failed completion can't
+# be retried before it
+class DeadlineExceeded(Exception):
+    pass
+
+# Langchain waits at least this many seconds before retrying a failed completion
+RETRY_MIN_WAIT = 4
+
+# openai.Completion for the agents' LLMs: each attempt (Langchain retries failed ones) gets what's left until the
+# deadline of the current run as its timeout, and the duration of the completions is kept to tell whether another one
+# still fits before the deadline
+class DeadlineCompletion:
+    @staticmethod
+    def create(**kwargs: Any) -> Any:
+        run = current_agent_run.get()
+        if run is None:
+            return openai.Completion.create(**kwargs)
+        if run.deadline is not None:
+            kwargs["request_timeout"] = run.check_deadline()
+        start = time.monotonic()
+        try:
+            response = openai.Completion.create(**kwargs)
+        except openai.error.OpenAIError as e:
+            if run.remaining() < RETRY_MIN_WAIT:
+                raise DeadlineExceeded(f"Completion failed too close to the deadline to be retried: {e}") from e
+            raise
+        run.llm_seconds.append(time.monotonic() - start)
+        return response
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
@@ -86,3 +147,167 @@ class HtmlCallbackHandler (BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+# State of one run of an agent approach: the overrides of the request, the data points its tools found and the log of
+# its thought process. Agents are built once and shared by concurrent requests, so their tools and callbacks find the
+# run they work for in current_agent_run instead of keeping it on the approach. The "max_steps" override bounds how
+# many times the agent goes back to the LLM, the run has to be done max_seconds after it starts (the "max_seconds"
+# override or the server's, whichever is lower).
+class AgentRun:
+    def __init__(self, overrides: dict[str, Any], max_seconds: Optional[float] = None):
+        self.overrides = overrides
+        self.results: list[str] = []
+        self.html = ""
+        self.max_steps: Optional[int] = overrides.get("max_steps") or None
+        limits = [float(seconds) for seconds in (overrides.get("max_seconds"), max_seconds) if seconds]
+        self.deadline: Optional[float] = time.monotonic() + min(limits) if limits else None
+        # Set when a completion or tool hit the deadline, nothing more is tried after that
+        self.expired = False
+        # Durations of the steps and completions so far
+        self.step_seconds: list[float] = []
+        self.llm_seconds: list[float] = []
+        # Steps taken so far, a step is one completion and the tool calls it asked for, and the step results are from
+        self.step = 0
+        self.results_step = 0
+        # Tool calls started ahead of the agent waiting for them, by tool name and input
+        self.pending: Dict[Tuple[str, str], Future] = {}
+        # Log of the last action written to html, the actions of a step share it
+        self.last_log: Optional[str] = None
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic() if self.deadline is not None else float("inf")
+
+    # The seconds left until the deadline, raises DeadlineExceeded when there are none
+    def check_deadline(self) -> float:
+        remaining = self.remaining()
+        if remaining <= 0:
+            self.expired = True
+            raise DeadlineExceeded("The agent ran out of time")
+        return remaining
+
+    # Whether something taking as long as it did on average so far (steps, completions) fits before the deadline
+    def fits(self, durations: list[float]) -> bool:
+        return not self.expired and self.remaining() > (sum(durations) / len(durations) if durations else 0)
+
+    # The result of a tool call started ahead of time, waiting for it until the deadline at the most
+    def wait(self, future: Future) -> Any:
+        try:
+            return future.result(timeout=self.check_deadline() if self.deadline is not None else None)
+        except concurrent.futures.TimeoutError:
+            self.expired = True
+            raise DeadlineExceeded("The agent ran out of time") from None
+
+current_agent_run: contextvars.ContextVar[Optional[AgentRun]] = contextvars.ContextVar("current_agent_run", default=None)
+
+# Makes a new run current while an agent runs, the agent and its tools have to run on the thread it's entered on (or
+# one started with a copy of its context)
+@contextlib.contextmanager
+def agent_run(overrides: dict[str, Any], max_seconds: Optional[float] = None) -> Iterator[AgentRun]:
+    run = AgentRun(overrides, max_seconds)
+    token = current_agent_run.set(run)
+    try:
+        yield run
+    finally:
+        current_agent_run.reset(token)
+
+# HtmlCallbackHandler logging to the current run, so one instance can be part of agents shared by concurrent requests
+class AgentRunCallbackHandler(HtmlCallbackHandler):
+    @property
+    def html(self) -> str:
+        run = current_agent_run.get()
+        return run.html if run is not None else ""
+
+    @html.setter
+    def html(self, value: str):
+        run = current_agent_run.get()
+        if run is not None:
+            run.html = value
+
+    def on_agent_action(self, action: AgentAction, color: Optional[str] = None, **kwargs: Any) -> Any:
+        run = current_agent_run.get()
+        if run is not None and action.log is not run.last_log:
+            run.last_log = action.log
+            super().on_agent_action(action, color, **kwargs)
+
+# AgentExecutor stopping at the step budget of the current run rather than its own, and before the run's deadline when
+# another step (taking as long as the previous ones did on average) wouldn't be done before it. A step cut short by the
+# deadline is dropped. Once stopped the agent answers with what it found so far (see PartialAnswerMixin).
+class BudgetedAgentExecutor(AgentExecutor):
+    def _should_continue(self, iterations: int, time_elapsed: float) -> bool:
+        run = current_agent_run.get()
+        if run is None:
+            return super()._should_continue(iterations, time_elapsed)
+        if iterations >= (run.max_steps or self.max_iterations or float("inf")):
+            return False
+        if self.max_execution_time is not None and time_elapsed >= self.max_execution_time:
+            return False
+        return run.fits(run.step_seconds)
+
+    def _take_next_step(self, *args: Any, **kwargs: Any) -> Any:
+        run = current_agent_run.get()
+        if run is None:
+            return super()._take_next_step(*args, **kwargs)
+        run.step += 1
+        start = time.monotonic()
+        try:
+            return super()._take_next_step(*args, **kwargs)
+        except DeadlineExceeded:
+            run.expired = True
+            return []
+        finally:
+            run.step_seconds.append(time.monotonic() - start)
+
+PARTIAL_ANSWER = "I couldn't finish looking for the answer in time, the supporting content has what I found so far."
+
+# For agents stopped before they finished (step budget used up, or deadline close): they answer from the steps taken
+# so far with one more completion if it fits before the deadline, with PARTIAL_ANSWER otherwise
+class PartialAnswerMixin:
+    def return_stopped_response(self, early_stopping_method: str, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any) -> AgentFinish:
+        run = current_agent_run.get()
+        if run is None:
+            return super().return_stopped_response(early_stopping_method, intermediate_steps, **kwargs)
+        if intermediate_steps and run.fits(run.llm_seconds):
+            thoughts = self._construct_scratchpad(intermediate_steps) + "\n\nI now need to return a final answer based on the previous steps:"
+            try:
+                output = self.output_parser.parse(self.llm_chain.predict(**kwargs, agent_scratchpad=thoughts, stop=self._stop))
+                if isinstance(output, AgentFinish):
+                    return output
+            except Exception:
+                logging.exception("Failed to answer from the steps taken so far")
+        return AgentFinish({"output": PARTIAL_ANSWER}, "")
+
+# Times the completions and tool runs of an agent as spans ("agent.llm", "tool.<name>") of the current request, and
+# counts the agent's iterations. It has to be created on the thread running the agent, within the request.
+class TracingCallbackHandler(BaseCallbackHandler):
+    def __init__(self):
+        self.steps = 0
+        self.spans: Dict[UUID, Span] = {}
+        self._last_log: Optional[str] = None
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self.spans[run_id] = Span("agent.llm", {"step": self.steps + 1})
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id in self.spans:
+            self.spans.pop(run_id).end()
+
+    def on_llm_error(self, error: Exception, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id in self.spans:
+            self.spans.pop(run_id).end(error)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.spans[run_id] = Span(f"tool.{serialized.get('name', 'unknown')}", {"step": self.steps})
+
+    def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id in self.spans:
+            self.spans.pop(run_id).end()
+
+    def on_tool_error(self, error: Exception, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id in self.spans:
+            self.spans.pop(run_id).end(error)
+
+    # Actions asked for in the same completion share its log and count as one step
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        if action.log is not self._last_log:
+            self._last_log = action.log
+            self.steps += 1
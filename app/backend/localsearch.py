@@ -0,0 +1,429 @@
+import asyncio
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import sys
+import threading
+from array import array
+from collections import Counter, namedtuple
+from typing import Any, Callable, Iterable, Optional
+
+# In-process BM25 search over the sections produced by create_sections, for small corpora and for running the app and
+# its benchmarks without Azure Cognitive Search. It implements the part of SearchClient.search the approaches use:
+# top, filter (eq/ne comparisons combined with and/or/not, e.g. "category ne 'x'"), select, include_total_count and
+# a stand-in for semantic captions (the sentences of the section that match the query best). Other search options are
+# accepted and ignored.
+#
+# The index is a directory written by LocalSearchIndexBuilder.save:
+#   meta.json          format version, document count, average length and the names of the filterable fields
+#   terms.bin          the terms as UTF-8, in sorted order, with their uint64 offsets in term_offsets.bin
+#   term_postings.bin  uint64 position of each term's postings, a term with df documents has 2 * df entries
+#   postings.bin       uint32 document ids of each term followed by the term frequency in each of those documents
+#   norms.bin          float32 BM25 length normalization of each document, k1 * (1 - b + b * length / average length)
+#   fields.bin         uint32 value of each filterable field of each document, one column of documents per field
+#   values.bin         the distinct filterable field values as UTF-8 JSON, with their uint64 offsets in value_offsets.bin
+#   docs.bin           the documents as UTF-8 JSON, one after another, with their uint64 offsets in offsets.bin
+# Everything but meta.json is memory-mapped when the index is loaded, so startup doesn't depend on the corpus size and
+# several worker processes share the same pages. Terms are found by binary search.
+
+FORMAT_VERSION = 2
+FILTERABLE_FIELDS = ("id", "category", "sourcepage", "sourcefile")
+K1 = 1.2
+B = 0.75
+
+TAG_RE = re.compile(r"<[^>]+>")
+TOKEN_RE = re.compile(r"\w+")
+SENTENCE_RE = re.compile(r"[^.!?\n]+[.!?]*")
+
+# Table HTML is indexed by its text only
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(TAG_RE.sub(" ", text or "").lower())
+
+Caption = namedtuple("Caption", ["text", "highlights"])
+IndexingResult = namedtuple("IndexingResult", ["key", "succeeded", "status_code", "error_message"])
+
+class LocalSearchIndex:
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION or meta.get("byteorder") != sys.byteorder:
+            raise ValueError(f"Unsupported local search index in {path}, rebuild it with prepdocs.py --localindex")
+        self.path = path
+        self.doc_count: int = meta["doc_count"]
+        self.columns: dict[str, int] = {name: i for i, name in enumerate(meta["filterable"])}
+        self._maps = []
+        self._views = []
+        self.terms = self._map("terms.bin", "B")
+        self.term_offsets = self._map("term_offsets.bin", "Q")
+        self.term_postings = self._map("term_postings.bin", "Q")
+        self.postings = self._map("postings.bin", "I")
+        self.norms = self._map("norms.bin", "f")
+        self.fields = self._map("fields.bin", "I")
+        self.values = self._map("values.bin", "B")
+        self.value_offsets = self._map("value_offsets.bin", "Q")
+        self.offsets = self._map("offsets.bin", "Q")
+        self.docs = self._map("docs.bin", "B")
+
+    @staticmethod
+    def load(path: str) -> "LocalSearchIndex":
+        return LocalSearchIndex(path)
+
+    def _map(self, name: str, typecode: str):
+        with open(os.path.join(self.path, name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(array(typecode))
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(m)
+        view = memoryview(m).cast(typecode)
+        self._views.append(view)
+        return view
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        for m in self._maps:
+            m.close()
+        self._views = []
+        self._maps = []
+
+    def document(self, doc_id: int) -> dict[str, Any]:
+        return json.loads(bytes(self.docs[self.offsets[doc_id]:self.offsets[doc_id + 1]]).decode("utf-8"))
+
+    def value(self, value_id: int) -> Any:
+        return json.loads(bytes(self.values[self.value_offsets[value_id]:self.value_offsets[value_id + 1]]).decode("utf-8"))
+
+    def column(self, name: str):
+        i = self.columns.get(name)
+        return self.fields[i * self.doc_count:(i + 1) * self.doc_count] if i is not None else None
+
+    def field(self, doc_id: int, name: str) -> Any:
+        column = self.column(name)
+        return self.value(column[doc_id]) if column is not None else self.document(doc_id).get(name)
+
+    # Field getter for filters evaluated on many documents, values are decoded once
+    def fields_reader(self) -> Callable[[int, str], Any]:
+        columns = {name: self.column(name) for name in self.columns}
+        values: dict[int, Any] = {}
+        def get(doc_id: int, name: str) -> Any:
+            column = columns.get(name)
+            if column is None:
+                return self.document(doc_id).get(name)
+            value_id = column[doc_id]
+            if value_id not in values:
+                values[value_id] = self.value(value_id)
+            return values[value_id]
+        return get
+
+    # Position and document frequency of a term's postings, or None if no document has it
+    def lookup(self, term: str) -> Optional[tuple[int, int]]:
+        key = term.encode("utf-8")
+        offsets = self.term_offsets
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.terms[offsets[middle]:offsets[middle + 1]]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(offsets) - 1 or bytes(self.terms[offsets[low]:offsets[low + 1]]) != key:
+            return None
+        start = self.term_postings[low]
+        return start, (self.term_postings[low + 1] - start) // 2
+
+    # BM25 scores of the documents containing any of the query terms
+    def score(self, terms: list[str]) -> dict[int, float]:
+        scores: dict[int, float] = {}
+        norms = self.norms
+        for term, query_tf in Counter(terms).items():
+            entry = self.lookup(term)
+            if entry is None:
+                continue
+            start, df = entry
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            weight = query_tf * idf * (K1 + 1)
+            doc_ids = self.postings[start:start + df]
+            tfs = self.postings[start + df:start + 2 * df]
+            for doc_id, tf in zip(doc_ids, tfs):
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (tf + norms[doc_id])
+        return scores
+
+    # Returns the total number of matches and the top (doc_id, score) pairs. An empty query (or "*") matches every
+    # document, in index order.
+    def query(self, search_text: Optional[str], top: int, filter: Optional[str] = None) -> tuple[int, list[tuple[int, float]]]:
+        predicate = parse_filter(filter) if filter else None
+        get = self.fields_reader()
+        accept = (lambda doc_id: predicate(lambda name: get(doc_id, name))) if predicate else (lambda doc_id: True)
+        terms = tokenize(search_text) if search_text and search_text.strip() != "*" else []
+        if not terms:
+            matches = [doc_id for doc_id in range(self.doc_count) if accept(doc_id)]
+            return len(matches), [(doc_id, 1.0) for doc_id in matches[:top]]
+        scored = [(doc_id, score) for doc_id, score in self.score(terms).items() if accept(doc_id)]
+        return len(scored), heapq.nlargest(top, scored, key=lambda r: (r[1], -r[0]))
+
+# Collects documents (sections) and writes the index files. It has the upload_documents and delete_documents methods
+# of SearchClient so it can be used wherever sections are indexed, and it can start from an existing index to update it.
+class LocalSearchIndexBuilder:
+    def __init__(self, path: Optional[str] = None):
+        self.documents: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(os.path.join(path, "meta.json")):
+            index = LocalSearchIndex.load(path)
+            try:
+                for doc_id in range(index.doc_count):
+                    doc = index.document(doc_id)
+                    self.documents[doc["id"]] = doc
+            finally:
+                index.close()
+
+    def upload_documents(self, documents: Iterable[dict[str, Any]]) -> list[IndexingResult]:
+        results = []
+        with self._lock:
+            for doc in documents:
+                self.documents[doc["id"]] = dict(doc)
+                results.append(IndexingResult(doc["id"], True, 201, None))
+        return results
+
+    def delete_documents(self, documents: Iterable[dict[str, Any]]) -> list[IndexingResult]:
+        results = []
+        with self._lock:
+            for doc in documents:
+                self.documents.pop(doc["id"], None)
+                results.append(IndexingResult(doc["id"], True, 200, None))
+        return results
+
+    # Lists the documents matching a filter, like the search the removal of documents relies on, all of them unless top
+    # is set. There is no full text search until the index is saved.
+    def search(self, search_text: Optional[str] = None, *, top: Optional[int] = None, filter: Optional[str] = None,
+               select: Optional[list[str]] = None, **kwargs) -> "LocalSearchResults":
+        if search_text and search_text.strip() != "*":
+            raise ValueError("Only an empty query is supported before the local search index is saved")
+        predicate = parse_filter(filter) if filter else (lambda get: True)
+        with self._lock:
+            matches = [doc for doc in self.documents.values() if predicate(doc.get)]
+        documents = matches if top is None else matches[:top]
+        if select:
+            documents = [{name: doc.get(name) for name in select} for doc in documents]
+        return LocalSearchResults([dict(doc) for doc in documents], len(matches))
+
+    def save(self, path: str):
+        with self._lock:
+            documents = sorted(self.documents.values(), key=lambda d: d["id"])
+        postings: dict[str, list[tuple[int, int]]] = {}
+        lengths = array("I")
+        offsets = array("Q", [0])
+        docs = bytearray()
+        for doc_id, doc in enumerate(documents):
+            terms = tokenize(doc.get("content", ""))
+            lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, []).append((doc_id, tf))
+            docs += json.dumps(doc, ensure_ascii=False).encode("utf-8")
+            offsets.append(len(docs))
+
+        avg_length = sum(lengths) / len(lengths) if lengths else 0.0
+        norms = array("f", (K1 * (1 - B + B * length / avg_length) if avg_length else K1 for length in lengths))
+        # Strings sort by code point, which is also the order of their UTF-8 bytes the lookups compare
+        terms = bytearray()
+        term_offsets = array("Q", [0])
+        term_postings = array("Q", [0])
+        postings_data = array("I")
+        for term in sorted(postings):
+            entries = postings[term]
+            terms += term.encode("utf-8")
+            term_offsets.append(len(terms))
+            postings_data.extend(doc_id for doc_id, _ in entries)
+            postings_data.extend(tf for _, tf in entries)
+            term_postings.append(len(postings_data))
+
+        value_ids: dict[str, int] = {}
+        values = bytearray()
+        value_offsets = array("Q", [0])
+        fields = array("I")
+        for name in FILTERABLE_FIELDS:
+            for doc in documents:
+                value = json.dumps(doc.get(name), ensure_ascii=False)
+                if value not in value_ids:
+                    value_ids[value] = len(value_ids)
+                    values += value.encode("utf-8")
+                    value_offsets.append(len(values))
+                fields.append(value_ids[value])
+
+        meta = {
+            "version": FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "doc_count": len(documents),
+            "avg_length": avg_length,
+            "filterable": list(FILTERABLE_FIELDS),
+        }
+        # Each file is replaced atomically and meta.json last, processes that already mapped the old files keep them
+        os.makedirs(path, exist_ok=True)
+        for name, data in (("terms.bin", bytes(terms)), ("term_offsets.bin", term_offsets.tobytes()),
+                           ("term_postings.bin", term_postings.tobytes()), ("postings.bin", postings_data.tobytes()),
+                           ("norms.bin", norms.tobytes()), ("fields.bin", fields.tobytes()), ("values.bin", bytes(values)),
+                           ("value_offsets.bin", value_offsets.tobytes()), ("offsets.bin", offsets.tobytes()),
+                           ("docs.bin", bytes(docs)), ("meta.json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))):
+            temp_path = os.path.join(path, name + ".tmp")
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, os.path.join(path, name))
+
+# Results of a search, iterable like the SDK's SearchItemPaged
+class LocalSearchResults:
+    def __init__(self, documents: list[dict[str, Any]], count: int):
+        self.documents = documents
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def get_count(self) -> int:
+        return self.count
+
+    def get_answers(self):
+        return None
+
+class AsyncLocalSearchResults(LocalSearchResults):
+    async def __aiter__(self):
+        for doc in self.documents:
+            yield doc
+
+    async def get_count(self) -> int:
+        return self.count
+
+    async def get_answers(self):
+        return None
+
+# Drop-in for the synchronous SearchClient on the retrieval path
+class LocalSearchClient:
+    def __init__(self, index: LocalSearchIndex):
+        self.index = index
+
+    def search(self, search_text: Optional[str] = None, *, top: Optional[int] = None, filter: Optional[str] = None,
+               select: Optional[list[str]] = None, query_caption: Optional[str] = None, include_total_count: bool = False,
+               **kwargs) -> LocalSearchResults:
+        count, hits = self.index.query(search_text, 50 if top is None else top, filter)
+        terms = set(tokenize(search_text)) if query_caption else None
+        documents = []
+        for doc_id, score in hits:
+            doc = self.index.document(doc_id)
+            if select:
+                doc = {name: doc.get(name) for name in select}
+            doc["@search.score"] = score
+            if query_caption:
+                doc["@search.captions"] = [caption(self.index.document(doc_id).get("content", ""), terms)]
+            documents.append(doc)
+        return LocalSearchResults(documents, count)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Drop-in for the async SearchClient. Scoring, filtering and decoding the documents take a while on large indexes,
+# so searches run on a worker thread rather than holding up the event loop.
+class AsyncLocalSearchClient:
+    def __init__(self, index: LocalSearchIndex):
+        self.client = LocalSearchClient(index)
+
+    async def search(self, search_text: Optional[str] = None, **kwargs) -> AsyncLocalSearchResults:
+        r = await asyncio.to_thread(self.client.search, search_text, **kwargs)
+        return AsyncLocalSearchResults(r.documents, r.count)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+# Stand-in for extractive captions: the sentence (with the next one) sharing the most terms with the query
+def caption(content: str, terms: set[str], max_length: int = 300) -> Caption:
+    text = " ".join(TAG_RE.sub(" ", content).split())
+    sentences = [s.strip() for s in SENTENCE_RE.findall(text) if s.strip()]
+    if not sentences:
+        return Caption(text[:max_length], None)
+    best = max(range(len(sentences)), key=lambda i: (len(terms.intersection(tokenize(sentences[i]))), -i))
+    return Caption(" ".join(sentences[best:best + 2])[:max_length], None)
+
+FILTER_TOKEN_RE = re.compile(r"\s*(?:(\()|(\))|'((?:[^']|'')*)'|([A-Za-z_][A-Za-z0-9_/]*))")
+
+# Parses the OData filter subset used by the approaches and prepdocs into a predicate taking a field getter
+def parse_filter(filter: str) -> Callable[[Callable[[str], Any]], bool]:
+    tokens = []
+    position = 0
+    while position < len(filter):
+        if filter[position:].strip() == "":
+            break
+        m = FILTER_TOKEN_RE.match(filter, position)
+        if not m:
+            raise ValueError(f"Unsupported filter: {filter}")
+        position = m.end()
+        if m.group(1):
+            tokens.append(("(", None))
+        elif m.group(2):
+            tokens.append((")", None))
+        elif m.group(3) is not None:
+            tokens.append(("string", m.group(3).replace("''", "'")))
+        else:
+            tokens.append(("word", m.group(4)))
+
+    def peek(*words):
+        return bool(tokens) and tokens[0][0] == "word" and tokens[0][1].lower() in words
+
+    def expect(kind):
+        if not tokens or tokens[0][0] != kind:
+            raise ValueError(f"Unsupported filter: {filter}")
+        return tokens.pop(0)[1]
+
+    def parse_or():
+        left = parse_and()
+        while peek("or"):
+            tokens.pop(0)
+            right = parse_and()
+            left = (lambda l, r: lambda get: l(get) or r(get))(left, right)
+        return left
+
+    def parse_and():
+        left = parse_not()
+        while peek("and"):
+            tokens.pop(0)
+            right = parse_not()
+            left = (lambda l, r: lambda get: l(get) and r(get))(left, right)
+        return left
+
+    def parse_not():
+        if peek("not"):
+            tokens.pop(0)
+            operand = parse_not()
+            return lambda get: not operand(get)
+        if tokens and tokens[0][0] == "(":
+            tokens.pop(0)
+            inner = parse_or()
+            expect(")")
+            return inner
+        field = expect("word")
+        operator = expect("word").lower()
+        if tokens and tokens[0] == ("word", "null"):
+            tokens.pop(0)
+            value = None
+        else:
+            value = expect("string")
+        if operator == "eq":
+            return lambda get: get(field) == value
+        if operator == "ne":
+            return lambda get: get(field) != value
+        raise ValueError(f"Unsupported filter operator '{operator}' in: {filter}")
+
+    predicate = parse_or()
+    if tokens:
+        raise ValueError(f"Unsupported filter: {filter}")
+    return predicate
@@ -1,20 +1,123 @@
+import bisect
+import codecs
 import csv
+import logging
+import os
+import threading
+import time
+from array import array
 from pathlib import Path
 from langchain.agents import Tool
 from langchain.callbacks.manager import Callbacks
-from typing import Optional, Union
+from typing import Any, NamedTuple, Optional, Union
+
+# Contents of a CSV file indexed by one of its fields: the raw file, the keys (case folded) in sorted order and where
+# each key's row is in the file. Rows are parsed when they're looked up.
+class CsvIndex(NamedTuple):
+    mtime: int
+    size: int
+    data: bytes
+    fields: list[str]
+    keys: list[str]
+    starts: array
+    ends: array
+
+# Lookup store shared by every tool using the same CSV file and key field, see CsvLookupStore.get. It's loaded once
+# and reloaded when the file changes, which is checked at most every check_interval seconds, so lookups don't do any
+# I/O in between. The file is read in memory rather than mapped, it can be rewritten in place while it's in use.
+class CsvLookupStore:
+    _stores: dict[tuple[str, str], "CsvLookupStore"] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, filename: Union[str, Path], key_field: str, check_interval: float = 5):
+        self.filename = str(filename)
+        self.key_field = key_field
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked_at = time.monotonic()
+        self.index = self.load()
+
+    @classmethod
+    def get(cls, filename: Union[str, Path], key_field: str) -> "CsvLookupStore":
+        key = (os.path.abspath(filename), key_field)
+        with cls._stores_lock:
+            store = cls._stores.get(key)
+            if store is None:
+                store = cls._stores[key] = CsvLookupStore(filename, key_field)
+            return store
+
+    def load(self) -> CsvIndex:
+        with open(self.filename, "rb") as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+        # The csv module gets the file line by line, so the end of the last line it got is the end of the row it returns
+        # (rows can span several lines when quoted values have line breaks)
+        line_end = len(codecs.BOM_UTF8) if data.startswith(codecs.BOM_UTF8) else 0
+        def lines():
+            nonlocal line_end
+            while line_end < len(data):
+                start, end = line_end, data.find(b"\n", line_end)
+                line_end = len(data) if end < 0 else end + 1
+                yield data[start:line_end].decode("utf-8", errors="replace")
+        reader = csv.reader(lines())
+        fields = next(reader, [])
+        if self.key_field not in fields:
+            raise ValueError(f"{self.filename} has no {self.key_field} field")
+        key_index = fields.index(self.key_field)
+        rows = []
+        start = line_end
+        for row in reader:
+            if len(row) > key_index:
+                rows.append((row[key_index].strip().casefold(), start, line_end))
+            start = line_end
+        # Rows with the same key stay in file order
+        rows.sort(key=lambda row: row[0])
+        return CsvIndex(stat.st_mtime_ns, stat.st_size, data, fields, [row[0] for row in rows],
+                        array("q", (row[1] for row in rows)), array("q", (row[2] for row in rows)))
+
+    # Reloads the file if it changed since it was loaded, unless it was checked less than check_interval seconds ago or
+    # another thread is on it. Lookups keep using the current index until the new one is loaded.
+    def refresh(self):
+        if time.monotonic() - self._checked_at < self.check_interval or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            stat = os.stat(self.filename)
+            if (stat.st_mtime_ns, stat.st_size) != (self.index.mtime, self.index.size):
+                self.index = self.load()
+        except (OSError, ValueError):
+            logging.exception("Failed to reload %s, still using the version loaded before", self.filename)
+        finally:
+            self._lock.release()
+
+    # The rows whose key is key, ignoring case, or if there are none the first max_matches rows whose key starts with
+    # it, formatted as one "field:value" line per field
+    def lookup(self, key: str, max_matches: int = 5) -> list[str]:
+        self.refresh()
+        index = self.index
+        key = key.strip().casefold()
+        if not key:
+            return []
+        first = bisect.bisect_left(index.keys, key)
+        last = bisect.bisect_right(index.keys, key)
+        if first == last:
+            last = min(bisect.bisect_right(index.keys, key + "\U0010ffff"), first + max_matches)
+        return [self.format(index, i) for i in range(first, last)]
+
+    @staticmethod
+    def format(index: CsvIndex, i: int) -> str:
+        values = next(csv.reader([index.data[index.starts[i]:index.ends[i]].decode("utf-8", errors="replace")]), [])
+        return "\n".join(f"{field}:{value}" for field, value in zip(index.fields, values))
 
 class CsvLookupTool(Tool):
-    data: dict[str, str] = {}
+    store: Any = None
+    max_matches: int = 5
 
-    def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup", 
+    def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup",
                  description: str = "useful to look up details given an input key as opposite to searching data with an unstructured question",
                  callbacks: Callbacks = None):
         super().__init__(name, self.lookup, description, callbacks=callbacks)
-        with open(filename, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.data[row[key_field]] =  "\n".join([f"{i}:{row[i]}" for i in row])
+        self.store = CsvLookupStore.get(filename, key_field)
 
     def lookup(self, key: str) -> Optional[str]:
-        return self.data.get(key, "")
+        return "\n\n".join(self.store.lookup(key, self.max_matches))
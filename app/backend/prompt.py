@@ -0,0 +1,74 @@
+import functools
+from typing import Optional, Sequence
+
+import tiktoken
+
+# Context window (prompt and completion together, in tokens) and tokenizer of the models the deployments can use
+MODELS = {
+    "gpt-35-turbo": (4096, "cl100k_base"),
+    "gpt-4": (8192, "cl100k_base"),
+    "gpt-4-32k": (32768, "cl100k_base"),
+    "text-davinci-003": (4097, "p50k_base"),
+    "text-davinci-002": (4097, "p50k_base"),
+}
+
+# The same sources and chat turns come back request after request, so their token counts are memoized
+@functools.lru_cache(maxsize=16384)
+def count_tokens(encoding_name: str, text: str) -> int:
+    # Special tokens like <|im_start|> are counted as plain text, which slightly overestimates ChatML prompts
+    return len(tiktoken.get_encoding(encoding_name).encode(text, disallowed_special=()))
+
+# Splits the context window of a model between the instructions, the sources, the chat history and the completion.
+# The completion gets max_completion_tokens and the chat history up to max_history_tokens, dropping the oldest turns
+# first (the last turn is always kept). Sources get what's left, dropping the lowest ranked first. The completion
+# can use whatever the prompt leaves, up to max_completion_tokens.
+class PromptBudget:
+    def __init__(self, model: str = "gpt-35-turbo", context_window: Optional[int] = None, max_completion_tokens: int = 1024,
+                 max_history_tokens: int = 1000):
+        default_window, self.encoding_name = MODELS.get(model, MODELS["gpt-35-turbo"])
+        self.context_window = context_window or default_window
+        self.max_completion_tokens = max_completion_tokens
+        self.max_history_tokens = max_history_tokens
+
+    def count(self, text: str) -> int:
+        return count_tokens(self.encoding_name, text)
+
+    # Newest turns are kept first, returns the turns to keep in their original order
+    def fit_history(self, turns: Sequence[str], max_tokens: Optional[int] = None) -> list[str]:
+        budget = self.max_history_tokens if max_tokens is None else max_tokens
+        kept = []
+        used = 0
+        for turn in reversed(turns):
+            tokens = self.count(turn)
+            if kept and used + tokens > budget:
+                break
+            kept.append(turn)
+            used += tokens
+        kept.reverse()
+        return kept
+
+    # Sources are in rank order, returns the ones that fit in max_tokens. If not even the first one fits it's cut down.
+    def fit_sources(self, sources: Sequence[str], max_tokens: int, separator: str = "\n") -> list[str]:
+        kept = []
+        used = 0
+        separator_tokens = self.count(separator)
+        for source in sources:
+            tokens = self.count(source) + (separator_tokens if kept else 0)
+            if used + tokens > max_tokens:
+                if not kept and max_tokens > 0:
+                    kept.append(self.truncate(source, max_tokens))
+                break
+            kept.append(source)
+            used += tokens
+        return kept
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        encoding = tiktoken.get_encoding(self.encoding_name)
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    # Tokens the prompt can use besides the instructions, keeping room for the completion
+    def available(self, instructions: str) -> int:
+        return max(0, self.context_window - self.max_completion_tokens - self.count(instructions))
+
+    def completion_tokens(self, prompt: str) -> int:
+        return max(1, min(self.max_completion_tokens, self.context_window - self.count(prompt)))
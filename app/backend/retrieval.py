@@ -0,0 +1,66 @@
+from typing import Any, Hashable, Optional
+from azure.search.documents.models import QueryType
+from cache import TTLCache
+from tracing import span
+
+# Search options shared by all the approaches, derived from the overrides sent by the client
+def search_args(overrides: dict[str, Any]) -> dict[str, Any]:
+    use_semantic_captions = True if overrides.get("semantic_captions") else False
+    top = overrides.get("top") or 3
+    exclude_category = overrides.get("exclude_category") or None
+    filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+
+    if overrides.get("semantic_ranker"):
+        return dict(filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language="en-us",
+                    query_speller="lexicon",
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None)
+    return dict(filter=filter, top=top)
+
+# In-process cache of search results. Entries are keyed on the normalized query and every search option that
+# changes the results, and are dropped when they expire, when the cache is full (least recently used first), or
+# all at once when the index changes.
+class RetrievalCache(TTLCache):
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        super().__init__(maxsize, ttl)
+        self.index_version: Optional[Hashable] = None
+
+    @staticmethod
+    def key(q: str, args: dict[str, Any]) -> Hashable:
+        return (" ".join(q.lower().split()),) + tuple(sorted((k, str(v)) for k, v in args.items()))
+
+    # Called with a value that changes whenever the index content changes (e.g. the index statistics), so
+    # updates done outside of this process, like prepdocs.py runs, also invalidate the cache
+    def set_index_version(self, version: Hashable):
+        if self.index_version is not None and version != self.index_version:
+            self.clear()
+        self.index_version = version
+
+# Runs a search and returns the results as a list, so they can be reused from the cache. It's timed as the "search"
+# stage of the request, cache hits included.
+def search(search_client: Any, q: str, overrides: dict[str, Any], cache: Optional[RetrievalCache] = None) -> list[dict[str, Any]]:
+    args = search_args(overrides)
+    key = RetrievalCache.key(q, args)
+    with span("search", cached=True) as attributes:
+        results = cache.get(key) if cache is not None else None
+        if results is None:
+            attributes["cached"] = False
+            results = [doc for doc in search_client.search(q, **args)]
+            if cache is not None:
+                cache.put(key, results)
+    return results
+
+async def asearch(search_client: Any, q: str, overrides: dict[str, Any], cache: Optional[RetrievalCache] = None) -> list[dict[str, Any]]:
+    args = search_args(overrides)
+    key = RetrievalCache.key(q, args)
+    with span("search", cached=True) as attributes:
+        results = cache.get(key) if cache is not None else None
+        if results is None:
+            attributes["cached"] = False
+            results = [doc async for doc in await search_client.search(q, **args)]
+            if cache is not None:
+                cache.put(key, results)
+    return results
@@ -0,0 +1,175 @@
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+from typing import Any, AsyncGenerator, Iterator, Optional
+
+# OpenTelemetry is optional: when the API is installed spans and histograms are also reported through it, and they go
+# wherever the application configures the SDK to export them (nowhere until it does)
+try:
+    from opentelemetry import metrics as otel_metrics, trace as otel_trace
+    tracer = otel_trace.get_tracer(__name__)
+except ImportError:
+    tracer = None
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket takes everything above
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Latency distribution of a stage, with a count per bucket like Prometheus histograms
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+# Histograms of every stage ("search", "openai.completion", ...) seen so far, shared by the request handlers and the
+# worker threads running the synchronous approaches, so all access goes through a lock
+class Histograms:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self._histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+        self._otel_histogram = otel_metrics.get_meter(__name__).create_histogram(
+            "app.stage.duration", unit="s", description="Duration of the stages of /ask and /chat requests") if tracer else None
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        if self._otel_histogram is not None:
+            self._otel_histogram.record(seconds, {"stage": stage})
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return {stage: {"count": h.count, "sum": h.sum, "buckets": dict(zip([*map(str, h.buckets), "+Inf"], h.counts))}
+                    for stage, h in sorted(self._histograms.items())}
+
+    # Prometheus text exposition format, buckets are cumulative there
+    def prometheus(self, name: str = "app_stage_duration_seconds") -> str:
+        lines = [f"# HELP {name} Duration of the stages of /ask and /chat requests", f"# TYPE {name} histogram"]
+        with self._lock:
+            for stage, h in sorted(self._histograms.items()):
+                label = stage.replace("\\", "\\\\").replace('"', '\\"')
+                total = 0
+                for bound, count in zip([*map(str, h.buckets), "+Inf"], h.counts):
+                    total += count
+                    lines.append(f'{name}_bucket{{stage="{label}",le="{bound}"}} {total}')
+                lines.append(f'{name}_sum{{stage="{label}"}} {h.sum}')
+                lines.append(f'{name}_count{{stage="{label}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+histograms = Histograms()
+
+# Timings of the stages of one request, returned with the response. Spans can be added from worker threads (tools of
+# the Langchain agents), so adding goes through a lock.
+class Trace:
+    def __init__(self, name: str, attributes: Optional[dict[str, Any]] = None):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.spans: list[tuple[str, float, float, dict[str, Any]]] = []
+        self._lock = threading.Lock()
+        self._otel_span = tracer.start_span(name, attributes=attributes) if tracer else None
+
+    def add(self, name: str, start: float, end: float, attributes: Optional[dict[str, Any]] = None):
+        with self._lock:
+            self.spans.append((name, start, end, attributes or {}))
+        histograms.observe(name, end - start)
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+            histograms.observe(self.name, self.end - self.start)
+            if self._otel_span is not None:
+                self._otel_span.end()
+
+    def timings(self) -> dict[str, Any]:
+        end = self.end or time.perf_counter()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s[1])
+        return {"total_ms": round((end - self.start) * 1000, 1),
+                "spans": [{"name": name, "start_ms": round((start - self.start) * 1000, 1), "duration_ms": round((stop - start) * 1000, 1), **attributes}
+                          for name, start, stop, attributes in spans]}
+
+    # Spans started with the request's span as their parent, without making them current so they don't have to end in
+    # the same context they started in (streamed responses resume in different contexts)
+    def start_otel_span(self, name: str, attributes: Optional[dict[str, Any]] = None):
+        if self._otel_span is None:
+            return None
+        return tracer.start_span(name, context=otel_trace.set_span_in_context(self._otel_span), attributes=attributes)
+
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+# A stage of the current request, from its creation until end() is called. Outside of a traced request the stage
+# only goes to the histograms.
+class Span:
+    def __init__(self, name: str, attributes: Optional[dict[str, Any]] = None):
+        self.name = name
+        self.attributes = attributes if attributes is not None else {}
+        self.trace = current_trace.get()
+        self._otel_span = self.trace.start_otel_span(name, self.attributes) if self.trace else None
+        self.start = time.perf_counter()
+
+    def end(self, error: Optional[BaseException] = None):
+        end = time.perf_counter()
+        if error is not None:
+            self.attributes["error"] = type(error).__name__
+        if self.trace:
+            self.trace.add(self.name, self.start, end, self.attributes)
+        else:
+            histograms.observe(self.name, end - self.start)
+        if self._otel_span is not None:
+            self._otel_span.set_attributes({k: v for k, v in self.attributes.items() if v is not None})
+            self._otel_span.end()
+
+# Times a block as a stage of the current request, e.g. "with span('search'): ...". The attributes dict it yields can
+# be updated inside the block (e.g. with whether a cache was hit).
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[dict[str, Any]]:
+    s = Span(name, attributes)
+    try:
+        yield s.attributes
+    except BaseException as e:
+        s.end(e)
+        raise
+    s.end()
+
+# Traces a whole request, stages timed with span() while it runs (including on threads started with asyncio.to_thread,
+# which copy the context) are added to it
+@contextlib.contextmanager
+def trace_request(name: str, **attributes: Any) -> Iterator[Trace]:
+    trace = Trace(name, attributes)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        trace.finish()
+
+# Streamed responses are iterated by the web server after the request handler returned, each step of the stream runs
+# with the request's trace as the current one. The trace ends with the stream, its timings are the last partial response.
+async def trace_stream(trace: Trace, stream: AsyncGenerator[dict[str, Any], None]) -> AsyncGenerator[dict[str, Any], None]:
+    try:
+        while True:
+            token = current_trace.set(trace)
+            try:
+                item = await stream.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                current_trace.reset(token)
+            yield item
+        trace.finish()
+        yield {"timings": trace.timings()}
+    finally:
+        trace.finish()
+        await stream.aclose()
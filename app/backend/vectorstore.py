@@ -0,0 +1,249 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+from embeddings import Embedder, create_embedder
+from localsearch import FILTERABLE_FIELDS, LocalSearchResults, AsyncLocalSearchResults, caption, parse_filter, tokenize
+from tracing import span
+
+# Embeddings of the sections, for vector search and for hybrid search fused with the keyword results of Cognitive
+# Search (or of the local search index). The store is a directory written by VectorStoreBuilder.save:
+#   meta.json     embedder name, dimensions, element type, number of sections and their filterable fields
+#   vectors.npy   one row per section, float16, or int8 with the scale of each row in scales.npy
+#   docs.bin      the sections as UTF-8 JSON, one after another, with their int64 offsets in offsets.npy
+# Everything but meta.json is memory-mapped when the store is loaded.
+
+FORMAT_VERSION = 1
+DTYPES = ("float16", "int8")
+# Rows scored at a time, bounds the memory used to convert them to float32
+CHUNK_ROWS = 16384
+# Constant of reciprocal rank fusion, each result list contributes 1 / (RRF_K + rank) to a document's score
+RRF_K = 60
+
+def quantize(vectors: np.ndarray, dtype: str) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    # Symmetric per row quantization, the largest component of each row maps to 127
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+class VectorStore:
+    def __init__(self, path: str, embedder: Optional[Embedder] = None):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported embedding store in {path}, rebuild it with prepdocs.py --embeddings")
+        self.path = path
+        self.embedder = embedder or create_embedder(meta["embedder"])
+        if self.embedder.name != meta["embedder"]:
+            raise ValueError(f"The embedding store in {path} was built with {meta['embedder']}, not {self.embedder.name}")
+        self.count: int = meta["count"]
+        self.filterable: dict[str, list[Any]] = meta["filterable"]
+        self.vectors = self._load("vectors.npy") if self.count else np.zeros((0, meta["dimensions"]), dtype=meta["dtype"])
+        self.scales = self._load("scales.npy") if self.count and meta["dtype"] == "int8" else None
+        self.offsets = self._load("offsets.npy") if self.count else np.zeros(1, dtype=np.int64)
+        self.docs = np.memmap(os.path.join(path, "docs.bin"), dtype=np.uint8, mode="r") if self.count else np.zeros(0, dtype=np.uint8)
+        self._masks: dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(path: str, embedder: Optional[Embedder] = None) -> "VectorStore":
+        return VectorStore(path, embedder)
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, name), mmap_mode="r")
+
+    def document(self, row: int) -> dict[str, Any]:
+        return json.loads(self.docs[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8"))
+
+    # Rows passing a filter, computed once per filter (there are only a few, e.g. one per excluded category)
+    def mask(self, filter: str) -> np.ndarray:
+        with self._lock:
+            mask = self._masks.get(filter)
+        if mask is None:
+            predicate = parse_filter(filter)
+            mask = np.fromiter((predicate(lambda name: self.filterable[name][row] if name in self.filterable else None)
+                                for row in range(self.count)), dtype=bool, count=self.count)
+            with self._lock:
+                if len(self._masks) >= 64:
+                    self._masks.clear()
+                self._masks[filter] = mask
+        return mask
+
+    # Top rows for each of the query vectors (one per row of queries), as (row, cosine similarity) pairs. The
+    # matrix is scored a chunk at a time for all the queries at once, keeping the best rows of each chunk.
+    def search_vectors(self, queries: np.ndarray, top: int, filter: Optional[str] = None) -> list[list[tuple[int, float]]]:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        top = min(top, self.count)
+        if top <= 0:
+            return [[] for _ in queries]
+        mask = self.mask(filter) if filter else None
+        candidates = [([], []) for _ in range(queries.shape[0])]
+        for start in range(0, self.count, CHUNK_ROWS):
+            end = min(start + CHUNK_ROWS, self.count)
+            scores = np.asarray(self.vectors[start:end], dtype=np.float32) @ queries.T
+            if self.scales is not None:
+                scores *= self.scales[start:end, None]
+            if mask is not None:
+                scores[~mask[start:end]] = -np.inf
+            k = min(top, end - start)
+            for q, (rows, row_scores) in enumerate(candidates):
+                # Rows tied with the k-th best are kept too, so ties always go to the first rows
+                column = scores[:, q]
+                kth = np.partition(column, end - start - k)[end - start - k]
+                best = np.flatnonzero(column >= kth)
+                rows.append(best + start)
+                row_scores.append(column[best])
+        results = []
+        for rows, row_scores in candidates:
+            rows = np.concatenate(rows)
+            row_scores = np.concatenate(row_scores)
+            order = np.lexsort((rows, -row_scores))[:top]
+            results.append([(int(rows[i]), float(row_scores[i])) for i in order if row_scores[i] != -np.inf])
+        return results
+
+    # Sections closest to each query, shaped like search results
+    def search(self, queries: np.ndarray, top: int, filter: Optional[str] = None) -> list[list[dict[str, Any]]]:
+        return [[{**self.document(row), "@search.score": score} for row, score in hits]
+                for hits in self.search_vectors(queries, top, filter)]
+
+# Collects the sections and their embeddings and writes the store. It can start from an existing store to update it.
+class VectorStoreBuilder:
+    def __init__(self, embedder_name: str, path: Optional[str] = None, dtype: str = "float16"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported embedding type {dtype}, use one of {', '.join(DTYPES)}")
+        self.embedder_name = embedder_name
+        self.dtype = dtype
+        self.sections: dict[str, tuple[dict[str, Any], np.ndarray]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(os.path.join(path, "meta.json")):
+            store = VectorStore.load(path, create_embedder(embedder_name))
+            for row in range(store.count):
+                vector = np.asarray(store.vectors[row], dtype=np.float32)
+                if store.scales is not None:
+                    vector *= store.scales[row]
+                section = store.document(row)
+                self.sections[section["id"]] = (section, vector)
+
+    def add(self, sections: list[dict[str, Any]], vectors: np.ndarray):
+        with self._lock:
+            for section, vector in zip(sections, vectors):
+                self.sections[section["id"]] = (dict(section), np.asarray(vector, dtype=np.float32))
+
+    def delete(self, section_ids: Iterable[str]):
+        with self._lock:
+            for section_id in section_ids:
+                self.sections.pop(section_id, None)
+
+    # Removes the sections matching a filter (all of them without one), returns how many were removed
+    def remove(self, filter: Optional[str] = None) -> int:
+        predicate = parse_filter(filter) if filter else (lambda get: True)
+        with self._lock:
+            removed = [section_id for section_id, (section, _) in self.sections.items() if predicate(section.get)]
+            for section_id in removed:
+                del self.sections[section_id]
+        return len(removed)
+
+    def save(self, path: str):
+        with self._lock:
+            entries = sorted(self.sections.values(), key=lambda e: e[0]["id"])
+        dimensions = len(entries[0][1]) if entries else create_embedder(self.embedder_name).dimensions
+        vectors = np.stack([vector for _, vector in entries]) if entries else np.zeros((0, dimensions), dtype=np.float32)
+        matrix, scales = quantize(vectors, self.dtype)
+        offsets = [0]
+        docs = bytearray()
+        for section, _ in entries:
+            docs += json.dumps(section, ensure_ascii=False).encode("utf-8")
+            offsets.append(len(docs))
+        meta = {
+            "version": FORMAT_VERSION,
+            "embedder": self.embedder_name,
+            "dimensions": dimensions,
+            "dtype": self.dtype,
+            "count": len(entries),
+            "filterable": {name: [section.get(name) for section, _ in entries] for name in FILTERABLE_FIELDS},
+        }
+
+        # Each file is replaced atomically and meta.json last, processes that already mapped the old files keep them
+        def write(name, save):
+            temp_path = os.path.join(path, name + ".tmp")
+            with open(temp_path, "wb") as f:
+                save(f)
+            os.replace(temp_path, os.path.join(path, name))
+
+        os.makedirs(path, exist_ok=True)
+        write("vectors.npy", lambda f: np.save(f, matrix))
+        if scales is not None:
+            write("scales.npy", lambda f: np.save(f, scales))
+        write("offsets.npy", lambda f: np.save(f, np.array(offsets, dtype=np.int64)))
+        write("docs.bin", lambda f: f.write(bytes(docs)))
+        write("meta.json", lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8")))
+
+# Reciprocal rank fusion of several ranked lists of documents, documents are matched by id and keep the fields of the
+# first list they appear in. The fused score replaces @search.score.
+def fuse(result_lists: list[list[dict[str, Any]]], top: int, k: int = RRF_K) -> list[dict[str, Any]]:
+    fused: dict[str, tuple[float, dict[str, Any]]] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            score, first = fused.get(doc["id"], (0.0, doc))
+            fused[doc["id"]] = (score + 1 / (k + rank + 1), first)
+    ranked = sorted(fused.values(), key=lambda e: -e[0])[:top]
+    return [{**doc, "@search.score": score} for score, doc in ranked]
+
+# Options that only make sense on the keyword search (answers, counts, listings), searches using them are passed
+# through unchanged
+KEYWORD_ONLY_OPTIONS = ("query_answer", "include_total_count", "select", "facets")
+
+# Drop-in for SearchClient that fuses the keyword results with the sections closest to the query in the embedding
+# store. Sections only found by their embedding get a caption when captions are requested.
+class HybridSearchClient:
+    def __init__(self, search_client, store: VectorStore):
+        self.search_client = search_client
+        self.store = store
+
+    def search(self, search_text: Optional[str] = None, **kwargs):
+        if not search_text or any(kwargs.get(option) for option in KEYWORD_ONLY_OPTIONS):
+            return self.search_client.search(search_text, **kwargs)
+        top = kwargs.get("top") or 50
+        keyword = list(self.search_client.search(search_text, **kwargs))
+        with span("embeddings.query"):
+            queries = self.store.embedder.embed([search_text])
+        with span("vectorstore.search"):
+            vector = self.store.search(queries, top, kwargs.get("filter"))[0]
+        return LocalSearchResults(with_captions(fuse([keyword, vector], top), search_text, kwargs.get("query_caption")), None)
+
+    def close(self):
+        self.search_client.close()
+
+class AsyncHybridSearchClient:
+    def __init__(self, search_client, store: VectorStore):
+        self.search_client = search_client
+        self.store = store
+
+    async def search(self, search_text: Optional[str] = None, **kwargs):
+        if not search_text or any(kwargs.get(option) for option in KEYWORD_ONLY_OPTIONS):
+            return await self.search_client.search(search_text, **kwargs)
+        top = kwargs.get("top") or 50
+        keyword = [doc async for doc in await self.search_client.search(search_text, **kwargs)]
+        with span("embeddings.query"):
+            queries = await self.store.embedder.aembed([search_text])
+        # Scoring a large store takes a while, keep it off the event loop
+        with span("vectorstore.search"):
+            vector = (await asyncio.to_thread(self.store.search, queries, top, kwargs.get("filter")))[0]
+        return AsyncLocalSearchResults(with_captions(fuse([keyword, vector], top), search_text, kwargs.get("query_caption")), None)
+
+    async def close(self):
+        await self.search_client.close()
+
+def with_captions(docs: list[dict[str, Any]], search_text: str, query_caption: Optional[str]) -> list[dict[str, Any]]:
+    if query_caption:
+        terms = set(tokenize(search_text))
+        for doc in docs:
+            if not doc.get("@search.captions"):
+                doc["@search.captions"] = [caption(doc.get("content", ""), terms)]
+    return docs
@@ -17,7 +17,10 @@ export async function askApi(options: AskRequest): Promise<AskResponse> {
                 prompt_template: options.overrides?.promptTemplate,
                 prompt_template_prefix: options.overrides?.promptTemplatePrefix,
                 prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-                exclude_category: options.overrides?.excludeCategory
+                exclude_category: options.overrides?.excludeCategory,
+                parallel_search: options.overrides?.parallelSearch,
+                max_steps: options.overrides?.maxSteps,
+                max_seconds: options.overrides?.maxSeconds
             }
         })
     });
@@ -14,6 +14,9 @@ export type AskRequestOverrides = {
     promptTemplatePrefix?: string;
     promptTemplateSuffix?: string;
     suggestFollowupQuestions?: boolean;
+    parallelSearch?: boolean;
+    maxSteps?: number;
+    maxSeconds?: number;
 };
 
 export type AskRequest = {
@@ -22,10 +25,23 @@ export type AskRequest = {
     overrides?: AskRequestOverrides;
 };
 
+export type TimingSpan = {
+    name: string;
+    start_ms: number;
+    duration_ms: number;
+    [attribute: string]: string | number | boolean;
+};
+
+export type Timings = {
+    total_ms: number;
+    spans: TimingSpan[];
+};
+
 export type AskResponse = {
     answer: string;
     thoughts: string | null;
     data_points: string[];
+    timings?: Timings;
     error?: string;
 };
 
@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import datetime
+import ipaddress
+import json
+import os
+import random
+import re
+import ssl
+import sys
+import tempfile
+import time
+from typing import NamedTuple, Optional
+
+from aiohttp import web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app", "backend"))
+from embeddings import HashingEmbedder
+from localsearch import LocalSearchClient, LocalSearchIndex, LocalSearchIndexBuilder
+
+# Local stand-ins for the Azure OpenAI and Cognitive Search endpoints the backend calls, so the app can be run and
+# load tested without the services. Each one waits according to a latency profile and fails a share of the requests
+# (429 for OpenAI, 503 for Search) like a throttled service would.
+#
+# OpenAI: completions (streamed or not) and embeddings of any deployment. Completions are made up from the prompt, in
+# the formats the approaches parse: search queries, ReAct (Search[...]/Finish[...]) and MRKL (Action/Final Answer)
+# agent steps, and answers citing the sources in the prompt.
+# Search: searches (served from a local search index, see localsearch.py) and index statistics of any index. The
+# Search SDK only connects to https endpoints, so it's served with a self-signed certificate the backend has to trust
+# (SSL_CERT_FILE and REQUESTS_CA_BUNDLE).
+#
+# Example, serve the stand-ins and print the settings to point the backend to them:
+#   python scripts/benchmarks/fakeservices.py --openai-latency 0.8 --openai-jitter 0.3 --search-latency 0.05
+
+class Profile(NamedTuple):
+    # Seconds before responding, normally distributed around latency
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Share of requests failing
+    error_rate: float = 0.0
+    # Seconds per generated word, added to the latency of completions (and spread between streamed chunks)
+    token_latency: float = 0.0
+
+    def delay(self, rnd: random.Random) -> float:
+        return max(0.0, rnd.gauss(self.latency, self.jitter) if self.jitter else self.latency)
+
+    def fails(self, rnd: random.Random) -> bool:
+        return rnd.random() < self.error_rate
+
+TOPICS = ["deductible", "copay", "in-network providers", "out-of-network providers", "prescription drugs", "dental coverage",
+          "vision coverage", "mental health services", "emergency care", "preventive care", "performance reviews",
+          "paid time off", "workplace safety", "the employee assistance program", "product managers", "open enrollment"]
+PLANS = ["Northwind Health Plus", "Northwind Standard", "the employee plan", "the family plan"]
+FILES = ["Benefit_Options", "Northwind_Health_Plus_Benefits_Details", "Northwind_Standard_Benefits_Details", "employee_handbook",
+         "role_library", "PerksPlus"]
+
+# Sections about made up benefits and handbook topics, shaped like the ones prepdocs.py creates
+def synthetic_sections(count: int, seed: int = 0) -> list[dict]:
+    rnd = random.Random(seed)
+    sections = []
+    for i in range(count):
+        filename = FILES[i % len(FILES)]
+        sentences = []
+        for _ in range(rnd.randint(4, 10)):
+            topic, plan = rnd.choice(TOPICS), rnd.choice(PLANS)
+            sentences.append(rnd.choice([
+                f"{plan} covers {topic} with a ${rnd.randint(1, 50) * 10} copay.",
+                f"For {topic}, employees on {plan} should contact the benefits team.",
+                f"{topic.capitalize()} are reviewed every {rnd.choice(['month', 'quarter', 'year'])} under {plan}.",
+                f"Coverage for {topic} depends on whether you use {rnd.choice(['in-network', 'out-of-network'])} providers.",
+            ]))
+        page = i // len(FILES)
+        sections.append({"id": f"{filename}-pdf-{i}", "content": " ".join(sentences), "category": None,
+                         "sourcepage": f"{filename}-{page}.pdf", "sourcefile": f"{filename}.pdf"})
+    return sections
+
+def build_index(path: str, sections: list[dict]) -> LocalSearchIndex:
+    builder = LocalSearchIndexBuilder()
+    builder.upload_documents(sections)
+    builder.save(path)
+    return LocalSearchIndex.load(path)
+
+SOURCE_RE = re.compile(r"^([\w\-\.]+\.\w+):\s*(.*)$", re.MULTILINE)
+FILLER = "The sources describe this in more detail, including the conditions that apply and who to contact for help.".split()
+
+def last_question(prompt: str) -> str:
+    matches = re.findall(r"Question:\s*\n?'?(.+?)'?\??\s*$", prompt, re.MULTILINE)
+    return matches[-1].strip() if matches else "benefits"
+
+# Makes up a completion in the format expected from the prompt
+def complete(prompt: str, answer_words: int = 40) -> str:
+    if prompt.rstrip().endswith("Search query:"):
+        return " ".join(re.findall(r"\w+", last_question(prompt))[:8])
+
+    question_start = prompt.rfind("\nQuestion: ")
+    scratchpad = prompt[question_start:] if question_start >= 0 else ""
+    if "Action: Finish[" in prompt:
+        # ReAct docstore agent (ReadDecomposeAsk): searches each part of a "... and ..." question, one per step or all in
+        # one step when the prompt allows it, then looks the first part up before answering
+        parts = re.split(r"\s+and\s+", last_question(prompt))
+        searched = re.findall(r"Search\[(.*?)\]", scratchpad)
+        remaining = [part for part in parts if part not in searched]
+        if remaining:
+            actions = remaining if "Search[first] | Search[second]" in prompt else remaining[:1]
+            return f"Thought: I need to search {remaining[0]}.\nAction: " + " | ".join(f"Search[{part}]" for part in actions)
+        if len(parts) > 1 and "Lookup[" not in scratchpad:
+            return f"Thought: I need to look up {parts[0]}.\nAction: Lookup[{parts[0]}]"
+        sources = SOURCE_RE.findall(scratchpad)
+        return f"Thought: The observation answers the question.\nAction: Finish[{answer(sources, answer_words)}]".replace(" [", " <").replace("]]", ">]")
+    if "Action Input:" in prompt:
+        # MRKL agent (ReadRetrieveRead)
+        if "Observation:" not in scratchpad:
+            return f" I need to search for information about this.\nAction: CognitiveSearch\nAction Input: {last_question(prompt)}"
+        return f" I now know the final answer.\nFinal Answer: {answer(SOURCE_RE.findall(scratchpad), answer_words)}"
+
+    sources_start = prompt.rfind("Sources:")
+    sources = SOURCE_RE.findall(prompt[sources_start:] if sources_start >= 0 else prompt)
+    text = answer(sources, answer_words)
+    if "<<" in prompt and "<|im_start|>" in prompt:
+        text += " <<What is not covered?>> <<How do I enroll?>> <<Who do I contact?>>"
+    return text
+
+def answer(sources: list[tuple[str, str]], answer_words: int) -> str:
+    words = []
+    citations = []
+    for name, content in sources[:3]:
+        words += content.split()[:answer_words // 3]
+        citations.append(f"[{name}]")
+    words += FILLER * (1 + answer_words // len(FILLER))
+    return " ".join(words[:answer_words]) + " " + "".join(citations or ["[unknown]"])
+
+# Writes a certificate and its key for 127.0.0.1 and localhost to directory, returns their paths
+def self_signed_certificate(directory: str) -> tuple[str, str]:
+    # The cryptography package comes with azure-identity
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=30))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+    cert_path, key_path = os.path.join(directory, "fake.crt"), os.path.join(directory, "fake.key")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_path, key_path
+
+class FakeServices:
+    def __init__(self, index: LocalSearchIndex, openai_profile: Profile = Profile(), search_profile: Profile = Profile(),
+                 answer_words: int = 40, seed: int = 0):
+        self.search_client = LocalSearchClient(index)
+        self.openai_profile = openai_profile
+        self.search_profile = search_profile
+        self.answer_words = answer_words
+        self.rnd = random.Random(seed)
+        self.embedder = HashingEmbedder(1536)
+        self.requests = {"openai": 0, "search": 0}
+        self.errors = {"openai": 0, "search": 0}
+        self._runners = []
+
+    # Returns the URLs of the OpenAI and Search endpoints, the certificate of the Search endpoint is written to directory
+    async def start(self, directory: str, host: str = "127.0.0.1", openai_port: int = 0, search_port: int = 0) -> tuple[str, str, str]:
+        cert_path, key_path = self_signed_certificate(directory)
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert_path, key_path)
+        openai_url = await self._serve(self.openai, host, openai_port)
+        search_url = await self._serve(self.search, host, search_port, ssl_context)
+        return openai_url, search_url, cert_path
+
+    async def _serve(self, handler, host: str, port: int, ssl_context: Optional[ssl.SSLContext] = None) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{tail:.*}", handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port, ssl_context=ssl_context)
+        await site.start()
+        self._runners.append(runner)
+        return f"{'https' if ssl_context else 'http'}://{host}:{site._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners = []
+
+    async def openai(self, request: web.Request) -> web.StreamResponse:
+        self.requests["openai"] += 1
+        body = await request.json()
+        await asyncio.sleep(self.openai_profile.delay(self.rnd))
+        if self.openai_profile.fails(self.rnd):
+            self.errors["openai"] += 1
+            return web.json_response({"error": {"code": "429", "message": "Rate limit exceeded (fake)"}}, status=429, headers={"Retry-After": "1"})
+
+        if request.path.endswith("/embeddings"):
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            vectors = self.embedder.embed(inputs)
+            return web.json_response({"object": "list", "data": [{"object": "embedding", "index": i, "embedding": v.tolist()} for i, v in enumerate(vectors)],
+                                      "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+        prompt = body.get("prompt")
+        prompt = prompt[0] if isinstance(prompt, list) else prompt or ""
+        text = complete(prompt, self.answer_words)
+        for stop in body.get("stop") or []:
+            text = text.split(stop)[0]
+        words = re.findall(r"\S+\s*", text) or [""]
+        completion = {"id": f"cmpl-{self.requests['openai']}", "object": "text_completion", "created": int(time.time()),
+                      "model": "fake", "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(words), "total_tokens": len(prompt) // 4 + len(words)}}
+        if not body.get("stream"):
+            await asyncio.sleep(self.openai_profile.token_latency * len(words))
+            return web.json_response({**completion, "choices": [{"text": text, "index": 0, "finish_reason": "stop", "logprobs": None}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, word in enumerate(words):
+            await asyncio.sleep(self.openai_profile.token_latency)
+            chunk = {**completion, "choices": [{"text": word, "index": 0, "finish_reason": "stop" if i == len(words) - 1 else None, "logprobs": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def search(self, request: web.Request) -> web.StreamResponse:
+        self.requests["search"] += 1
+        await asyncio.sleep(self.search_profile.delay(self.rnd))
+        if self.search_profile.fails(self.rnd):
+            self.errors["search"] += 1
+            return web.json_response({"error": {"code": "ServiceUnavailable", "message": "Service unavailable (fake)"}}, status=503)
+
+        if request.path.endswith("/search.stats"):
+            index = self.search_client.index
+            return web.json_response({"documentCount": index.doc_count, "storageSize": index.doc_count * 1024, "vectorIndexSize": 0})
+        if not request.path.endswith("/docs/search.post.search"):
+            return web.json_response({"error": {"code": "NotFound", "message": f"Not supported by the fake: {request.path}"}}, status=404)
+
+        body = await request.json()
+        select = body.get("select")
+        r = self.search_client.search(body.get("search"), top=body.get("top"), filter=body.get("filter"),
+                                      select=select.split(",") if select else None, query_caption=body.get("captions"))
+        documents = []
+        for doc in r:
+            if "@search.captions" in doc:
+                doc["@search.captions"] = [{"text": c.text, "highlights": c.highlights} for c in doc["@search.captions"]]
+            documents.append(doc)
+        result = {"value": documents}
+        if body.get("count"):
+            result["@odata.count"] = r.get_count()
+        if body.get("answers"):
+            result["@search.answers"] = []
+        return web.json_response(result)
+
+def profile_args(parser: argparse.ArgumentParser, name: str, latency: float, token_latency: float = 0.0):
+    parser.add_argument(f"--{name}-latency", type=float, default=latency, help=f"Mean seconds before {name} responds")
+    parser.add_argument(f"--{name}-jitter", type=float, default=latency / 4, help=f"Standard deviation of the {name} latency")
+    parser.add_argument(f"--{name}-error-rate", type=float, default=0.0, help=f"Share of {name} requests failing")
+    if name == "openai":
+        parser.add_argument("--openai-token-latency", type=float, default=token_latency, help="Seconds per generated word")
+
+def profiles(args) -> tuple[Profile, Profile]:
+    return (Profile(args.openai_latency, args.openai_jitter, args.openai_error_rate, args.openai_token_latency),
+            Profile(args.search_latency, args.search_jitter, args.search_error_rate))
+
+def service_args(parser: argparse.ArgumentParser):
+    profile_args(parser, "openai", 0.5, 0.01)
+    profile_args(parser, "search", 0.05)
+    parser.add_argument("--index", help="Local search index to serve (built with prepdocs.py --localindex), synthetic sections otherwise")
+    parser.add_argument("--sections", type=int, default=2000, help="Number of synthetic sections")
+    parser.add_argument("--answer-words", type=int, default=40, help="Number of words of the answers")
+    parser.add_argument("--seed", type=int, default=0)
+
+def load_index(args, temp_dir: str) -> LocalSearchIndex:
+    return LocalSearchIndex.load(args.index) if args.index else build_index(temp_dir, synthetic_sections(args.sections, args.seed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve local stand-ins for the Azure OpenAI and Cognitive Search endpoints")
+    service_args(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--openai-port", type=int, default=8081)
+    parser.add_argument("--search-port", type=int, default=8082)
+    args = parser.parse_args()
+
+    async def serve():
+        with tempfile.TemporaryDirectory() as temp_dir:
+            openai_profile, search_profile = profiles(args)
+            services = FakeServices(load_index(args, temp_dir), openai_profile, search_profile, args.answer_words, args.seed)
+            openai_url, search_url, cert_path = await services.start(temp_dir, args.host, args.openai_port, args.search_port)
+            print("Point the backend to the stand-ins with:")
+            print(f"\tAZURE_OPENAI_ENDPOINT={openai_url} AZURE_OPENAI_KEY=fake AZURE_SEARCH_ENDPOINT={search_url} AZURE_SEARCH_KEY=fake "
+                  f"SSL_CERT_FILE={cert_path} REQUESTS_CA_BUNDLE={cert_path}")
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await services.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
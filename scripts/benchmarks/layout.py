@@ -0,0 +1,138 @@
+import argparse
+import html
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app", "backend"))
+from ingestion.layout import layout_page_map
+
+# Micro-benchmark for layout_page_map: checks that it builds the same page map as the original character by character
+# assembly of the Form Recognizer output (kept below as the reference), and compares their speed on synthetic
+# table-heavy documents.
+#
+# Example: python scripts/benchmarks/layout.py --pages 500 --tables-per-page 4
+
+def reference_table_to_html(table):
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html +="</tr>"
+    table_html += "</table>"
+    return table_html
+
+def reference_layout_page_map(form_recognizer_results):
+    offset = 0
+    page_map = []
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
+
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_chars = [-1]*page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >=0 and idx < page_length:
+                        table_chars[idx] = table_id
+
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                page_text += form_recognizer_results.content[page_offset + idx]
+            elif not table_id in added_tables:
+                page_text += reference_table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+
+        page_text += " "
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+WORDS = ["deductible", "coverage", "in-network", "plan", "employee", "benefit", "Northwind", "<b>", "&", "copay",
+         "prescription", "out-of-pocket", "a", "the", "of", "and", "visit"]
+
+def random_text(rnd, length):
+    text = ""
+    while len(text) < length:
+        text += rnd.choice(WORDS) + rnd.choice([" ", " ", " ", ". ", "\n"])
+    return text[:length]
+
+def random_table(rnd, page_number, spans):
+    row_count = rnd.randint(1, 30)
+    column_count = rnd.randint(1, 6)
+    cells = [SimpleNamespace(row_index=r, column_index=c, content=random_text(rnd, rnd.randint(1, 40)),
+                             kind=rnd.choice(["content", "content", "columnHeader", "rowHeader"]),
+                             column_span=rnd.choice([1, 1, 1, 2]), row_span=rnd.choice([1, 1, 1, 2]))
+             for r in range(row_count) for c in range(column_count)]
+    # Form Recognizer doesn't promise any order for the cells
+    rnd.shuffle(cells)
+    return SimpleNamespace(row_count=row_count, column_count=column_count, cells=cells, spans=spans,
+                           bounding_regions=[SimpleNamespace(page_number=page_number)])
+
+# A synthetic analysis result, tables have one or more spans within their page and, more rarely, spans running past
+# the page or overlapping other tables
+def random_results(rnd, pages, page_length, tables_per_page):
+    content = ""
+    result_pages = []
+    tables = []
+    for page_num in range(pages):
+        length = rnd.randint(0, 2 * page_length)
+        page_offset = len(content)
+        content += random_text(rnd, length)
+        result_pages.append(SimpleNamespace(spans=[SimpleNamespace(offset=page_offset, length=length)]))
+        for _ in range(rnd.randint(0, 2 * tables_per_page) if length else 0):
+            spans = []
+            for _ in range(rnd.choice([1, 1, 1, 2, 3])):
+                start = rnd.randint(-20 if rnd.random() < 0.05 else 0, length - 1)
+                span_length = rnd.randint(1, max(1, length // (2 * tables_per_page)) + (50 if rnd.random() < 0.05 else 0))
+                spans.append(SimpleNamespace(offset=page_offset + start, length=span_length))
+            tables.append(random_table(rnd, page_num + 1, spans))
+    # Tables are listed in document order, but not sorted by page
+    rnd.shuffle(tables)
+    # Leave room for spans running past the last page
+    content += random_text(rnd, 100)
+    return SimpleNamespace(content=content, pages=result_pages, tables=tables)
+
+def timed(f, results):
+    start = time.perf_counter()
+    page_map = f(results)
+    return page_map, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare layout_page_map with the original implementation on synthetic Form Recognizer results")
+    parser.add_argument("--pages", type=int, default=300, help="Number of pages of the large document")
+    parser.add_argument("--page-length", type=int, default=3000, help="Average number of characters per page")
+    parser.add_argument("--tables-per-page", type=int, default=3, help="Average number of tables per page")
+    parser.add_argument("--documents", type=int, default=200, help="Number of small random documents checked for identical output")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    for i in range(args.documents):
+        results = random_results(rnd, rnd.randint(0, 10), rnd.randint(1, 1000), rnd.randint(1, 5))
+        if layout_page_map(results) != reference_layout_page_map(results):
+            print(f"Different page map for document {i}")
+            sys.exit(1)
+    print(f"{args.documents} random documents: identical page maps")
+
+    results = random_results(rnd, args.pages, args.page_length, args.tables_per_page)
+    new_page_map, new_time = timed(layout_page_map, results)
+    reference_page_map, reference_time = timed(reference_layout_page_map, results)
+    if new_page_map != reference_page_map:
+        print("Different page map for the large document")
+        sys.exit(1)
+    print(f"{args.pages} pages, {len(results.content)} characters, {len(results.tables)} tables")
+    print(f"\treference: {reference_time:.3f}s")
+    print(f"\tlayout_page_map: {new_time:.3f}s ({reference_time / new_time:.1f}x)")
@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import NamedTuple, Optional
+
+import aiohttp
+
+from fakeservices import FakeServices, load_index, profiles, service_args
+
+# Load test of the backend without Azure: serves local stand-ins for Azure OpenAI and Cognitive Search (see
+# fakeservices.py), starts app.py pointed to them, and replays questions against /ask and /chat, either with a fixed
+# number of concurrent clients or with requests arriving at a fixed rate (Poisson arrivals). Chats are multi-turn
+# conversations made from the questions, each turn sending the history so far. Reports the throughput and the
+# p50/p95/p99 latency of each approach, the time to the first streamed line with --stream, and the time spent in each
+# stage (search, completions, agent steps...) from the timings returned with the responses.
+#
+# Nothing is sent to Azure, but tiktoken downloads its encodings the first time prompts are measured: run once with
+# network access (or point TIKTOKEN_CACHE_DIR to a copy of them) before running on a machine without it.
+#
+# Examples:
+#   python scripts/benchmarks/loadtest.py --concurrency 16 --duration 60
+#   python scripts/benchmarks/loadtest.py --rate 20 --requests 500 --approaches ask:rtr chat:rrr --stream
+#   python scripts/benchmarks/loadtest.py --app-url http://localhost:50505 --approaches ask:rrr
+
+APPROACHES = ["ask:rtr", "ask:rrr", "ask:rda", "chat:rrr"]
+QUESTIONS = [
+    "What is included in my Northwind Health Plus plan that is not in standard?",
+    "What happens in a performance review?",
+    "What does a Product Manager do?",
+    "Does my plan cover eye exams?",
+    "How much is the copay for emergency care?",
+    "Are out-of-network providers covered?",
+    "What mental health services are available?",
+    "How do I file a claim for prescription drugs?",
+    "Does Northwind Standard cover eye exams and what is the copay for emergency care?",
+    "What does a Product Manager do and what happens in a performance review?",
+]
+FOLLOW_UPS = ["Can you tell me more?", "What about dental coverage?", "Is there a deductible for that?", "Who do I contact about it?"]
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app", "backend")
+
+class Result(NamedTuple):
+    approach: str
+    seconds: float
+    # Seconds to the first streamed line, None when not streaming
+    first_line: Optional[float]
+    error: Optional[str]
+    # Seconds spent in each stage of the request, from the timings returned by the app
+    stages: dict[str, float]
+
+# Questions from a JSON lines file, using the "question" field of each line (or "title", so request logs can be replayed)
+def read_questions(path: str) -> list[str]:
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                question = entry.get("question") or entry.get("title") if isinstance(entry, dict) else entry
+                if question:
+                    questions.append(question)
+    return questions
+
+# History of a chat with turns questions, the last turn without a bot answer yet
+def chat_history(rnd: random.Random, questions: list[str], turns: int) -> list[dict]:
+    history = [{"user": rnd.choice(questions), "bot": "Sorry, I don't know. [unknown]"} for _ in range(turns - 1)]
+    history = [{"user": turn["user"] if i == 0 else rnd.choice(FOLLOW_UPS), "bot": turn["bot"]} for i, turn in enumerate(history)]
+    return history + [{"user": rnd.choice(FOLLOW_UPS if history else questions)}]
+
+def request_body(rnd: random.Random, approach: str, questions: list[str], args) -> tuple[str, dict]:
+    route, name = approach.split(":")
+    body = {"approach": name, "overrides": {"top": args.top, "semantic_captions": args.captions, "suggest_followup_questions": True,
+                                            "parallel_search": args.parallel_search}}
+    if args.stream:
+        body["stream"] = True
+    if route == "chat":
+        body["history"] = chat_history(rnd, questions, rnd.randint(1, args.max_turns))
+    else:
+        body["question"] = rnd.choice(questions)
+    return f"/{route}", body
+
+def stage_seconds(timings: Optional[dict]) -> dict[str, float]:
+    stages = {}
+    for span in (timings or {}).get("spans", []):
+        stages[span["name"]] = stages.get(span["name"], 0.0) + span["duration_ms"] / 1000
+    return stages
+
+async def send(session: aiohttp.ClientSession, app_url: str, approach: str, path: str, body: dict) -> Result:
+    start = time.perf_counter()
+    first_line = None
+    timings = None
+    try:
+        async with session.post(app_url + path, json=body) as response:
+            if body.get("stream"):
+                async for line in response.content:
+                    if first_line is None:
+                        first_line = time.perf_counter() - start
+                    if response.status == 200 and (b'"error"' in line or b'"timings"' in line):
+                        event = json.loads(line)
+                        if "error" in event:
+                            return Result(approach, time.perf_counter() - start, first_line, event["error"][:80], {})
+                        timings = event.get("timings", timings)
+            else:
+                content = await response.read()
+                if response.status == 200:
+                    timings = json.loads(content).get("timings")
+            error = None if response.status == 200 else f"HTTP {response.status}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        error = type(e).__name__
+    return Result(approach, time.perf_counter() - start, first_line, error, stage_seconds(timings))
+
+async def run_load(app_url: str, questions: list[str], args) -> tuple[list[Result], float]:
+    rnd = random.Random(args.seed)
+    results: list[Result] = []
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    sent = 0
+
+    def next_request() -> Optional[tuple[str, str, dict]]:
+        nonlocal sent
+        if (args.requests and sent >= args.requests) or (deadline and time.perf_counter() >= deadline):
+            return None
+        sent += 1
+        approach = args.approaches[sent % len(args.approaches)]
+        return (approach, *request_body(rnd, approach, questions, args))
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        start = time.perf_counter()
+        if args.rate:
+            # Open loop: requests arrive at the given rate whatever the response times are
+            tasks = []
+            while (request := next_request()) is not None:
+                tasks.append(asyncio.create_task(send(session, app_url, *request)))
+                await asyncio.sleep(rnd.expovariate(args.rate))
+            results = await asyncio.gather(*tasks)
+        else:
+            # Closed loop: each client sends its next request once the previous one is answered
+            async def client():
+                while (request := next_request()) is not None:
+                    results.append(await send(session, app_url, *request))
+            await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        return list(results), time.perf_counter() - start
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else float("nan")
+
+def report(results: list[Result], elapsed: float) -> dict:
+    summary = {}
+    for approach in sorted({r.approach for r in results}):
+        approach_results = [r for r in results if r.approach == approach]
+        ok = [r.seconds for r in approach_results if r.error is None]
+        first_lines = [r.first_line for r in approach_results if r.error is None and r.first_line is not None]
+        errors = {}
+        for r in approach_results:
+            if r.error is not None:
+                errors[r.error] = errors.get(r.error, 0) + 1
+        summary[approach] = {"requests": len(approach_results), "errors": errors, "throughput": len(ok) / elapsed,
+                             "p50": percentile(ok, 50), "p95": percentile(ok, 95), "p99": percentile(ok, 99)}
+        if first_lines:
+            summary[approach]["first_line_p50"] = percentile(first_lines, 50)
+            summary[approach]["first_line_p95"] = percentile(first_lines, 95)
+        # Time per stage of the requests that went through it, to see where the time goes
+        stages = {}
+        for r in approach_results:
+            for stage, seconds in r.stages.items():
+                stages.setdefault(stage, []).append(seconds)
+        summary[approach]["stages"] = {stage: {"requests": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95)}
+                                       for stage, values in sorted(stages.items(), key=lambda item: -sum(item[1]))}
+    return summary
+
+def print_report(summary: dict, elapsed: float):
+    print(f"{sum(s['requests'] for s in summary.values())} requests in {elapsed:.1f}s")
+    print(f"{'approach':<10} {'requests':>8} {'errors':>7} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for approach, s in summary.items():
+        print(f"{approach:<10} {s['requests']:>8} {sum(s['errors'].values()):>7} {s['throughput']:>7.2f} "
+              f"{s['p50'] * 1000:>6.0f}ms {s['p95'] * 1000:>6.0f}ms {s['p99'] * 1000:>6.0f}ms")
+        if "first_line_p50" in s:
+            print(f"{'':<10} first streamed line: p50 {s['first_line_p50'] * 1000:.0f}ms, p95 {s['first_line_p95'] * 1000:.0f}ms")
+        for stage, t in s["stages"].items():
+            print(f"{'':<10} {stage:<22} {t['requests']:>5} requests, p50 {t['p50'] * 1000:.0f}ms, p95 {t['p95'] * 1000:.0f}ms")
+        for error, count in s["errors"].items():
+            print(f"{'':<10} {count} x {error}")
+
+# Starts app.py with uvicorn, pointed to the stand-ins, and waits until it answers
+async def start_app(openai_url: str, search_url: str, cert_path: str, port: int, args) -> subprocess.Popen:
+    env = {**os.environ, "AZURE_OPENAI_ENDPOINT": openai_url, "AZURE_OPENAI_KEY": "fake",
+           "AZURE_SEARCH_ENDPOINT": search_url, "AZURE_SEARCH_KEY": "fake", "SSL_CERT_FILE": cert_path, "REQUESTS_CA_BUNDLE": cert_path}
+    if args.no_cache:
+        env.update({"RETRIEVAL_CACHE_SIZE": "0", "QUERY_CACHE_SIZE": "0"})
+    app = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--workers", str(args.workers),
+                            "--log-level", "warning"], cwd=BACKEND_DIR, env=env)
+    async with aiohttp.ClientSession() as session:
+        for _ in range(300):
+            if app.poll() is not None:
+                raise RuntimeError(f"app.py exited with code {app.returncode}")
+            try:
+                async with session.post(f"http://127.0.0.1:{port}/ask", json={}) as response:
+                    return app
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    app.terminate()
+    raise RuntimeError("app.py didn't start in 30s")
+
+async def main(args):
+    questions = read_questions(args.questions) if args.questions else QUESTIONS
+    if args.app_url:
+        results, elapsed = await run_load(args.app_url.rstrip("/"), questions, args)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            openai_profile, search_profile = profiles(args)
+            services = FakeServices(load_index(args, temp_dir), openai_profile, search_profile, args.answer_words, args.seed)
+            openai_url, search_url, cert_path = await services.start(temp_dir)
+            app = await start_app(openai_url, search_url, cert_path, args.port, args)
+            try:
+                results, elapsed = await run_load(f"http://127.0.0.1:{args.port}", questions, args)
+            finally:
+                app.terminate()
+                app.wait()
+                await services.stop()
+            print(f"Fake OpenAI: {services.requests['openai']} requests ({services.errors['openai']} failed), "
+                  f"fake Search: {services.requests['search']} requests ({services.errors['search']} failed)")
+    summary = report(results, elapsed)
+    if args.json:
+        print(json.dumps({"elapsed": elapsed, "approaches": summary}, indent=2))
+    else:
+        print_report(summary, elapsed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the backend against local stand-ins for Azure OpenAI and Cognitive Search")
+    parser.add_argument("--approaches", nargs="+", default=APPROACHES, choices=APPROACHES, help="Approaches to send requests to, in turn")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, default=8, help="Number of clients each sending one request at a time")
+    load.add_argument("--rate", type=float, help="Requests per second, sent whether or not earlier requests were answered")
+    parser.add_argument("--duration", type=float, help="Seconds to send requests for")
+    parser.add_argument("--requests", type=int, help="Number of requests to send (default 200 without --duration)")
+    parser.add_argument("--questions", help="JSON lines file of questions (\"question\" or \"title\" field), built-in questions otherwise")
+    parser.add_argument("--max-turns", type=int, default=4, help="Maximum number of turns of the generated chats")
+    parser.add_argument("--top", type=int, default=3)
+    parser.add_argument("--captions", action="store_true", help="Use semantic captions")
+    parser.add_argument("--stream", action="store_true", help="Request streamed responses")
+    parser.add_argument("--parallel-search", action="store_true", help="Let the rda agent run independent searches in the same step")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds before a request counts as failed")
+    parser.add_argument("--app-url", help="Load test an app that's already running instead of starting one with the stand-ins")
+    parser.add_argument("--port", type=int, default=50599, help="Port of the started app")
+    parser.add_argument("--workers", type=int, default=1, help="Number of uvicorn workers of the started app")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the retrieval and query caches of the started app")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    service_args(parser)
+    args = parser.parse_args()
+    if not args.duration and not args.requests:
+        args.requests = 200
+    asyncio.run(main(args))
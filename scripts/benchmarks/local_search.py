@@ -0,0 +1,106 @@
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app", "backend"))
+from localsearch import B, K1, LocalSearchClient, LocalSearchIndex, LocalSearchIndexBuilder, tokenize
+
+# Benchmark for the local search backend: builds an index from synthetic sections, checks that the top results match
+# a brute-force BM25 over the same sections (kept below as the reference, scores differ slightly since the index keeps
+# the length normalization in single precision), and measures build, load and query times.
+#
+# Example: python scripts/benchmarks/local_search.py --sections 20000 --queries 500
+
+WORDS = ["deductible", "coverage", "in-network", "plan", "employee", "benefit", "Northwind", "copay", "prescription",
+         "out-of-pocket", "a", "the", "of", "and", "visit", "dental", "vision", "premium", "claim", "provider",
+         "emergency", "hospital", "referral", "specialist", "pharmacy", "annual", "limit", "network", "policy", "handbook"]
+CATEGORIES = [None, "benefits", "handbook"]
+
+def random_sections(rnd, count, length):
+    sections = []
+    for i in range(count):
+        # Skewed word frequencies, like real text
+        words = rnd.choices(WORDS, weights=[1 / (r + 1) for r in range(len(WORDS))], k=rnd.randint(length // 2, length))
+        filename = f"doc{i // 20}.pdf"
+        sections.append({
+            "id": f"doc{i // 20}-pdf-section-{i % 20}",
+            "content": " ".join(words) + ".",
+            "category": rnd.choice(CATEGORIES),
+            "sourcepage": f"doc{i // 20}-{i % 20}.pdf",
+            "sourcefile": filename,
+        })
+    return sections
+
+def reference_search(sections, q, top):
+    documents = sorted(sections, key=lambda s: s["id"])
+    tokens = [tokenize(s["content"]) for s in documents]
+    avg_length = sum(len(t) for t in tokens) / len(tokens)
+    df = Counter(term for t in tokens for term in set(t))
+    scores = []
+    for doc_id, t in enumerate(tokens):
+        tf = Counter(t)
+        score = 0.0
+        for term, query_tf in Counter(tokenize(q)).items():
+            if tf[term]:
+                idf = math.log(1 + (len(documents) - df[term] + 0.5) / (df[term] + 0.5))
+                score += query_tf * idf * tf[term] * (K1 + 1) / (tf[term] + K1 * (1 - B + B * len(t) / avg_length))
+        if score > 0:
+            scores.append((score, -doc_id, documents[doc_id]["id"]))
+    return [(doc_key, score) for score, _, doc_key in sorted(scores, reverse=True)[:top]]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local search index from synthetic sections and measure query latency")
+    parser.add_argument("--sections", type=int, default=10000, help="Number of sections in the index")
+    parser.add_argument("--section-length", type=int, default=150, help="Maximum number of words per section")
+    parser.add_argument("--queries", type=int, default=300, help="Number of queries timed")
+    parser.add_argument("--checks", type=int, default=20, help="Number of queries checked against the brute-force reference")
+    parser.add_argument("--top", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    sections = random_sections(rnd, args.sections, args.section_length)
+    queries = [" ".join(rnd.sample(WORDS, rnd.randint(1, 5))) for _ in range(args.queries)]
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        builder = LocalSearchIndexBuilder()
+        builder.upload_documents(sections)
+        builder.save(path)
+        build_time = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+        start = time.perf_counter()
+        index = LocalSearchIndex.load(path)
+        load_time = time.perf_counter() - start
+        client = LocalSearchClient(index)
+
+        for q in queries[:args.checks]:
+            results = [(r["id"], r["@search.score"]) for r in client.search(q, top=args.top)]
+            expected = reference_search(sections, q, args.top)
+            if [key for key, _ in results] != [key for key, _ in expected] or any(abs(a[1] - b[1]) > 1e-5 * b[1] for a, b in zip(results, expected)):
+                print(f"Different results for '{q}': {results} != {expected}")
+                sys.exit(1)
+        print(f"{min(args.checks, len(queries))} queries: same results as the brute-force reference")
+
+        latencies = {"plain": [], "filter+captions": []}
+        for q in queries:
+            start = time.perf_counter()
+            list(client.search(q, top=args.top))
+            latencies["plain"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            list(client.search(q, top=args.top, filter="category ne 'handbook'", query_caption="extractive|highlight-false"))
+            latencies["filter+captions"].append(time.perf_counter() - start)
+        index.close()
+
+    print(f"{args.sections} sections: built in {build_time:.2f}s ({size / 1024 / 1024:.1f} MB), loaded in {load_time * 1000:.1f}ms")
+    for name, values in latencies.items():
+        print(f"\t{name}: p50 {percentile(values, 50) * 1000:.2f}ms, p95 {percentile(values, 95) * 1000:.2f}ms")
@@ -0,0 +1,124 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app", "backend"))
+from ingestion.textsplit import MAX_SECTION_LENGTH, SECTION_OVERLAP, SENTENCE_SEARCH_LIMIT, split_text
+
+# Micro-benchmark for split_text: checks that it produces the same sections as the original character by character
+# implementation (kept below as the reference), and compares their speed on synthetic documents with many pages.
+#
+# Example: python scripts/benchmarks/split_text.py --pages 2000
+
+def reference_split_text(page_map):
+    SENTENCE_ENDINGS = [".", "!", "?"]
+    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        l = len(page_map)
+        for i in range(l - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return l - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word
+        if end < length:
+            end += 1
+
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+WORDS = ["deductible", "coverage", "in-network", "plan", "employee", "benefit", "Northwind", "(see", "below)", "claims:",
+         "copay;", "prescription", "[1]", "{note}", "out-of-pocket", "a", "the", "of", "and", "visit"]
+
+def random_page(rnd, page_length):
+    text = ""
+    while len(text) < page_length:
+        kind = rnd.random()
+        if kind < 0.05:
+            # Cells hold a few words, like the tables rendered by prepdocs.table_to_html
+            cells = (" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 6))) for _ in range(rnd.randint(1, 80)))
+            text += "<table>" + "".join(f"<tr><td>{cell}</td><td>${rnd.randint(1, 5000)}</td></tr>" for cell in cells) + "</table>"
+        elif kind < 0.08:
+            # Long runs without sentence endings or word breaks
+            text += "x" * rnd.randint(50, 400)
+        else:
+            text += " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 30))) + rnd.choice([". ", "! ", "? ", "\n", "\t", " "])
+    return text
+
+def random_page_map(rnd, pages, page_length):
+    page_map = []
+    offset = 0
+    for page_num in range(pages):
+        page_text = "" if rnd.random() < 0.02 else random_page(rnd, rnd.randint(1, 2 * page_length))
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+def timed(f, page_map):
+    start = time.perf_counter()
+    sections = list(f(page_map))
+    return sections, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare split_text with the original implementation on synthetic documents")
+    parser.add_argument("--pages", type=int, default=1000, help="Number of pages of the large document")
+    parser.add_argument("--page-length", type=int, default=3000, help="Average number of characters per page")
+    parser.add_argument("--documents", type=int, default=200, help="Number of small random documents checked for identical output")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    for i in range(args.documents):
+        page_map = random_page_map(rnd, rnd.randint(0, 20), rnd.randint(1, 3000))
+        if list(split_text(page_map)) != list(reference_split_text(page_map)):
+            print(f"Different sections for document {i}")
+            sys.exit(1)
+    print(f"{args.documents} random documents: identical sections")
+
+    page_map = random_page_map(rnd, args.pages, args.page_length)
+    new_sections, new_time = timed(split_text, page_map)
+    reference_sections, reference_time = timed(reference_split_text, page_map)
+    if new_sections != reference_sections:
+        print("Different sections for the large document")
+        sys.exit(1)
+    print(f"{args.pages} pages, {len(page_map[-1][2]) + page_map[-1][1]} characters, {len(new_sections)} sections")
+    print(f"\treference: {reference_time:.3f}s")
+    print(f"\tsplit_text: {new_time:.3f}s ({reference_time / new_time:.1f}x)")
@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app", "backend"))
+from embeddings import HashingEmbedder
+from vectorstore import DTYPES, VectorStore, VectorStoreBuilder
+
+# Benchmark for the embedding store: builds float16 and int8 stores from random unit vectors, checks how many of the
+# exact float32 top results each one finds (recall), and measures query latency one query at a time and in batches.
+#
+# Example: python scripts/benchmarks/vector_search.py --sections 200000 --dimensions 1536
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure recall and latency of the embedding store on random vectors")
+    parser.add_argument("--sections", type=int, default=50000, help="Number of vectors in the store")
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=16, help="Number of queries scored together in the batched run")
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    def unit(n):
+        vectors = rng.normal(size=(n, args.dimensions)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    vectors = unit(args.sections)
+    queries = unit(args.queries)
+    # Queries close to some of the stored vectors, like real questions about the documents
+    queries = queries * 0.5 + vectors[rng.integers(0, args.sections, args.queries)]
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    exact = np.argsort(-(vectors @ queries.T), axis=0)[:args.top].T
+    sections = [{"id": f"section-{i:08}", "content": "", "sourcepage": "", "sourcefile": ""} for i in range(args.sections)]
+    embedder = HashingEmbedder(args.dimensions)
+
+    for dtype in DTYPES:
+        with tempfile.TemporaryDirectory() as path:
+            builder = VectorStoreBuilder(embedder.name, dtype=dtype)
+            builder.add(sections, vectors)
+            start = time.perf_counter()
+            builder.save(path)
+            save_time = time.perf_counter() - start
+            size = os.path.getsize(os.path.join(path, "vectors.npy"))
+            store = VectorStore.load(path, embedder)
+
+            single = []
+            results = []
+            for q in queries:
+                start = time.perf_counter()
+                results.append(store.search_vectors(q, args.top)[0])
+                single.append(time.perf_counter() - start)
+            recall = np.mean([len(set(row for row, _ in r) & set(e)) / args.top for r, e in zip(results, exact)])
+
+            start = time.perf_counter()
+            for i in range(0, len(queries), args.batch):
+                store.search_vectors(queries[i:i + args.batch], args.top)
+            batched = (time.perf_counter() - start) / len(queries)
+            del store
+
+        print(f"{dtype}: {size / 1024 / 1024:.1f} MB saved in {save_time:.2f}s, recall@{args.top} {recall:.3f}")
+        print(f"\tone query at a time: p50 {percentile(single, 50) * 1000:.2f}ms, p95 {percentile(single, 95) * 1000:.2f}ms")
+        print(f"\tbatches of {args.batch}: {batched * 1000:.2f}ms per query")
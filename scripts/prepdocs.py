@@ -1,22 +1,42 @@
 import os
 import argparse
 import glob
-import html
-import io
 import re
+import sys
+import threading
 import time
-from pypdf import PdfReader, PdfWriter
+import requests
+import openai
+from requests.adapters import HTTPAdapter
+from pypdf import PdfReader
 from azure.identity import AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import *
 from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
-MAX_SECTION_LENGTH = 1000
-SENTENCE_SEARCH_LIMIT = 100
-SECTION_OVERLAP = 100
+# The ingestion building blocks shared with the backend's /ingest endpoint live in app/backend/ingestion
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from ingestion.pipeline import IngestionPipeline, ParsedFile
+from ingestion.pages import PageUploader, delete_blobs, page_pdfs
+from ingestion.indexer import SectionIndexer
+from ingestion.manifest import IngestionManifest
+from ingestion.textsplit import split_text
+from ingestion.layout import layout_page_map
+from localsearch import LocalSearchIndexBuilder
+from embeddings import create_embedder
+from ingestion.embedding import BatchEmbedder, EmbeddingCache, MAX_BATCH_COUNT, MAX_BATCH_TOKENS
+from vectorstore import DTYPES, VectorStoreBuilder
+
+# remove_from_index gives up once the number of sections left hasn't gone down for this many seconds
+REMOVE_TIMEOUT = 120
+# Longest wait, in seconds, between checks for deleted sections to disappear from search results
+REMOVE_MAX_DELAY = 8
+# Number of section ids listed per query when removing sections, the most the search service returns at once
+REMOVE_PAGE_SIZE = 1000
 
 parser = argparse.ArgumentParser(
     description="Prepare documents by extracting content from PDFs, splitting content into sections, uploading to blob storage, and indexing in a search index.",
@@ -37,6 +57,21 @@ parser.add_argument("--removeall", action="store_true", help="Remove all blobs f
 parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
 parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
 parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--incremental", action="store_true", help="Optional. Only process files that changed since the last run, and remove sections and blobs of files that shrank or were deleted")
+parser.add_argument("--manifest", default=".prepdocs-manifest.json", help="Optional. File where --incremental keeps track of what was ingested (default: .prepdocs-manifest.json)")
+parser.add_argument("--workers", type=int, default=1, help="Optional. Number of processes extracting text and splitting documents into sections in parallel (threads when using Azure Form Recognizer)")
+parser.add_argument("--concurrency", type=int, default=1, help="Optional. Number of files uploaded to blob storage and indexed in parallel")
+parser.add_argument("--pageconcurrency", type=int, default=4, help="Optional. Number of page blobs of a file uploaded to blob storage (or batches of blobs removed) in parallel")
+parser.add_argument("--indexconcurrency", type=int, default=2, help="Optional. Number of batches of sections of a file sent to (or removed from) the search index in parallel")
+parser.add_argument("--localindex", required=False, help="Optional. Write the sections to a local search index in this directory (see LOCAL_SEARCH_INDEX in the backend) instead of Azure Cognitive Search")
+parser.add_argument("--embeddings", required=False, help="Optional. Also embed the sections and write them to an embedding store in this directory (see EMBEDDINGS_STORE in the backend), for hybrid keyword and vector retrieval")
+parser.add_argument("--embedder", default="hashing-256", help="Optional. Embedder used with --embeddings: hashing-<dimensions> for a local deterministic embedder, or openai:<deployment> for an Azure OpenAI embeddings deployment (default: hashing-256)")
+parser.add_argument("--embeddingstype", default="float16", choices=DTYPES, help="Optional. Element type of the stored embeddings, int8 takes half the memory of float16 (default: float16)")
+parser.add_argument("--embeddingscache", default=".prepdocs-embeddings.db", help="Optional. File where embeddings are cached by content, so unchanged sections aren't embedded again (default: .prepdocs-embeddings.db)")
+parser.add_argument("--embeddingsbatch", type=int, default=MAX_BATCH_COUNT, help=f"Optional. Maximum number of sections embedded per request (default: {MAX_BATCH_COUNT})")
+parser.add_argument("--embeddingsbatchtokens", type=int, default=MAX_BATCH_TOKENS, help=f"Optional. Maximum number of tokens embedded per request (default: {MAX_BATCH_TOKENS})")
+parser.add_argument("--openaiservice", required=False, help="Optional. Name of the Azure OpenAI service used by --embedder openai:<deployment>")
+parser.add_argument("--openaikey", required=False, help="Optional. Use this Azure OpenAI account key instead of the current user identity to login (use az login to set current user for Azure)")
 parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
 args = parser.parse_args()
 
@@ -52,6 +87,110 @@ if not args.localpdfparser:
         print("Error: Azure Form Recognizer service is not provided. Please provide formrecognizerservice or use --localpdfparser for local pypdf parser.")
         exit(1)
     formrecognizer_creds = default_creds if args.formrecognizerkey == None else AzureKeyCredential(args.formrecognizerkey)
+if args.embeddings and args.embedder.startswith("openai:"):
+    if args.openaiservice == None:
+        print("Error: Azure OpenAI service is not provided. Please provide openaiservice or use a hashing embedder.")
+        exit(1)
+    openai.api_base = f"https://{args.openaiservice}.openai.azure.com"
+    openai.api_version = "2022-12-01"
+    if args.openaikey == None:
+        openai.api_type = "azure_ad"
+        openai.api_key = azd_credential.get_token("https://cognitiveservices.azure.com/.default").token
+    else:
+        openai.api_type = "azure"
+        openai.api_key = args.openaikey
+
+# Builds each service client once and shares one pool of connections between them, instead of new clients (with new
+# TLS connections and credential lookups) for every file. The pool has room for all the requests the pipeline can have
+# in flight. Clients are built on first use in each process, worker processes build their own as connections can't be
+# shared with a forked process.
+class ServiceClients:
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        # Reentrant, clients can be built from other clients (the indexer from the search client)
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._session = None
+        self._clients = {}
+
+    def _get(self, name, create):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if name not in self._clients:
+                if self._session is None:
+                    self._session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    self._session.mount("https://", adapter)
+                self._clients[name] = create(RequestsTransport(session=self._session, session_owner=False))
+            return self._clients[name]
+
+    @property
+    def blob_container(self):
+        return self._get("blob", lambda transport: BlobServiceClient(
+            account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds, transport=transport
+            ).get_container_client(args.container))
+
+    # With --localindex sections go to a local index builder instead, it has the same methods used here
+    @property
+    def search_client(self):
+        if args.localindex:
+            return self._get("search", lambda transport: LocalSearchIndexBuilder(args.localindex))
+        return self._get("search", lambda transport: SearchClient(
+            endpoint=f"https://{args.searchservice}.search.windows.net/", index_name=args.index, credential=search_creds, transport=transport))
+
+    @property
+    def index_client(self):
+        return self._get("index", lambda transport: SearchIndexClient(
+            endpoint=f"https://{args.searchservice}.search.windows.net/", credential=search_creds, transport=transport))
+
+    @property
+    def form_recognizer_client(self):
+        return self._get("formrecognizer", lambda transport: DocumentAnalysisClient(
+            endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds,
+            headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"}, transport=transport))
+
+    @property
+    def embedder(self):
+        return self._get("embedder", lambda transport: BatchEmbedder(
+            create_embedder(args.embedder), EmbeddingCache(args.embeddingscache), args.embeddingsbatch, args.embeddingsbatchtokens, args.verbose))
+
+    @property
+    def vector_store(self):
+        return self._get("vectors", lambda transport: VectorStoreBuilder(args.embedder, args.embeddings, args.embeddingstype))
+
+    @property
+    def indexer(self):
+        search_client = self.search_client
+        return self._get("indexer", lambda transport: SectionIndexer(search_client, args.indexconcurrency, verbose=args.verbose))
+
+    def close(self):
+        with self._lock:
+            clients, session = self._clients, self._session
+            self._reset()
+        # The local index is written once, with everything added or removed during the run
+        if args.localindex and "search" in clients:
+            if args.verbose: print(f"Saving local search index to '{args.localindex}'")
+            clients["search"].save(args.localindex)
+        if args.embeddings and "vectors" in clients:
+            if args.verbose: print(f"Saving embedding store to '{args.embeddings}'")
+            clients["vectors"].save(args.embeddings)
+        for client in clients.values():
+            if hasattr(client, "close"):
+                client.close()
+        if session is not None:
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+clients = ServiceClients(pool_size=args.workers + args.concurrency * max(args.pageconcurrency, args.indexconcurrency))
 
 def blob_name_from_file_page(filename, page = 0):
     if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -59,64 +198,30 @@ def blob_name_from_file_page(filename, page = 0):
     else:
         return os.path.basename(filename)
 
-def upload_blobs(filename):
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
+def ensure_container():
+    blob_container = clients.blob_container
     if not blob_container.exists():
         blob_container.create_container()
 
-    # if file is PDF split into pages and upload each page as a separate blob
-    if os.path.splitext(filename)[1].lower() == ".pdf":
-        reader = PdfReader(filename)
-        pages = reader.pages
-        for i in range(len(pages)):
-            blob_name = blob_name_from_file_page(filename, i)
-            if args.verbose: print(f"\tUploading blob for page {i} -> {blob_name}")
-            f = io.BytesIO()
-            writer = PdfWriter()
-            writer.add_page(pages[i])
-            writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
-    else:
-        blob_name = blob_name_from_file_page(filename)
-        with open(filename,"rb") as data:
-            blob_container.upload_blob(blob_name, data, overwrite=True)
+def remove_blob_names(blob_names):
+    delete_blobs(clients.blob_container, blob_names, args.pageconcurrency, args.verbose)
 
 def remove_blobs(filename):
     if args.verbose: print(f"Removing blobs for '{filename or '<all>'}'")
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
+    blob_container = clients.blob_container
     if blob_container.exists():
         if filename == None:
             blobs = blob_container.list_blob_names()
         else:
             prefix = os.path.splitext(os.path.basename(filename))[0]
             blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
-        for b in blobs:
-            if args.verbose: print(f"\tRemoving blob {b}")
-            blob_container.delete_blob(b)
-
-def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
-    for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
-            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
-            cell_spans = ""
-            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
-            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
-
-def get_document_text(filename):
+        delete_blobs(blob_container, blobs, args.pageconcurrency, args.verbose)
+
+# reader is the PdfReader already opened on the file, the local parser extracts the text from it
+def get_document_text(filename, reader):
     offset = 0
     page_map = []
     if args.localpdfparser:
-        reader = PdfReader(filename)
         pages = reader.pages
         for page_num, p in enumerate(pages):
             page_text = p.extract_text()
@@ -124,104 +229,17 @@ def get_document_text(filename):
             offset += len(page_text)
     else:
         if args.verbose: print(f"Extracting text from '{filename}' using Azure Form Recognizer")
-        form_recognizer_client = DocumentAnalysisClient(endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"})
         with open(filename, "rb") as f:
-            poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
+            poller = clients.form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
         form_recognizer_results = poller.result()
 
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif not table_id in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
-            page_text += " "
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+        page_map = layout_page_map(form_recognizer_results)
 
     return page_map
 
-def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
-    if args.verbose: print(f"Splitting '{filename}' into sections")
-
-    def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if args.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-        
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
-
 def create_sections(filename, page_map):
-    for i, (section, pagenum) in enumerate(split_text(page_map)):
+    if args.verbose: print(f"Splitting '{filename}' into sections")
+    for i, (section, pagenum) in enumerate(split_text(page_map, args.verbose)):
         yield {
             "id": re.sub("[^0-9a-zA-Z_-]","_",f"{filename}-{i}"),
             "content": section,
@@ -232,8 +250,7 @@ def create_sections(filename, page_map):
 
 def create_search_index():
     if args.verbose: print(f"Ensuring search index {args.index} exists")
-    index_client = SearchIndexClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                     credential=search_creds)
+    index_client = clients.index_client
     if args.index not in index_client.list_index_names():
         index = SearchIndex(
             name=args.index,
@@ -257,59 +274,140 @@ def create_search_index():
 
 def index_sections(filename, sections):
     if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                    index_name=args.index,
-                                    credential=search_creds)
-    i = 0
-    batch = []
-    for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-            batch = []
-
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    clients.indexer.index(sections)
+
+def embed_sections(filename, sections):
+    if args.verbose: print(f"Embedding sections from '{filename}'")
+    clients.vector_store.add(sections, clients.embedder.embed([s["content"] for s in sections]))
+
+def remove_sections(section_ids):
+    clients.indexer.delete(section_ids)
+    if args.embeddings:
+        clients.vector_store.delete(section_ids)
 
+# Only the keys of the matching sections are retrieved, a page at a time, and they are deleted in parallel batches.
+# The same query runs again rather than skipping ahead (the service doesn't skip past 100,000 results). Deleted
+# sections can take a few seconds to disappear from search results, so when a page only has sections already deleted
+# it waits, backing off, until they're gone. It keeps going as long as the count of sections left goes down and stops
+# when it's zero or hasn't gone down for REMOVE_TIMEOUT seconds. Sections listed again after the longest wait are
+# deleted again, in case their deletion was lost.
 def remove_from_index(filename):
     if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                    index_name=args.index,
-                                    credential=search_creds)
+    search_client = clients.search_client
+    indexer = clients.indexer
+    filter = None if filename == None else f"sourcefile eq '{os.path.basename(filename)}'"
+    if args.embeddings:
+        clients.vector_store.remove(filter)
+
+    deleted = set()
+    remaining = None
+    delay = 0.5
+    progress_at = time.monotonic()
     while True:
-        filter = None if filename == None else f"sourcefile eq '{os.path.basename(filename)}'"
-        r = search_client.search("", filter=filter, top=1000, include_total_count=True)
-        if r.get_count() == 0:
-            break
-        r = search_client.delete_documents(documents=[{ "id": d["id"] } for d in r])
-        if args.verbose: print(f"\tRemoved {len(r)} sections from index")
-        # It can take a few seconds for search results to reflect changes, so wait a bit
-        time.sleep(2)
-
-if args.removeall:
-    remove_blobs(None)
-    remove_from_index(None)
-else:
-    if not args.remove:
-        create_search_index()
-    
-    print(f"Processing files...")
-    for filename in glob.glob(args.files):
-        if args.verbose: print(f"Processing '{filename}'")
-        if args.remove:
-            remove_blobs(filename)
-            remove_from_index(filename)
-        elif args.removeall:
+        r = search_client.search("", filter=filter, select=["id"], top=REMOVE_PAGE_SIZE, include_total_count=True)
+        section_ids = [d["id"] for d in r]
+        if not section_ids:
+            return
+        count = r.get_count()
+        if remaining is None or count < remaining:
+            progress_at = time.monotonic()
+            delay = 0.5
+        remaining = count
+        new_ids = [section_id for section_id in section_ids if section_id not in deleted]
+        if new_ids:
+            indexer.delete(new_ids)
+            deleted.update(new_ids)
+            continue
+        if time.monotonic() - progress_at > REMOVE_TIMEOUT:
+            print(f"Warning: {remaining} sections from '{filename or '<all>'}' are still in search index '{args.index}'")
+            return
+        if args.verbose: print(f"\t{remaining} sections still in the index")
+        if delay == REMOVE_MAX_DELAY:
+            deleted.difference_update(section_ids)
+        time.sleep(delay)
+        delay = min(delay * 2, REMOVE_MAX_DELAY)
+
+# Extracts the text, splits it into sections and splits PDFs into page blobs, runs on the pipeline's worker processes.
+# The PDF is only read once for both.
+def parse_file(filename):
+    if args.verbose: print(f"Processing '{filename}'")
+    is_pdf = os.path.splitext(filename)[1].lower() == ".pdf"
+    reader = PdfReader(filename) if is_pdf or args.localpdfparser else None
+    page_map = get_document_text(filename, reader)
+    pages = {}
+    if not args.skipblobs:
+        # if file is PDF split into pages and upload each page as a separate blob
+        if is_pdf:
+            pages = {blob_name_from_file_page(filename, i): data for i, data in enumerate(page_pdfs(reader))}
+        else:
+            with open(filename, "rb") as f:
+                pages = {blob_name_from_file_page(filename): f.read()}
+    return ParsedFile(list(create_sections(os.path.basename(filename), page_map)), pages)
+
+if __name__ == "__main__":
+    # Closes the shared clients and their connections once done
+    with clients:
+        if args.removeall:
             remove_blobs(None)
             remove_from_index(None)
+        elif args.remove:
+            print(f"Processing files...")
+            for filename in glob.glob(args.files):
+                if args.verbose: print(f"Processing '{filename}'")
+                remove_blobs(filename)
+                remove_from_index(filename)
         else:
+            if not args.localindex:
+                create_search_index()
+            if not args.skipblobs:
+                ensure_container()
+
+            filenames = glob.glob(args.files)
+            manifest = None
+            hashes = {}
+            if args.incremental:
+                # Only process files that changed since the last run and clean up after files that were removed
+                manifest = IngestionManifest(args.manifest, target=f"{args.storageaccount}/{args.container}/{args.localindex or f'{args.searchservice}/{args.index}'}")
+                for name in manifest.removed_files(filenames, args.files):
+                    if args.verbose: print(f"Removing '{name}'")
+                    remove_sections(manifest.sections(name))
+                    if not args.skipblobs:
+                        remove_blob_names(manifest.blobs(name))
+                    manifest.remove(name)
+                hashes = {filename: IngestionManifest.file_hash(filename, args.category or "") for filename in filenames}
+                filenames = [filename for filename in filenames if manifest.has_changed(filename, hashes[filename])]
+                if args.verbose: print(f"{len(filenames)} new or changed files")
+
             if not args.skipblobs:
-                upload_blobs(filename)
-            page_map = get_document_text(filename)
-            sections = create_sections(os.path.basename(filename), page_map)
-            index_sections(os.path.basename(filename), sections)
+                uploader = PageUploader(clients.blob_container, args.pageconcurrency, args.verbose)
+
+            def upload(filename, pages):
+                blobs = uploader.upload(pages)
+                if manifest:
+                    remove_blob_names(manifest.set_blobs(filename, blobs))
+
+            def index(filename, sections):
+                index_sections(os.path.basename(filename), sections)
+                if manifest:
+                    orphans = manifest.set_sections(filename, [s["id"] for s in sections])
+                    if orphans:
+                        remove_sections(orphans)
+
+            print(f"Processing files...")
+            pipeline = IngestionPipeline(
+                parse=parse_file,
+                upload=None if args.skipblobs else upload,
+                index=index,
+                embed=(lambda filename, sections: embed_sections(os.path.basename(filename), sections)) if args.embeddings else None,
+                workers=args.workers,
+                concurrency=args.concurrency,
+                # Form Recognizer does the heavy lifting remotely, threads are enough to overlap the calls
+                use_processes=args.localpdfparser,
+                done=lambda filename: manifest.set_hash(filename, hashes[filename]) if manifest else None)
+            try:
+                pipeline.run(filenames)
+            finally:
+                if manifest:
+                    manifest.save()
+                if args.embeddings:
+                    print(f"Embeddings: {clients.embedder.summary()}")
@@ -0,0 +1,53 @@
+import importlib
+import os
+import sys
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# The backend and scripts aren't packages, their modules import each other by name
+sys.path[:0] = [os.path.join(ROOT, "app", "backend"), os.path.join(ROOT, "scripts")]
+
+# Async SearchClient returning the same documents for any query, and recording the queries
+class FakeAsyncSearchClient:
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = []
+
+    async def search(self, q, **kwargs):
+        self.queries.append((q, kwargs))
+        documents = self.documents[:kwargs.get("top") or len(self.documents)]
+        async def results():
+            for doc in documents:
+                yield dict(doc)
+        return results()
+
+# Replaces openai.Completion.acreate: the answer to a prompt is the first value of answers (a function of the prompt)
+# that it contains, streamed a word at a time when asked to. The prompts are recorded in the fixture's prompts list.
+@pytest.fixture
+def completions(monkeypatch):
+    prompts = []
+    answers = {}
+    async def acreate(prompt, stream=False, **kwargs):
+        prompts.append(prompt)
+        text = next((answer for key, answer in answers.items() if key in prompt), "answer")
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(text=text)])
+        async def chunks():
+            for i, word in enumerate(text.split(" ")):
+                yield SimpleNamespace(choices=[SimpleNamespace(text=word if i == 0 else " " + word)])
+        return chunks()
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+    return SimpleNamespace(prompts=prompts, answers=answers)
+
+# The web app, importing it doesn't connect to any service. The approaches and clients created when it starts
+# serving are left for the tests to set.
+@pytest.fixture
+def backend(monkeypatch):
+    # Keys rather than the current user identity, so the app can be imported without signing in
+    monkeypatch.setenv("AZURE_OPENAI_KEY", "fake")
+    monkeypatch.setenv("AZURE_SEARCH_KEY", "fake")
+    return importlib.import_module("app")
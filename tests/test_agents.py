@@ -0,0 +1,176 @@
+import os
+import re
+import threading
+import time
+
+import openai
+import pytest
+
+from conftest import ROOT
+from benchmarks.fakeservices import build_index, complete, synthetic_sections
+from approaches.readdecomposeask import ParallelReActOutputParser, ReadDecomposeAsk
+from approaches.readretrieveread import ReadRetrieveReadApproach
+from langchainadapters import PARTIAL_ANSWER, RETRY_MIN_WAIT
+from localsearch import LocalSearchClient
+
+# Replaces openai.Completion.create (the agents' LLM calls it on a worker thread) with the completions of the fake
+# OpenAI service, each taking delay seconds. The prompts are recorded.
+class FakeCompletions:
+    def __init__(self):
+        self.prompts = []
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def create(self, prompt, stop=None, **kwargs):
+        prompt = prompt[0] if isinstance(prompt, list) else prompt
+        with self._lock:
+            self.prompts.append(prompt)
+        time.sleep(self.delay)
+        text = complete(prompt)
+        for s in stop or []:
+            text = text.split(s)[0]
+        return {"choices": [{"text": text, "index": 0, "finish_reason": "stop", "logprobs": None}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+
+@pytest.fixture
+def completions(monkeypatch):
+    fake = FakeCompletions()
+    monkeypatch.setattr(openai, "api_key", "fake")
+    monkeypatch.setattr(openai.Completion, "create", fake.create)
+    return fake
+
+# LocalSearchClient over synthetic sections, recording the queries and how many searches run at the same time
+class RecordingSearchClient(LocalSearchClient):
+    def __init__(self, index, delay=0.0):
+        super().__init__(index)
+        self.delay = delay
+        self.queries = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def search(self, search_text=None, **kwargs):
+        with self._lock:
+            self.queries.append(search_text)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            return super().search(search_text, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+@pytest.fixture
+def search_client(tmp_path):
+    index = build_index(str(tmp_path), synthetic_sections(60))
+    yield RecordingSearchClient(index)
+    index.close()
+
+# ReadRetrieveReadApproach's employee tool reads data/employeeinfo.csv from the backend's directory
+@pytest.fixture
+def backend_dir(monkeypatch):
+    monkeypatch.chdir(os.path.join(ROOT, "app", "backend"))
+
+def test_agents_are_built_once_per_prompt_and_temperature(completions, search_client, backend_dir):
+    rda = ReadDecomposeAsk(search_client, "davinci", "sourcepage", "content")
+    assert rda.agent({}) is rda.agent({"top": 5})
+    assert rda.agent({"temperature": 0.5}) is not rda.agent({})
+    rrr = ReadRetrieveReadApproach(search_client, "davinci", "sourcepage", "content")
+    assert rrr.agent({}) is rrr.agent({"semantic_captions": False})
+    assert rrr.agent({"prompt_template_prefix": "Other"}) is not rrr.agent({})
+
+def test_concurrent_runs_of_a_shared_agent_keep_their_own_results(completions, search_client, backend_dir):
+    rrr = ReadRetrieveReadApproach(search_client, "davinci", "sourcepage", "content")
+    search_client.delay = 0.05
+    questions = ["copay", "dental coverage", "paid time off", "vision coverage"]
+    responses = {}
+    def ask(q):
+        responses[q] = rrr.run(q, {"top": 2})
+    threads = [threading.Thread(target=ask, args=(q,)) for q in questions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert search_client.max_running > 1
+    assert len(rrr.agents) == 1
+    for q in questions:
+        expected = [doc["sourcepage"] + ":" for doc in search_client.search(q, top=2)]
+        r = responses[q]
+        assert [p[:len(e)] for p, e in zip(r["data_points"], expected)] == expected
+        assert re.findall(r"Action Input: ([^<]*)", r["thoughts"]) == [q]
+        assert r["answer"]
+
+def test_parallel_mode_searches_independent_parts_in_one_step(completions, search_client):
+    search_client.delay = 0.1
+    rda = ReadDecomposeAsk(search_client, "davinci", "sourcepage", "content")
+    serial = rda.run("copay and deductible", {"top": 2})
+    serial_completions = len(completions.prompts)
+    completions.prompts.clear()
+    search_client.max_running = 0
+
+    r = rda.run("copay and deductible", {"top": 2, "parallel_search": True})
+
+    # Search[copay] | Search[deductible], then the Lookup[copay] started along with them, then Finish
+    assert (serial_completions, len(completions.prompts)) == (4, 3)
+    assert search_client.max_running > 1
+    assert len(r["data_points"]) == 4
+    assert r["answer"] == serial["answer"]
+
+def test_parallel_actions_are_parsed_into_one_step():
+    parser = ParallelReActOutputParser()
+    actions = parser.parse("Thought: independent.\nAction: Search[a] | Lookup[b]")
+    assert [(a.tool, a.tool_input) for a in actions] == [("Search", "a"), ("Lookup", "b")]
+    assert parser.parse("Thought: one.\nAction: Search[a]").tool_input == "a"
+    assert parser.parse("Thought: done.\nAction: Finish[yes <a.pdf>]").return_values == {"output": "yes <a.pdf>"}
+
+def test_step_budget_answers_from_the_steps_taken(completions, search_client):
+    rda = ReadDecomposeAsk(search_client, "davinci", "sourcepage", "content")
+    r = rda.run("copay and deductible", {"top": 2, "max_steps": 1})
+    # One step, then one completion asked to answer from it, which still wants to search
+    assert len(completions.prompts) == 2
+    assert "I now need to return a final answer" in completions.prompts[-1]
+    assert r["answer"] == PARTIAL_ANSWER
+    assert len(r["data_points"]) == 2
+
+    completions.prompts.clear()
+    r = rda.run("copay", {"top": 2, "max_steps": 1})
+    assert len(completions.prompts) == 2
+    assert r["answer"] != PARTIAL_ANSWER and r["answer"].endswith("]")
+
+def test_agent_stops_before_a_step_that_would_miss_the_deadline(completions, search_client):
+    completions.delay = 0.3
+    rda = ReadDecomposeAsk(search_client, "davinci", "sourcepage", "content", max_seconds=30)
+    start = time.monotonic()
+    r = rda.run("copay and deductible", {"top": 2, "max_seconds": 0.5})
+    # Another step (or an answer from the first one) would take longer than what's left
+    assert time.monotonic() - start < 1
+    assert len(completions.prompts) == 1
+    assert r["answer"] == PARTIAL_ANSWER
+    assert len(r["data_points"]) == 2
+
+def test_completions_are_given_the_time_left(completions, search_client, backend_dir, monkeypatch):
+    timeouts = []
+    create = completions.create
+    def create_with_timeout(request_timeout=None, **kwargs):
+        timeouts.append(request_timeout)
+        return create(**kwargs)
+    monkeypatch.setattr(openai.Completion, "create", create_with_timeout)
+    rrr = ReadRetrieveReadApproach(search_client, "davinci", "sourcepage", "content", max_seconds=5)
+    rrr.run("copay", {"max_seconds": 20})
+    assert len(timeouts) == 2
+    assert all(0 < timeout <= 5 for timeout in timeouts)
+
+def test_failed_completion_close_to_the_deadline_is_not_retried(completions, search_client, backend_dir, monkeypatch):
+    def throttled(**kwargs):
+        completions.prompts.append(kwargs["prompt"])
+        raise openai.error.RateLimitError("Rate limit exceeded")
+    monkeypatch.setattr(openai.Completion, "create", throttled)
+    rrr = ReadRetrieveReadApproach(search_client, "davinci", "sourcepage", "content")
+    start = time.monotonic()
+    r = rrr.run("copay", {"max_seconds": 2})
+    # Langchain would wait RETRY_MIN_WAIT seconds before trying again
+    assert time.monotonic() - start < RETRY_MIN_WAIT
+    assert len(completions.prompts) == 1
+    assert r["answer"] == PARTIAL_ANSWER
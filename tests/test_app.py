@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+from conftest import FakeAsyncSearchClient
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.retrievethenread import RetrieveThenReadApproach
+from blobcache import BlobDiskCache
+
+DOCUMENTS = [{"sourcepage": f"benefits-{i}.pdf", "content": f"Benefit {i} is covered."} for i in range(3)]
+
+def post(backend, path, body):
+    async def send():
+        response = await backend.app.test_client().post(path, json=body)
+        return response.status_code, response.mimetype, (await response.get_data()).decode("utf-8")
+    return asyncio.run(send())
+
+def test_ask_streams_ndjson(backend, completions, monkeypatch):
+    completions.answers["Sources:"] = "Benefit 0 is covered [benefits-0.pdf]"
+    monkeypatch.setitem(backend.ask_approaches, "rtr", RetrieveThenReadApproach(FakeAsyncSearchClient(DOCUMENTS), "davinci", "sourcepage", "content"))
+
+    status, mimetype, body = post(backend, "/ask", {"approach": "rtr", "question": "Is benefit 0 covered?", "stream": True})
+
+    assert (status, mimetype) == (200, "application/x-ndjson")
+    assert body.endswith("\n")
+    events = [json.loads(line) for line in body.splitlines()]
+    assert events[0] == {"data_points": [f"benefits-{i}.pdf: Benefit {i} is covered." for i in range(3)]}
+    assert all(list(event) == ["answer"] for event in events[1:-2]) and len(events) > 4
+    assert "".join(event["answer"] for event in events[1:-2]) == "Benefit 0 is covered [benefits-0.pdf]"
+    assert "thoughts" in events[-2]
+    assert "total_ms" in events[-1]["timings"]
+
+def test_chat_streams_follow_up_questions_last(backend, completions, monkeypatch):
+    completions.answers["Search query:"] = "benefit 0"
+    completions.answers["Sources:"] = "It's covered [benefits-0.pdf] <<Is benefit 1 covered?>>"
+    approach = ChatReadRetrieveReadApproach(FakeAsyncSearchClient(DOCUMENTS), "chat", "davinci", "sourcepage", "content")
+    monkeypatch.setitem(backend.chat_approaches, "rrr", approach)
+
+    status, _, body = post(backend, "/chat", {"approach": "rrr", "history": [{"user": "Is benefit 0 covered?"}], "stream": True})
+
+    events = [json.loads(line) for line in body.splitlines()]
+    assert status == 200
+    assert "".join(event.get("answer", "") for event in events) == "It's covered [benefits-0.pdf] <<Is benefit 1 covered?>>"
+    assert events[-2]["follow_up_questions"] == ["Is benefit 1 covered?"]
+
+def test_errors_while_streaming_are_sent_as_a_last_line(backend, completions, monkeypatch):
+    class FailingSearchClient:
+        async def search(self, q, **kwargs):
+            raise RuntimeError("search failed")
+    monkeypatch.setitem(backend.ask_approaches, "rtr", RetrieveThenReadApproach(FailingSearchClient(), "davinci", "sourcepage", "content"))
+
+    status, _, body = post(backend, "/ask", {"approach": "rtr", "question": "Is benefit 0 covered?", "stream": True})
+
+    assert status == 200
+    assert [json.loads(line) for line in body.splitlines()] == [{"error": "search failed"}]
+
+def test_ask_without_stream_returns_one_json_object(backend, completions, monkeypatch):
+    monkeypatch.setitem(backend.ask_approaches, "rtr", RetrieveThenReadApproach(FakeAsyncSearchClient(DOCUMENTS), "davinci", "sourcepage", "content"))
+
+    status, mimetype, body = post(backend, "/ask", {"approach": "rtr", "question": "Is benefit 0 covered?"})
+
+    assert (status, mimetype) == (200, "application/json")
+    assert json.loads(body)["answer"] == "answer"
+
+# Blob container holding the given blobs, downloads are sent 4 bytes at a time and recorded
+class FakeBlobContainer:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.downloads = []
+
+    def get_blob_client(self, path):
+        return FakeBlobClient(self, path)
+
+class FakeBlobClient:
+    def __init__(self, container, path):
+        self.container = container
+        self.path = path
+
+    async def get_blob_properties(self):
+        if self.path not in self.container.blobs:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return SimpleNamespace(etag='"1"', size=len(self.container.blobs[self.path]),
+                               content_settings=SimpleNamespace(content_type="application/pdf"))
+
+    async def download_blob(self, offset, length, **kwargs):
+        self.container.downloads.append((self.path, offset, length))
+        data = self.container.blobs[self.path][offset:offset + length]
+        async def chunks():
+            for i in range(0, len(data), 4):
+                yield data[i:i + 4]
+        return SimpleNamespace(chunks=chunks)
+
+BLOB = b"0123456789abcdefghij"
+
+@pytest.fixture
+def blobs(backend, monkeypatch):
+    container = FakeBlobContainer({"a.pdf": BLOB})
+    monkeypatch.setattr(backend, "async_blob_container", container)
+    monkeypatch.setattr(backend, "content_cache", None)
+    return container
+
+def get(backend, path, headers=None):
+    async def send():
+        response = await backend.app.test_client().get(path, headers=headers or {})
+        return response.status_code, response.headers, await response.get_data()
+    return asyncio.run(send())
+
+def test_content_is_sent_whole_with_its_etag(backend, blobs):
+    status, headers, body = get(backend, "/content/a.pdf")
+    assert (status, body) == (200, BLOB)
+    assert (headers["ETag"], headers["Accept-Ranges"], headers["Content-Length"]) == ('"1"', "bytes", "20")
+    assert headers["Content-Type"] == "application/pdf"
+    assert get(backend, "/content/missing.pdf")[0] == 404
+
+@pytest.mark.parametrize("if_none_match", ['"1"', '"0", "1"', "*"])
+def test_content_not_modified(backend, blobs, if_none_match):
+    status, headers, body = get(backend, "/content/a.pdf", {"If-None-Match": if_none_match})
+    assert (status, body, headers["ETag"]) == (304, b"", '"1"')
+    assert blobs.downloads == []
+
+def test_content_modified(backend, blobs):
+    assert get(backend, "/content/a.pdf", {"If-None-Match": '"0"'})[::2] == (200, BLOB)
+
+@pytest.mark.parametrize("range, content_range, body", [
+    ("bytes=2-5", "bytes 2-5/20", BLOB[2:6]),
+    ("bytes=15-", "bytes 15-19/20", BLOB[15:]),
+    ("bytes=-3", "bytes 17-19/20", BLOB[17:]),
+    ("bytes=18-100", "bytes 18-19/20", BLOB[18:]),
+])
+def test_content_range(backend, blobs, range, content_range, body):
+    status, headers, data = get(backend, "/content/a.pdf", {"Range": range})
+    assert (status, headers["Content-Range"], headers["Content-Length"], data) == (206, content_range, str(len(body)), body)
+    assert blobs.downloads == [("a.pdf", 20 - len(body) if range.startswith("bytes=-") else int(range[6:].split("-")[0]), len(body))]
+
+# Invalid, multiple or stale ranges are ignored and the whole content is sent
+@pytest.mark.parametrize("headers", [{"Range": "bytes=5-2"}, {"Range": "bytes=x-y"}, {"Range": "bytes=0-1,4-5"},
+                                     {"Range": "items=0-1"}, {"Range": "bytes=0-1", "If-Range": '"0"'}])
+def test_content_range_ignored(backend, blobs, headers):
+    status, response_headers, body = get(backend, "/content/a.pdf", headers)
+    assert (status, body) == (200, BLOB)
+    assert "Content-Range" not in response_headers
+
+def test_content_range_not_satisfiable(backend, blobs):
+    status, headers, body = get(backend, "/content/a.pdf", {"Range": "bytes=20-"})
+    assert (status, headers["Content-Range"], body) == (416, "bytes */20", b"")
+    assert blobs.downloads == []
+
+def test_content_is_served_from_the_cache_once_downloaded_whole(backend, blobs, tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, "content_cache", BlobDiskCache(str(tmp_path), 1000))
+    assert get(backend, "/content/a.pdf", {"Range": "bytes=0-3"})[::2] == (206, BLOB[:4])
+    assert get(backend, "/content/a.pdf")[::2] == (200, BLOB)
+    assert get(backend, "/content/a.pdf")[::2] == (200, BLOB)
+    assert get(backend, "/content/a.pdf", {"Range": "bytes=4-7"})[::2] == (206, BLOB[4:8])
+    assert blobs.downloads == [("a.pdf", 0, 4), ("a.pdf", 0, 20)]
+
+def test_content_file_downloads_blob_evicted_before_it_was_opened(backend, blobs, tmp_path, monkeypatch):
+    cache = BlobDiskCache(str(tmp_path), 1000)
+    monkeypatch.setattr(backend, "content_cache", cache)
+    assert get(backend, "/content/a.pdf")[::2] == (200, BLOB)
+    real_open = cache.open
+    def open_after_eviction(name, etag):
+        os.remove(cache.path(name, etag))
+        return real_open(name, etag)
+    monkeypatch.setattr(cache, "open", open_after_eviction)
+
+    assert get(backend, "/content/a.pdf")[::2] == (200, BLOB)
+    assert len(blobs.downloads) == 2
+    with real_open("a.pdf", '"1"') as f:
+        assert f.read() == BLOB
+
+def test_unfinished_downloads_are_not_cached(backend, blobs, tmp_path, monkeypatch):
+    cache = BlobDiskCache(str(tmp_path), 1000)
+    monkeypatch.setattr(backend, "content_cache", cache)
+    async def disconnect(chunks):
+        async with backend.app.test_request_context("/content/a.pdf"):
+            response = await backend.content_file("a.pdf")
+        # The body is closed when the client goes away, after some chunks or before the first one
+        async with response.response as body:
+            body = body.__aiter__()
+            for _ in range(chunks):
+                await body.__anext__()
+    asyncio.run(disconnect(0))
+    asyncio.run(disconnect(2))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,50 @@
+from conftest import FakeAsyncSearchClient
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.retrievethenread import RetrieveThenReadApproach
+from cache import TTLCache
+
+DOCUMENTS = [{"sourcepage": f"benefits-{i}.pdf", "content": f"Benefit {i} is covered."} for i in range(3)]
+
+def test_retrieve_then_read_can_be_run_synchronously(completions):
+    completions.answers["Benefit 0"] = "It's covered [benefits-0.pdf]"
+    approach = RetrieveThenReadApproach(FakeAsyncSearchClient(DOCUMENTS), "davinci", "sourcepage", "content")
+
+    r = approach.run("Is benefit 0 covered?", {})
+
+    assert r["answer"] == "It's covered [benefits-0.pdf]"
+    assert r["data_points"] == [f"benefits-{i}.pdf: Benefit {i} is covered." for i in range(3)]
+
+def test_chat_read_retrieve_read_can_be_run_synchronously(completions):
+    completions.answers["Search query:"] = "benefit 0 coverage"
+    completions.answers["Sources:"] = "It's covered [benefits-0.pdf]"
+    search_client = FakeAsyncSearchClient(DOCUMENTS)
+    approach = ChatReadRetrieveReadApproach(search_client, "chat", "davinci", "sourcepage", "content")
+
+    r = approach.run([{"user": "Is benefit 0 covered?"}], {})
+
+    assert r["answer"] == "It's covered [benefits-0.pdf]"
+    assert search_client.queries[0][0] == "benefit 0 coverage"
+    assert len(r["data_points"]) == 3
+
+def query_rewrites(completions):
+    return [prompt for prompt in completions.prompts if "Search query:" in prompt]
+
+def test_chat_query_rewrite_is_memoized(completions):
+    completions.answers["Search query:"] = "benefit 0 coverage"
+    approach = ChatReadRetrieveReadApproach(FakeAsyncSearchClient(DOCUMENTS), "chat", "davinci", "sourcepage", "content",
+                                            query_cache=TTLCache())
+
+    approach.run([{"user": "Is benefit 0 covered?"}], {})
+    approach.run([{"user": "is  BENEFIT 0 covered?"}], {"temperature": 0.1})
+    assert len(query_rewrites(completions)) == 1
+
+    approach.run([{"user": "Is benefit 0 covered?", "bot": "Yes"}, {"user": "Is benefit 0 covered?"}], {})
+    approach.run([{"user": "Is benefit 1 covered?"}], {})
+    assert len(query_rewrites(completions)) == 3
+
+def test_chat_query_rewrite_without_cache(completions):
+    approach = ChatReadRetrieveReadApproach(FakeAsyncSearchClient(DOCUMENTS), "chat", "davinci", "sourcepage", "content")
+    approach.run([{"user": "Is benefit 0 covered?"}], {})
+    approach.run([{"user": "Is benefit 0 covered?"}], {})
+    assert len(query_rewrites(completions)) == 2
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from blobcache import BlobDiskCache
+
+
+def put(cache, name, etag, data):
+    writer = cache.writer(name, etag)
+    writer.write(data)
+    writer.commit()
+
+
+def test_evicted_entry_is_a_cache_miss(tmp_path):
+    cache = BlobDiskCache(str(tmp_path), 1000)
+    put(cache, "a.pdf", '"1"', b"a" * 10)
+    os.remove(cache.path("a.pdf", '"1"'))
+    assert cache.open("a.pdf", '"1"') is None
+
+
+def test_entry_evicted_while_served_stays_readable(tmp_path):
+    cache = BlobDiskCache(str(tmp_path), 100, max_entry_bytes=100)
+    put(cache, "a.pdf", '"1"', b"a" * 80)
+    with cache.open("a.pdf", '"1"') as f:
+        # Pushes a.pdf out of the cache while it's open
+        put(cache, "b.pdf", '"1"', b"b" * 80)
+        assert not os.path.exists(cache.path("a.pdf", '"1"'))
+        assert f.read() == b"a" * 80
+    assert cache.open("a.pdf", '"1"') is None
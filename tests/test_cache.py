@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+from conftest import FakeAsyncSearchClient
+
+import cache
+from cache import TTLCache
+from retrieval import RetrievalCache, asearch, search
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+def test_entries_expire_after_their_ttl(clock):
+    c = TTLCache(maxsize=10, ttl=60)
+    c.put("a", 1)
+    c.put("b", 2, ttl=10)
+    clock[0] += 30
+    assert (c.get("a"), c.get("b")) == (1, None)
+    clock[0] += 31
+    assert c.get("a") is None
+    assert c.stats()["evictions"] == 2
+    assert len(c) == 0
+
+def test_least_recently_used_entries_go_first(clock):
+    c = TTLCache(maxsize=2, ttl=60)
+    c.put("a", 1)
+    c.put("b", 2)
+    c.get("a")
+    c.put("c", 3)
+    assert (c.get("a"), c.get("b"), c.get("c")) == (1, None, 3)
+
+def test_zero_size_cache_keeps_nothing(clock):
+    c = TTLCache(maxsize=0)
+    c.put("a", 1)
+    assert c.get("a") is None
+
+def test_changed_index_version_clears_the_cache(clock):
+    c = RetrievalCache()
+    c.set_index_version((1, 100))
+    c.put("q", ["doc"])
+    c.set_index_version((1, 100))
+    assert c.get("q") == ["doc"]
+    c.set_index_version((2, 120))
+    assert c.get("q") is None
+
+class CountingSearchClient:
+    def __init__(self):
+        self.queries = []
+
+    def search(self, q, **kwargs):
+        self.queries.append(q)
+        return iter([{"id": q}])
+
+def test_searches_differing_in_case_and_spaces_share_results(clock):
+    c = RetrievalCache()
+    client = CountingSearchClient()
+    assert search(client, "Overlake  deductible", {}, c) == [{"id": "Overlake  deductible"}]
+    assert search(client, "overlake deductible", {}, c) == [{"id": "Overlake  deductible"}]
+    search(client, "overlake deductible", {"top": 5}, c)
+    search(client, "overlake deductible", {"exclude_category": "x"}, c)
+    assert len(client.queries) == 3
+
+def test_sync_and_async_searches_share_the_cache(clock):
+    c = RetrievalCache()
+    client = FakeAsyncSearchClient([{"id": "1"}])
+    first = asyncio.run(asearch(client, "deductible", {}, c))
+    assert search(CountingSearchClient(), "deductible", {}, c) == first
+    assert len(client.queries) == 1
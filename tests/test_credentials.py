@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+
+from azure.core.credentials import AccessToken
+
+from credentials import AsyncTokenRefresher, TokenRefresher
+
+# Credential handing out numbered tokens valid for lifetime seconds, optionally failing or waiting on a gate first
+class FakeCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = []
+        self.fail = False
+        self.gate = None
+
+    def get_token(self, *scopes, **kwargs):
+        self.calls.append((scopes, kwargs))
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.fail:
+            raise RuntimeError("Azure AD unavailable")
+        return AccessToken(f"token-{len(self.calls)}", int(time.time() + self.lifetime))
+
+def test_tokens_are_cached_until_they_are_about_to_expire():
+    credential = FakeCredential()
+    refresher = TokenRefresher(credential)
+    assert refresher.get_token("scope").token == "token-1"
+    assert refresher.get_token("scope").token == "token-1"
+    assert refresher.get_token("other").token == "token-2"
+    # Tokens valid for less than min_validity seconds aren't handed out
+    credential.lifetime = refresher.min_validity - 1
+    refresher._tokens = {("scope",): AccessToken("old", int(time.time() + 10))}
+    assert refresher.get_token("scope").token == "token-3"
+
+def test_claims_challenges_are_not_cached():
+    credential = FakeCredential()
+    refresher = TokenRefresher(credential)
+    refresher.get_token("scope")
+    assert refresher.get_token("scope", claims="c").token == "token-2"
+    assert refresher.get_token("scope").token == "token-1"
+
+def test_concurrent_requests_share_one_renewal():
+    credential = FakeCredential()
+    credential.gate = threading.Event()
+    refresher = TokenRefresher(credential)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(refresher.get_token("scope").token)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    credential.gate.set()
+    for thread in threads:
+        thread.join()
+    assert tokens == ["token-1"] * 8
+    assert len(credential.calls) == 1
+
+def test_background_thread_renews_ahead_of_expiry_and_notifies():
+    credential = FakeCredential(lifetime=2)
+    renewed = threading.Event()
+    seen = []
+    def listener(token):
+        seen.append(token.token)
+        if len(seen) > 1:
+            renewed.set()
+    with TokenRefresher(credential, refresh_margin=600) as refresher:
+        refresher.min_validity = 0
+        refresher.subscribe("scope", listener)
+        refresher.start("scope")
+        # Short lived tokens are renewed half way through their lifetime, the requests keep getting a valid one
+        assert renewed.wait(5)
+        assert refresher.get_token("scope").token == seen[-1]
+    assert seen[:2] == ["token-1", "token-2"]
+
+def test_failed_renewal_keeps_the_current_token():
+    credential = FakeCredential()
+    refresher = TokenRefresher(credential, retry_interval=30)
+    refresher.get_token("scope")
+    refresher._refresh_at[("scope",)] = time.time() - 1
+    credential.fail = True
+    refresher._refresh_ahead(("scope",))
+    assert refresher.get_token("scope").token == "token-1"
+    assert refresher._refresh_at[("scope",)] > time.time() + 20
+
+def test_async_credential_uses_the_cached_token():
+    credential = FakeCredential()
+    refresher = TokenRefresher(credential)
+
+    async def get():
+        async with AsyncTokenRefresher(refresher) as async_credential:
+            return [(await async_credential.get_token("scope")).token for _ in range(3)]
+
+    assert asyncio.run(get()) == ["token-1"] * 3
+    assert len(credential.calls) == 1
@@ -0,0 +1,51 @@
+import numpy as np
+
+from embeddings import HashingEmbedder
+from ingestion.embedding import BatchEmbedder, EmbeddingCache
+
+# HashingEmbedder recording the texts of each call
+class CountingEmbedder(HashingEmbedder):
+    def __init__(self):
+        super().__init__(32)
+        self.calls = []
+
+    def embed(self, texts):
+        self.calls.append(list(texts))
+        return super().embed(texts)
+
+def test_duplicates_are_embedded_once_and_batches_are_bounded():
+    embedder = CountingEmbedder()
+    batcher = BatchEmbedder(embedder, max_batch_count=2, max_batch_tokens=5, verbose=False)
+    texts = ["one two", "three four", "one two", "five six seven eight", "nine"]
+    vectors = batcher.embed(texts)
+    assert vectors.shape == (5, 32)
+    assert np.allclose(vectors, HashingEmbedder(32).embed(texts))
+    assert embedder.calls == [["one two", "three four"], ["five six seven eight", "nine"]]
+    assert batcher.summary().startswith("5 sections: 4 embedded")
+    assert batcher.embed([]).shape == (0, 32)
+
+def test_cached_embeddings_are_reused_across_runs(tmp_path):
+    path = str(tmp_path / "embeddings.db")
+    first = BatchEmbedder(CountingEmbedder(), EmbeddingCache(path), verbose=False)
+    expected = first.embed(["alpha", "beta"])
+    first.close()
+
+    embedder = CountingEmbedder()
+    second = BatchEmbedder(embedder, EmbeddingCache(path), verbose=False)
+    try:
+        vectors = second.embed(["beta", "gamma", "alpha"])
+        assert embedder.calls == [["gamma"]]
+        assert np.allclose(vectors[0], expected[1])
+        assert np.allclose(vectors[2], expected[0])
+        assert second.cached == 2
+    finally:
+        second.close()
+
+def test_cache_is_keyed_on_the_embedder(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.db"))
+    try:
+        cache.put("hashing-32", {"h": np.ones(32, dtype=np.float32)})
+        assert list(cache.get("hashing-32", ["h", "other"])) == ["h"]
+        assert cache.get("openai:ada", ["h"]) == {}
+    finally:
+        cache.close()
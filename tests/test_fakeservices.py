@@ -0,0 +1,46 @@
+import asyncio
+import ssl
+
+import aiohttp
+
+from benchmarks.fakeservices import FakeServices, Profile, build_index, complete, synthetic_sections
+
+def test_completions_follow_the_prompt_format():
+    assert complete("Question:\nWhat is the copay for vision coverage?\n\nSearch query:\n") == "What is the copay for vision coverage"
+    answer = complete("Sources:\ninfo1.txt: The deductible is $500.\ninfo2.pdf: Overlake is in-network.\n\nAnswer:\n", answer_words=10)
+    assert answer.endswith("[info1.txt][info2.pdf]")
+    # Each cited source contributes its first words
+    assert answer.startswith("The deductible is Overlake is in-network.")
+    react = complete("Action: Finish[yes]\n\nQuestion: copay and deductible\n")
+    assert react.endswith("Action: Search[copay]")
+    mrkl = complete("Action Input: the input\n\nQuestion: copay\nThought:")
+    assert "Action: CognitiveSearch\nAction Input: copay" in mrkl
+
+def test_services_answer_over_http_and_fail_per_profile(tmp_path):
+    index = build_index(str(tmp_path / "index"), synthetic_sections(30))
+    services = FakeServices(index, openai_profile=Profile(error_rate=1.0))
+
+    async def run():
+        openai_url, search_url, cert_path = await services.start(str(tmp_path))
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"{openai_url}/openai/deployments/davinci/completions", json={"prompt": "Sources:\n"}) as response:
+                    throttled = response.status
+                context = ssl.create_default_context(cafile=cert_path)
+                async with session.post(f"{search_url}/indexes/gptkbindex/docs/search.post.search", ssl=context,
+                                        json={"search": "copay", "top": 3, "count": True}) as response:
+                    found = response.status, await response.json()
+        finally:
+            await services.stop()
+        return throttled, found
+
+    try:
+        throttled, (status, body) = asyncio.run(run())
+    finally:
+        index.close()
+    assert throttled == 429
+    assert status == 200
+    assert len(body["value"]) == 3
+    assert body["@odata.count"] > 3
+    assert services.requests == {"openai": 1, "search": 1}
+    assert services.errors == {"openai": 1, "search": 0}
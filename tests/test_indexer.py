@@ -0,0 +1,99 @@
+import json
+import threading
+from collections import namedtuple
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from ingestion.indexer import SectionIndexer
+
+IndexingResult = namedtuple("IndexingResult", ["key", "succeeded", "status_code", "error_message"])
+
+def http_error(status_code):
+    error = HttpResponseError(f"{status_code}")
+    error.status_code = status_code
+    return error
+
+# Search client that rejects batches of more than max_batch documents with 413, throttles the first requests with 429
+# and fails the first attempt of the documents in flaky with 503
+class FlakySearchClient:
+    def __init__(self, max_batch=1000, throttled=0, flaky=()):
+        self.max_batch = max_batch
+        self.throttled = throttled
+        self.flaky = set(flaky)
+        self.documents = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def upload_documents(self, documents):
+        with self.lock:
+            self.requests.append(len(documents))
+            if len(documents) > self.max_batch:
+                raise http_error(413)
+            if self.throttled:
+                self.throttled -= 1
+                raise http_error(429)
+            results = []
+            for doc in documents:
+                if doc["id"] in self.flaky:
+                    self.flaky.discard(doc["id"])
+                    results.append(IndexingResult(doc["id"], False, 503, "Service unavailable"))
+                elif doc["id"] == "bad":
+                    results.append(IndexingResult(doc["id"], False, 400, "Invalid document"))
+                else:
+                    self.documents[doc["id"]] = doc
+                    results.append(IndexingResult(doc["id"], True, 201, None))
+            return results
+
+    def delete_documents(self, documents):
+        with self.lock:
+            for doc in documents:
+                self.documents.pop(doc["id"], None)
+            return [IndexingResult(doc["id"], True, 200, None) for doc in documents]
+
+def sections(count):
+    return [{"id": f"s{i}", "content": "x" * 100} for i in range(count)]
+
+def test_batches_are_limited_by_count_and_size():
+    indexer = SectionIndexer(None, max_batch_count=10, max_batch_bytes=1000, verbose=False)
+    batches = list(indexer.batches(sections(25)))
+    assert all(len(json.dumps(b)) <= 1000 for b in batches) and len(batches) == 4
+    assert [s for b in batches for s in b] == sections(25)
+    indexer = SectionIndexer(None, max_batch_count=10, verbose=False)
+    assert [len(b) for b in indexer.batches(sections(25))] == [10, 10, 5]
+
+def test_batches_rejected_as_too_large_are_split():
+    client = FlakySearchClient(max_batch=30)
+    indexer = SectionIndexer(client, concurrency=1, max_batch_count=100, backoff=0, verbose=False)
+    assert indexer.index(sections(100)) == 100
+    assert sorted(client.documents) == sorted(s["id"] for s in sections(100))
+    assert client.requests == [100, 50, 25, 25, 50, 25, 25]
+
+def test_throttled_batches_and_transient_document_failures_are_retried():
+    client = FlakySearchClient(throttled=2, flaky=["s3", "s7"])
+    indexer = SectionIndexer(client, concurrency=2, max_batch_count=5, backoff=0, verbose=False)
+    assert indexer.index(sections(20) + [{"id": "bad"}]) == 20
+    assert len(client.documents) == 20
+    assert client.requests.count(1) == 3
+
+def test_retries_are_limited():
+    client = FlakySearchClient(throttled=10)
+    indexer = SectionIndexer(client, concurrency=1, max_retries=3, backoff=0, verbose=False)
+    with pytest.raises(HttpResponseError):
+        indexer.index(sections(5))
+    assert len(client.requests) == 4
+
+def test_retry_after_is_honored(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("ingestion.indexer.time.sleep", sleeps.append)
+    indexer = SectionIndexer(None, backoff=1, verbose=False)
+    indexer.wait(0, "7")
+    indexer.wait(2)
+    assert sleeps[0] == 7 and 2 <= sleeps[1] <= 6
+
+def test_sections_are_deleted_in_batches():
+    client = FlakySearchClient()
+    indexer = SectionIndexer(client, max_batch_count=10, verbose=False)
+    indexer.index(sections(25))
+    assert indexer.delete([f"s{i}" for i in range(20)]) == 20
+    assert sorted(client.documents) == ["s20", "s21", "s22", "s23", "s24"]
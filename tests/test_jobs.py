@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+import pytest
+
+from ingestion.jobs import IngestionJobs
+
+# Job runner that blocks until released, recording the jobs it ran
+class BlockingRun:
+    def __init__(self):
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+        self.ran = []
+
+    def __call__(self, job):
+        self.ran.append(job.id)
+        self.started.release()
+        self.release.wait(10)
+
+@pytest.fixture
+def jobs():
+    run = BlockingRun()
+    jobs = IngestionJobs(run)
+    jobs.blocking_run = run
+    yield jobs
+    run.release.set()
+    jobs.shutdown()
+
+def wait_for(job, status):
+    for _ in range(1000):
+        if job.status == status:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError(f"job is {job.status}, not {status}")
+
+def test_requests_coalesce_into_the_waiting_job(jobs):
+    running, created = jobs.submit()
+    assert created
+    assert jobs.blocking_run.started.acquire(timeout=10)
+    assert running.status == "running"
+
+    # While a job runs, one follow-up job is queued and later requests share it
+    queued, created = jobs.submit()
+    assert created and queued is not running
+    assert jobs.submit() == (queued, False)
+    assert jobs.submit() == (queued, False)
+    assert jobs.latest() is queued
+
+    jobs.blocking_run.release.set()
+    wait_for(queued, "succeeded")
+    assert running.status == "succeeded"
+    assert jobs.blocking_run.ran == [running.id, queued.id]
+    # Nothing is queued anymore, the next request starts a new job
+    assert jobs.submit()[1]
+
+def test_failed_job_reports_its_error():
+    def run(job):
+        job.start(["data/a.pdf", "data/b.pdf"])
+        job.stage_done("data/a.pdf", "parse", 0.5, 10)
+        job.file_done("data/a.pdf")
+        raise RuntimeError("index not found")
+    jobs = IngestionJobs(run)
+    try:
+        job, _ = jobs.submit()
+        wait_for(job, "failed")
+        status = job.to_dict()
+        assert status["error"] == "index not found"
+        assert (status["files_total"], status["files_done"]) == (2, 1)
+        assert status["files"] == {"a.pdf": {"status": "done", "stages": {"parse": {"seconds": 0.5, "items": 10}}},
+                                   "b.pdf": {"status": "pending", "stages": {}}}
+        assert status["stages"]["parse"]["items_per_second"] == 20
+    finally:
+        jobs.shutdown()
+
+def test_only_the_last_jobs_are_kept():
+    jobs = IngestionJobs(lambda job: None, max_history=3)
+    try:
+        submitted = []
+        for _ in range(6):
+            job, _ = jobs.submit()
+            wait_for(job, "succeeded")
+            submitted.append(job)
+        assert jobs.get(submitted[0].id) is None
+        assert [jobs.get(job.id) for job in submitted[-3:]] == submitted[-3:]
+    finally:
+        jobs.shutdown()
+
+def test_ingest_endpoint_returns_right_away(backend, monkeypatch):
+    jobs = IngestionJobs(BlockingRun())
+    monkeypatch.setattr(backend, "ingestion_jobs", jobs)
+    async def requests():
+        client = backend.app.test_client()
+        first = await client.post("/ingest")
+        assert await asyncio.to_thread(jobs.run.started.acquire, timeout=10)
+        second = await client.post("/ingest")
+        third = await client.post("/ingest")
+        status = await client.get(first.headers["Location"])
+        latest = await client.get("/ingest/latest")
+        missing = await client.get("/ingest/unknown")
+        return [first, second, third, status, latest, missing], [await r.get_json() for r in (first, second, third, status, latest, missing)]
+    try:
+        responses, bodies = asyncio.run(requests())
+        assert [r.status_code for r in responses] == [202, 202, 202, 200, 200, 404]
+        assert [b["message"] for b in bodies[:3]] == ["ingesting", "ingesting", "ingestion already queued"]
+        assert bodies[2]["id"] == bodies[1]["id"] == bodies[4]["id"] != bodies[0]["id"]
+        assert bodies[3]["id"] == bodies[0]["id"] and "files" in bodies[3]
+    finally:
+        jobs.run.release.set()
+        jobs.shutdown()
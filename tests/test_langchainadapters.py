@@ -0,0 +1,38 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from langchainadapters import AgentRun, DeadlineExceeded
+
+def test_wait_stops_at_the_deadline():
+    run = AgentRun({"max_seconds": 0.1})
+    never_done = concurrent.futures.Future()
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        run.wait(never_done)
+    assert time.monotonic() - start < 1
+    assert run.expired
+
+# Before Python 3.11 concurrent.futures.TimeoutError isn't the builtin TimeoutError
+def test_wait_catches_the_futures_timeout_error(monkeypatch):
+    class FuturesTimeoutError(Exception):
+        pass
+
+    class TimingOutFuture:
+        def result(self, timeout=None):
+            raise FuturesTimeoutError()
+
+    monkeypatch.setattr(concurrent.futures, "TimeoutError", FuturesTimeoutError)
+    run = AgentRun({"max_seconds": 5})
+    with pytest.raises(DeadlineExceeded):
+        run.wait(TimingOutFuture())
+    assert run.expired
+
+def test_wait_returns_the_result_in_time():
+    run = AgentRun({"max_seconds": 5})
+    future = concurrent.futures.Future()
+    threading.Timer(0.05, future.set_result, ["done"]).start()
+    assert run.wait(future) == "done"
+    assert not run.expired
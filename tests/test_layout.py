@@ -0,0 +1,32 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.layout import random_results, reference_layout_page_map
+from ingestion.layout import layout_page_map
+
+@pytest.mark.parametrize("seed", range(5))
+def test_page_map_matches_the_original_assembly(seed):
+    rnd = random.Random(seed)
+    for _ in range(10):
+        results = random_results(rnd, rnd.randint(1, 8), rnd.randint(1, 2000), rnd.randint(0, 4))
+        assert layout_page_map(results) == reference_layout_page_map(results)
+
+def span(offset, length):
+    return SimpleNamespace(offset=offset, length=length)
+
+def cell(row, column, content, kind="content"):
+    return SimpleNamespace(row_index=row, column_index=column, content=content, kind=kind, column_span=1, row_span=1)
+
+def test_table_replaces_its_span_where_it_starts():
+    content = "Intro. A B 1 2 Outro. Page two."
+    table = SimpleNamespace(bounding_regions=[SimpleNamespace(page_number=1)], spans=[span(7, 8)], row_count=2,
+                            cells=[cell(0, 1, "B", "columnHeader"), cell(0, 0, "A", "columnHeader"), cell(1, 0, "1"), cell(1, 1, "2 & 3")])
+    results = SimpleNamespace(content=content, pages=[SimpleNamespace(spans=[span(0, 21)]), SimpleNamespace(spans=[span(22, 9)])],
+                              tables=[table])
+
+    page_map = layout_page_map(results)
+
+    table_html = "<table><tr><th>A</th><th>B</th></tr><tr><td>1</td><td>2 &amp; 3</td></tr></table>"
+    assert page_map == [(0, 0, "Intro. " + table_html + "Outro. "), (1, len(page_map[0][2]), "Page two. ")]
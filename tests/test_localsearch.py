@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+from localsearch import AsyncLocalSearchClient, LocalSearchClient, LocalSearchIndex, LocalSearchIndexBuilder
+
+def sections(count, sourcefile):
+    return [{"id": f"{sourcefile}-{i}", "content": f"section {i}", "category": None, "sourcepage": f"{sourcefile}-{i}.pdf",
+             "sourcefile": sourcefile} for i in range(count)]
+
+def test_builder_lists_every_match_without_top():
+    builder = LocalSearchIndexBuilder()
+    builder.upload_documents(sections(300, "a.pdf") + sections(10, "b.pdf"))
+    r = builder.search("", filter="sourcefile eq 'a.pdf'", select=["id"])
+    assert len(list(r)) == 300
+    assert r.get_count() == 300
+    assert len(list(builder.search("", filter="sourcefile eq 'a.pdf'", top=20))) == 20
+
+def test_saved_index_finds_terms_and_filters_on_fields(tmp_path):
+    builder = LocalSearchIndexBuilder()
+    builder.upload_documents(sections(20, "a.pdf") + sections(5, "b.pdf") + [
+        {"id": "c", "content": "Übersicht über Leistungen", "category": "x", "sourcepage": "c-1.pdf", "sourcefile": "c.pdf"}])
+    builder.save(str(tmp_path))
+    index = LocalSearchIndex.load(str(tmp_path))
+    try:
+        client = LocalSearchClient(index)
+        assert [d["id"] for d in client.search("section 3", top=3)][0] in ("a.pdf-3", "b.pdf-3")
+        assert [d["id"] for d in client.search("übersicht")] == ["c"]
+        assert list(client.search("missing")) == []
+        assert [d["id"] for d in client.search("section 3", filter="sourcefile eq 'b.pdf'")][0] == "b.pdf-3"
+        assert client.search("", filter="category eq null").get_count() == 25
+        assert [d["id"] for d in client.search("", filter="category ne null")] == ["c"]
+        assert [d["id"] for d in client.search("", filter="content eq 'section 4' and sourcefile eq 'a.pdf'")] == ["a.pdf-4"]
+        assert index.field(index.doc_count - 1, "sourcepage") == "c-1.pdf"
+    finally:
+        index.close()
+
+def test_empty_index_can_be_searched(tmp_path):
+    LocalSearchIndexBuilder().save(str(tmp_path))
+    index = LocalSearchIndex.load(str(tmp_path))
+    try:
+        assert list(LocalSearchClient(index).search("anything")) == []
+        assert LocalSearchClient(index).search("", filter="category eq 'x'").get_count() == 0
+    finally:
+        index.close()
+
+def build(tmp_path, documents):
+    builder = LocalSearchIndexBuilder()
+    builder.upload_documents(documents)
+    builder.save(str(tmp_path))
+    return LocalSearchIndex.load(str(tmp_path))
+
+def test_results_are_ranked_by_bm25(tmp_path):
+    index = build(tmp_path, [
+        {"id": "1", "content": "The deductible is $500. Overlake is in-network.", "sourcepage": "a-0.pdf"},
+        {"id": "2", "content": "Deductible, deductible, deductible: the deductible applies to every visit.", "sourcepage": "a-1.pdf"},
+        {"id": "3", "content": "Vision coverage includes an annual exam.", "sourcepage": "b-0.pdf"},
+        {"id": "4", "content": "<table><tr><td>Overlake</td><td>in-network</td></tr></table>", "sourcepage": "b-1.pdf"},
+    ])
+    try:
+        client = LocalSearchClient(index)
+        r = client.search("deductible", include_total_count=True)
+        docs = list(r)
+        assert [d["id"] for d in docs] == ["2", "1"] and r.get_count() == 2
+        assert docs[0]["@search.score"] > docs[1]["@search.score"] > 0
+        # Rare terms weigh more than common ones, table markup isn't indexed
+        assert [d["id"] for d in client.search("overlake deductible")][0] == "1"
+        assert list(client.search("td tr")) == []
+        selected = list(client.search("overlake", select=["sourcepage"]))
+        assert [sorted(d) for d in selected] == [["@search.score", "sourcepage"]] * 2
+        assert sorted(d["sourcepage"] for d in selected) == ["a-0.pdf", "b-1.pdf"]
+        captions = list(client.search("overlake network", filter="id eq '1'", query_caption="extractive"))[0]["@search.captions"]
+        assert captions[0].text == "Overlake is in-network."
+    finally:
+        index.close()
+
+def test_async_search_runs_off_the_event_loop(tmp_path):
+    index = build(tmp_path, sections(5, "a.pdf"))
+    client = AsyncLocalSearchClient(index)
+    threads = []
+    search = client.client.search
+    client.client.search = lambda *args, **kwargs: threads.append(threading.get_ident()) or search(*args, **kwargs)
+    async def run():
+        r = await client.search("section 3", top=2)
+        return threading.get_ident(), [d["id"] async for d in r], await r.get_count()
+    try:
+        loop_thread, ids, count = asyncio.run(run())
+        assert ids[0] == "a.pdf-3" and count == 5
+        assert threads and threads[0] != loop_thread
+    finally:
+        index.close()
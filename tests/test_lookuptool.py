@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from lookuptool import CsvLookupStore, CsvLookupTool
+
+CSV = 'name,title,notes\nJohn Smith,Engineer,"likes\nhiking"\njohn smith,Manager,\nJohnny Doe,Designer,\nJane Doe,Analyst,\n'
+
+def write(path, text, mtime=None):
+    path.write_text(text, encoding="utf-8")
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+def test_exact_matches_ignore_case_and_keep_quoted_line_breaks(tmp_path):
+    write(tmp_path / "people.csv", CSV)
+    store = CsvLookupStore(tmp_path / "people.csv", "name")
+    assert store.lookup("JOHN SMITH ") == ["name:John Smith\ntitle:Engineer\nnotes:likes\nhiking", "name:john smith\ntitle:Manager\nnotes:"]
+    assert store.lookup("jane doe") == ["name:Jane Doe\ntitle:Analyst\nnotes:"]
+    assert store.lookup("nobody") == []
+    assert store.lookup("  ") == []
+
+def test_prefix_matches_are_bounded(tmp_path):
+    write(tmp_path / "people.csv", CSV)
+    store = CsvLookupStore(tmp_path / "people.csv", "name")
+    assert [row.split("\n")[0] for row in store.lookup("joh")] == ["name:John Smith", "name:john smith", "name:Johnny Doe"]
+    assert len(store.lookup("j", max_matches=2)) == 2
+
+def test_changed_file_is_reloaded(tmp_path):
+    path = tmp_path / "people.csv"
+    write(path, CSV, mtime=1_000_000_000)
+    store = CsvLookupStore(path, "name", check_interval=0)
+    write(path, CSV + "Ann Lee,Nurse,\n", mtime=2_000_000_000)
+    assert store.lookup("ann lee") == ["name:Ann Lee\ntitle:Nurse\nnotes:"]
+
+    # Not checked again before check_interval
+    store.check_interval = 3600
+    write(path, "name,title\nBob,Driver\n", mtime=3_000_000_000)
+    assert store.lookup("bob") == []
+
+def test_failed_reload_keeps_the_loaded_rows(tmp_path):
+    path = tmp_path / "people.csv"
+    write(path, CSV, mtime=1_000_000_000)
+    store = CsvLookupStore(path, "name", check_interval=0)
+    write(path, "title\nEngineer\n", mtime=2_000_000_000)
+    assert store.lookup("jane doe") == ["name:Jane Doe\ntitle:Analyst\nnotes:"]
+    path.unlink()
+    assert store.lookup("jane doe") == ["name:Jane Doe\ntitle:Analyst\nnotes:"]
+
+def test_missing_key_field_is_an_error(tmp_path):
+    write(tmp_path / "people.csv", CSV)
+    with pytest.raises(ValueError):
+        CsvLookupStore(tmp_path / "people.csv", "email")
+
+def test_tools_share_the_store_of_a_file(tmp_path):
+    write(tmp_path / "people.csv", CSV)
+    first = CsvLookupTool(tmp_path / "people.csv", "name")
+    second = CsvLookupTool(str(tmp_path / "people.csv"), "name")
+    assert first.store is second.store
+    second.max_matches = 1
+    assert second.lookup("john smith").count("name:") == 2
+    assert second.lookup("jane") == "name:Jane Doe\ntitle:Analyst\nnotes:"
+    assert first.run("john smith").split("\n\n")[1] == "name:john smith\ntitle:Manager\nnotes:"
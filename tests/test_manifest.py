@@ -0,0 +1,116 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from ingestion.ingest import Ingest
+from ingestion.manifest import IngestionManifest
+from ingestion.pipeline import ParsedFile
+from localsearch import LocalSearchIndexBuilder
+
+def test_manifest_reports_orphans_and_changes(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = IngestionManifest(path, target="account/container/index")
+    manifest.set_sections("data/a.pdf", ["a-0", "a-1", "a-2"])
+    manifest.set_blobs("data/a.pdf", {"a-0.pdf": "h0", "a-1.pdf": "h1"})
+    manifest.set_hash("data/a.pdf", "hash1")
+    manifest.set_sections("data/b.pdf", ["b-0"])
+    manifest.save()
+
+    manifest = IngestionManifest(path, target="account/container/index")
+    assert not manifest.has_changed("data/a.pdf", "hash1")
+    assert manifest.has_changed("data/a.pdf", "hash2")
+    # b.pdf never completed, it's processed again
+    assert manifest.has_changed("data/b.pdf", "hash")
+    assert manifest.set_sections("data/a.pdf", ["a-0"]) == ["a-1", "a-2"]
+    assert manifest.set_blobs("data/a.pdf", {"a-0.pdf": "h0"}) == ["a-1.pdf"]
+    assert manifest.removed_files(["data/a.pdf"], "data/*") == ["b.pdf"]
+    assert manifest.removed_files(["data/a.pdf"], "other/*") == []
+
+def test_manifest_of_another_target_is_ignored(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = IngestionManifest(path, target="account/container/index")
+    manifest.set_hash("data/a.pdf", "hash1")
+    manifest.save()
+    assert IngestionManifest(path, target="account/container/other").has_changed("data/a.pdf", "hash1")
+
+# Blob container keeping blobs in memory, with the metadata PageUploader reads
+class FakeBlobContainer:
+    account_name = "account"
+    container_name = "content"
+
+    def __init__(self):
+        self.blobs = {}
+        self.uploads = []
+
+    def exists(self):
+        return True
+
+    def list_blobs(self, name_starts_with="", include=None):
+        return [SimpleNamespace(name=name, metadata=metadata) for name, (_, metadata) in sorted(self.blobs.items())
+                if name.startswith(name_starts_with)]
+
+    def upload_blob(self, name, data, overwrite=False, metadata=None):
+        self.uploads.append(name)
+        self.blobs[name] = (data, metadata)
+
+    def delete_blobs(self, *names, raise_on_any_failure=True):
+        return [SimpleNamespace(status_code=202 if self.blobs.pop(name, None) else 404, reason="") for name in names]
+
+# Text files with pages separated by form feeds, uploaded as one blob per page
+def parse_text_file(filename):
+    pages = open(filename, "r", encoding="utf-8").read().split("\f")
+    page_map = []
+    for i, text in enumerate(pages):
+        page_map.append((i, sum(len(p) for p in pages[:i]), text))
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return ParsedFile(list(Ingest.create_sections(os.path.basename(filename), page_map)),
+                      {f"{stem}-{i}.txt": text.encode("utf-8") for i, text in enumerate(pages)})
+
+def write(name, pages):
+    with open(os.path.join("data", name), "w", encoding="utf-8") as f:
+        f.write("\f".join(" ".join(f"Page {page} sentence {i} of {name}." for i in range(60)) for page in range(pages)))
+
+@pytest.fixture
+def ingestion(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("data")
+    monkeypatch.setattr(Ingest, "parse_file", staticmethod(parse_text_file))
+    search_client = LocalSearchIndexBuilder()
+    search_index_client = SimpleNamespace(list_index_names=lambda: ["index"])
+    container = FakeBlobContainer()
+    ingest = Ingest("index", search_index_client, container, search_client, manifest_path=str(tmp_path / "manifest.json"))
+    return SimpleNamespace(ingest=ingest, search_client=search_client, container=container)
+
+def indexed(search_client, name):
+    return sorted(d["id"] for d in search_client.search("", filter=f"sourcefile eq '{name}'"))
+
+def test_reingestion_removes_orphans(ingestion):
+    write("a.txt", 3)
+    write("b.txt", 2)
+    ingestion.ingest.run()
+    a_sections = indexed(ingestion.search_client, "a.txt")
+    assert len(a_sections) > 3 and indexed(ingestion.search_client, "b.txt")
+    assert sorted(ingestion.container.blobs) == ["a-0.txt", "a-1.txt", "a-2.txt", "b-0.txt", "b-1.txt"]
+
+    # a.txt shrinks, b.txt is deleted
+    write("a.txt", 1)
+    os.remove("data/b.txt")
+    ingestion.container.uploads.clear()
+    ingestion.ingest.run()
+
+    remaining = indexed(ingestion.search_client, "a.txt")
+    assert 0 < len(remaining) < len(a_sections)
+    assert indexed(ingestion.search_client, "b.txt") == []
+    assert sorted(ingestion.container.blobs) == ["a-0.txt"]
+    # The page that didn't change isn't uploaded again
+    assert ingestion.container.uploads == []
+
+def test_unchanged_files_are_skipped(ingestion):
+    write("a.txt", 2)
+    ingestion.ingest.run()
+    ingestion.container.uploads.clear()
+    uploads = []
+    ingestion.search_client.upload_documents = lambda documents: uploads.append(documents)
+    ingestion.ingest.run()
+    assert (uploads, ingestion.container.uploads) == ([], [])
@@ -0,0 +1,58 @@
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+from pypdf import PdfReader, PdfWriter
+
+from ingestion.pages import HASH_METADATA, PageUploader, content_hash, delete_blobs, page_pdfs
+
+class FakeBlobContainer:
+    def __init__(self, blobs=None):
+        self.blobs = dict(blobs or {})
+        self.uploads = []
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def list_blobs(self, name_starts_with="", include=None):
+        return [SimpleNamespace(name=name, metadata=metadata) for name, (_, metadata) in self.blobs.items()
+                if name.startswith(name_starts_with)]
+
+    def upload_blob(self, name, data, overwrite=False, metadata=None):
+        time.sleep(0.01)
+        with self.lock:
+            self.uploads.append(name)
+            self.threads.add(threading.get_ident())
+            self.blobs[name] = (data, metadata)
+
+    def delete_blobs(self, *names, raise_on_any_failure=True):
+        return [SimpleNamespace(status_code=202 if self.blobs.pop(name, None) else 404, reason="") for name in names]
+
+def test_every_page_is_written_as_its_own_pdf():
+    writer = PdfWriter()
+    for width in (100, 200, 300):
+        writer.add_blank_page(width=width, height=100)
+    f = io.BytesIO()
+    writer.write(f)
+
+    pages = page_pdfs(PdfReader(f))
+
+    assert len(pages) == 3
+    assert [float(PdfReader(io.BytesIO(page)).pages[0].mediabox.width) for page in pages] == [100, 200, 300]
+
+def test_only_changed_pages_are_uploaded():
+    container = FakeBlobContainer({"a-0.pdf": (b"page 0", {HASH_METADATA: content_hash(b"page 0")}),
+                                   "a-1.pdf": (b"old page 1", {HASH_METADATA: content_hash(b"old page 1")})})
+    pages = {f"a-{i}.pdf": f"page {i}".encode() for i in range(12)}
+
+    hashes = PageUploader(container, concurrency=4, verbose=False).upload(pages)
+
+    assert hashes == {name: content_hash(data) for name, data in pages.items()}
+    assert sorted(container.uploads) == sorted(f"a-{i}.pdf" for i in range(1, 12))
+    assert all(container.blobs[name][0] == data for name, data in pages.items())
+    assert len(container.threads) > 1
+
+def test_missing_blobs_are_ignored_when_deleting():
+    container = FakeBlobContainer({f"a-{i}.pdf": (b"", {}) for i in range(300)})
+    assert delete_blobs(container, [f"a-{i}.pdf" for i in range(310)], verbose=False) == 300
+    assert container.blobs == {}
@@ -0,0 +1,99 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ingestion import pipeline as pipeline_module
+from ingestion.pipeline import IngestionPipeline, ParsedFile
+from ingestion.textsplit import split_text
+
+# Pages of the text files are separated by form feeds. Module level so it can run on worker processes.
+def parse_text_file(filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        pages = f.read().split("\f")
+    page_map = []
+    offset = 0
+    for i, text in enumerate(pages):
+        page_map.append((i, offset, text))
+        offset += len(text)
+    name = os.path.basename(filename)
+    sections = [{"id": f"{name}-{i}", "content": content, "sourcepage": f"{name}-{page}"}
+                for i, (content, page) in enumerate(split_text(page_map))]
+    return ParsedFile(sections, {f"{name}-{i}": text.encode("utf-8") for i, text in enumerate(pages)})
+
+@pytest.fixture
+def files(tmp_path):
+    filenames = []
+    for n in range(12):
+        filename = str(tmp_path / f"doc{n}.txt")
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write("\f".join(" ".join(f"Sentence {n}.{page}.{i} of the document." for i in range(40 * (n % 4 + 1)))
+                              for page in range(n % 3 + 1)))
+        filenames.append(filename)
+    return filenames
+
+# Runs a pipeline and returns what each stage got for each file
+def run(filenames, **kwargs):
+    lock = threading.Lock()
+    out = {"index": {}, "upload": {}, "embed": {}, "done": [], "stages": []}
+    def stage(name):
+        def record(filename, items):
+            with lock:
+                out[name][filename] = items
+        return record
+    def on_stage(filename, name, seconds, items):
+        with lock:
+            out["stages"].append((filename, name, items))
+    IngestionPipeline(parse_text_file, index=stage("index"), upload=stage("upload"), embed=stage("embed"),
+                      done=lambda filename: out["done"].append(filename), on_stage=on_stage, **kwargs).run(filenames)
+    return out
+
+@pytest.mark.parametrize("use_processes", [True, False])
+def test_parallel_run_matches_serial_run(files, use_processes):
+    serial = run(files)
+    parallel = run(files, workers=3, concurrency=4, max_pending=4, use_processes=use_processes)
+
+    assert parallel["index"] == serial["index"]
+    assert parallel["upload"] == serial["upload"]
+    assert parallel["embed"] == serial["embed"]
+    assert sorted(parallel["done"]) == sorted(serial["done"]) == sorted(files)
+    assert sorted(parallel["stages"]) == sorted(serial["stages"])
+    assert len(serial["stages"]) == 4 * len(files)
+
+def test_failed_file_is_not_done(files):
+    def index(filename, sections):
+        if filename == files[3]:
+            raise RuntimeError("index failed")
+    done = []
+    pipeline = IngestionPipeline(parse_text_file, index=index, done=done.append, workers=2, concurrency=2, use_processes=False)
+    with pytest.raises(RuntimeError, match="index failed"):
+        pipeline.run(files)
+    assert files[3] not in done
+
+def test_stage_that_cannot_be_submitted_fails_the_file(files, monkeypatch):
+    def index(filename, sections):
+        pass
+    # The pool refuses the index stage of one file, as a pool that's shut down would
+    class RefusingPool(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            if args[:2] == (index, files[1]):
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            return super().submit(fn, *args, **kwargs)
+    monkeypatch.setattr(pipeline_module, "ThreadPoolExecutor", RefusingPool)
+    done = []
+    pipeline = IngestionPipeline(parse_text_file, index=index, done=done.append, workers=2, concurrency=2, max_pending=2,
+                                 use_processes=False)
+    result = {}
+    def target():
+        try:
+            pipeline.run(files)
+        except RuntimeError as e:
+            result["error"] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive(), "the pipeline waited forever for the file"
+    assert "cannot schedule" in str(result["error"])
+    assert files[1] not in done
@@ -0,0 +1,111 @@
+import importlib
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from localsearch import LocalSearchResults, parse_filter
+
+# prepdocs.py parses its arguments when imported
+@pytest.fixture
+def prepdocs(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["prepdocs.py", str(tmp_path / "*.pdf"), "--localpdfparser", "--skipblobs",
+                                      "--localindex", str(tmp_path / "index")])
+    sys.modules.pop("prepdocs", None)
+    module = importlib.import_module("prepdocs")
+    yield module
+    sys.modules.pop("prepdocs", None)
+
+def test_indexer_is_built_from_the_shared_search_client(prepdocs):
+    clients = prepdocs.ServiceClients(pool_size=4)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(indexer=clients.indexer), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "building the indexer deadlocked"
+    assert result["indexer"] is clients.indexer
+    assert result["indexer"].search_client is clients.search_client
+
+def test_remove_from_index_pages_without_skip(prepdocs):
+    search_client = prepdocs.clients.search_client
+    search_client.upload_documents([{"id": f"{name}-{i}", "content": "text", "sourcefile": name}
+                                    for name in ("a.pdf", "b.pdf") for i in range(2500)])
+    searches = []
+    search = search_client.search
+    search_client.search = lambda *a, **kwargs: searches.append(kwargs) or search(*a, **kwargs)
+
+    prepdocs.remove_from_index("a.pdf")
+
+    assert search("", filter="sourcefile eq 'a.pdf'", top=0, include_total_count=True).get_count() == 0
+    assert search("", filter="sourcefile eq 'b.pdf'", top=0, include_total_count=True).get_count() == 2500
+    listings = [kwargs for kwargs in searches if kwargs.get("select") == ["id"]]
+    assert [kwargs["top"] for kwargs in listings] == [1000, 1000, 1000, 1000]
+    assert not any("skip" in kwargs for kwargs in searches)
+
+# Search client and indexer whose deletions only show up in search results after lag more searches, like the service
+class LateDeletes:
+    def __init__(self, documents, lag, lose_first_delete=False):
+        self.documents = {d["id"]: d for d in documents}
+        self.lag = lag
+        self.lose_first_delete = lose_first_delete
+        self.pending = []
+        self.searches = 0
+        self.deleted = []
+
+    def search(self, search_text, filter=None, select=None, top=None, include_total_count=False, **kwargs):
+        self.searches += 1
+        for visible_at, ids in self.pending:
+            if visible_at <= self.searches:
+                for section_id in ids:
+                    self.documents.pop(section_id, None)
+        predicate = parse_filter(filter) if filter else (lambda get: True)
+        matches = [d for _, d in sorted(self.documents.items()) if predicate(d.get)]
+        return LocalSearchResults([{"id": d["id"]} for d in matches[:top]], len(matches))
+
+    def delete(self, section_ids):
+        self.deleted.extend(section_ids)
+        if self.lose_first_delete:
+            self.lose_first_delete = False
+            return
+        self.pending.append((self.searches + self.lag, list(section_ids)))
+
+def sections(name, count):
+    return [{"id": f"{name}-{i:05}", "sourcefile": name} for i in range(count)]
+
+@pytest.fixture
+def late_deletes(prepdocs, monkeypatch):
+    def install(documents, **kwargs):
+        client = LateDeletes(documents, **kwargs)
+        monkeypatch.setattr(prepdocs, "clients", SimpleNamespace(search_client=client, indexer=client))
+        monkeypatch.setattr(prepdocs.time, "sleep", lambda seconds: sleeps.append(seconds))
+        return client
+    sleeps = []
+    install.sleeps = sleeps
+    return install
+
+def test_remove_from_index_waits_for_deletes_to_show(prepdocs, late_deletes):
+    client = late_deletes(sections("a.pdf", 5500) + sections("b.pdf", 10), lag=3)
+
+    prepdocs.remove_from_index("a.pdf")
+
+    assert sorted(client.documents) == [d["id"] for d in sections("b.pdf", 10)]
+    assert sorted(client.deleted) == [d["id"] for d in sections("a.pdf", 5500)]
+    assert late_deletes.sleeps and max(late_deletes.sleeps) < prepdocs.REMOVE_MAX_DELAY
+
+def test_remove_from_index_deletes_again_sections_left_behind(prepdocs, late_deletes):
+    client = late_deletes(sections("a.pdf", 1500), lag=1, lose_first_delete=True)
+
+    prepdocs.remove_from_index("a.pdf")
+
+    assert client.documents == {}
+    assert len(client.deleted) == 2500
+
+def test_remove_from_index_gives_up_once_nothing_changes(prepdocs, late_deletes, monkeypatch, capsys):
+    monkeypatch.setattr(prepdocs, "REMOVE_TIMEOUT", 0)
+    client = late_deletes(sections("a.pdf", 10), lag=10 ** 6)
+
+    prepdocs.remove_from_index("a.pdf")
+
+    assert len(client.documents) == 10
+    assert "10 sections from 'a.pdf' are still in search index" in capsys.readouterr().out
@@ -0,0 +1,49 @@
+from conftest import FakeAsyncSearchClient
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from prompt import PromptBudget
+
+def test_oldest_turns_are_dropped_first():
+    budget = PromptBudget(max_history_tokens=30)
+    turns = [f"turn {i} " + "word " * 8 for i in range(5)]
+    kept = budget.fit_history(turns)
+    assert kept == turns[-len(kept):] and 1 < len(kept) < 5
+    assert sum(budget.count(t) for t in kept) <= 30
+
+def test_last_turn_is_kept_even_when_too_long():
+    budget = PromptBudget(max_history_tokens=5)
+    assert budget.fit_history(["short", "word " * 50]) == ["word " * 50]
+
+def test_lowest_ranked_sources_are_dropped():
+    budget = PromptBudget()
+    sources = [f"doc{i}.pdf: " + "fact " * 20 for i in range(10)]
+    kept = budget.fit_sources(sources, 100)
+    assert kept == sources[:len(kept)] and 0 < len(kept) < 10
+    assert budget.count("\n".join(kept)) <= 100
+
+def test_first_source_is_cut_when_nothing_fits():
+    budget = PromptBudget()
+    kept = budget.fit_sources(["doc0.pdf: " + "fact " * 100], 10)
+    assert len(kept) == 1 and 0 < budget.count(kept[0]) <= 10
+    assert budget.fit_sources(["doc0.pdf: fact"], 0) == []
+
+def test_completion_gets_what_the_prompt_leaves():
+    budget = PromptBudget(context_window=1000, max_completion_tokens=300)
+    assert budget.completion_tokens("word " * 10) == 300
+    assert budget.completion_tokens("word " * 900) == 100
+    assert budget.completion_tokens("word " * 2000) == 1
+    assert budget.available("word " * 100) == 1000 - 300 - budget.count("word " * 100)
+
+def test_chat_prompt_fits_the_context_window(completions):
+    budget = PromptBudget(context_window=2000, max_completion_tokens=500, max_history_tokens=300)
+    documents = [{"sourcepage": f"doc{i}.pdf", "content": "The plan covers visits. " * 60} for i in range(10)]
+    approach = ChatReadRetrieveReadApproach(FakeAsyncSearchClient(documents), "chat", "davinci", "sourcepage", "content",
+                                            prompt_budget=budget)
+    history = [{"user": f"Question {i}? " + "details " * 40, "bot": "Answer. " * 40} for i in range(10)] + [{"user": "Last question?"}]
+
+    r = approach.run(history, {"top": 10})
+
+    prompt = completions.prompts[-1]
+    assert budget.count(prompt) + budget.completion_tokens(prompt) <= 2000
+    assert "Last question?" in prompt and "Question 0?" not in prompt
+    assert 0 < len(r["data_points"]) < 10 and r["data_points"][0].startswith("doc0.pdf")
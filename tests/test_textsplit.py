@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+from benchmarks.split_text import random_page_map, reference_split_text
+from ingestion.textsplit import MAX_SECTION_LENGTH, split_text
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sections_match_the_original_implementation(seed):
+    rnd = random.Random(seed)
+    for _ in range(20):
+        page_map = random_page_map(rnd, rnd.randint(0, 15), rnd.randint(1, 3000))
+        assert list(split_text(page_map)) == list(reference_split_text(page_map))
+
+def test_sections_overlap_and_point_to_their_first_page():
+    pages = [" ".join(f"Page {p} sentence {i}." for i in range(80)) for p in range(3)]
+    page_map = [(p, sum(len(t) for t in pages[:p]), text) for p, text in enumerate(pages)]
+    sections = list(split_text(page_map))
+    text = "".join(pages)
+    assert len(sections) > 3
+    for content, page in sections:
+        start = text.index(content)
+        assert len(content) <= MAX_SECTION_LENGTH * 1.2
+        assert page_map[page][1] <= start < page_map[page][1] + len(page_map[page][2])
+    assert sections[0][0].startswith("Page 0 sentence 0.") and sections[-1][0].endswith("Page 2 sentence 79.")
+
+def test_empty_document_has_no_sections():
+    assert list(split_text([])) == []
+    assert list(split_text([(0, 0, "")])) == []
@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+
+from conftest import FakeAsyncSearchClient
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from cache import TTLCache
+from tracing import Histograms, Trace, histograms, span, trace_request, trace_stream
+
+def names(trace):
+    return [s["name"] for s in trace.timings()["spans"]]
+
+def test_spans_of_a_request_include_worker_threads():
+    def search():
+        with span("search", cached=False):
+            pass
+
+    async def request():
+        with trace_request("ask.test") as trace:
+            with span("prompt"):
+                await asyncio.to_thread(search)
+        return trace
+
+    trace = asyncio.run(request())
+    timings = trace.timings()
+    assert names(trace) == ["prompt", "search"]
+    assert timings["spans"][1]["cached"] is False
+    assert timings["total_ms"] >= timings["spans"][0]["duration_ms"]
+
+def test_failed_spans_record_the_error():
+    with trace_request("ask.test") as trace:
+        with pytest.raises(ValueError):
+            with span("openai.completion"):
+                raise ValueError("throttled")
+    assert trace.timings()["spans"][0]["error"] == "ValueError"
+
+def test_streamed_trace_ends_with_timings():
+    async def stream():
+        with span("search"):
+            pass
+        yield {"data_points": []}
+        with span("openai.completion"):
+            pass
+        yield {"answer": "a"}
+
+    async def consume():
+        return [item async for item in trace_stream(Trace("ask.stream"), stream())]
+
+    items = asyncio.run(consume())
+    assert items[:2] == [{"data_points": []}, {"answer": "a"}]
+    assert [s["name"] for s in items[-1]["timings"]["spans"]] == ["search", "openai.completion"]
+
+def test_histograms_are_cumulative_in_prometheus_format():
+    h = Histograms(buckets=(0.1, 1.0))
+    h.observe("search", 0.05)
+    h.observe("search", 0.5)
+    h.observe("search", 5.0)
+    assert h.stats()["search"]["buckets"] == {"0.1": 1, "1.0": 1, "+Inf": 1}
+    text = h.prometheus()
+    assert 'app_stage_duration_seconds_bucket{stage="search",le="1.0"} 2' in text
+    assert 'app_stage_duration_seconds_bucket{stage="search",le="+Inf"} 3' in text
+    assert 'app_stage_duration_seconds_count{stage="search"} 3' in text
+
+def test_chat_response_has_stage_timings_and_metrics(backend, completions, monkeypatch):
+    approach = ChatReadRetrieveReadApproach(FakeAsyncSearchClient([{"sourcepage": "a.pdf", "content": "covered"}]), "chat", "davinci",
+                                            "sourcepage", "content", query_cache=TTLCache())
+    monkeypatch.setitem(backend.chat_approaches, "rrr", approach)
+
+    async def send():
+        client = backend.app.test_client()
+        response = await client.post("/chat", json={"approach": "rrr", "history": [{"user": "Is it covered?"}]})
+        metrics = await client.get("/metrics")
+        return json.loads(await response.get_data()), (await metrics.get_data()).decode("utf-8")
+
+    r, metrics = asyncio.run(send())
+    spans = r["timings"]["spans"]
+    assert [s["name"] for s in spans] == ["openai.query_rewrite", "search", "prompt", "openai.completion"]
+    assert spans[0]["cached"] is False
+    assert 'stage="chat.rrr"' in metrics
+    assert histograms.stats()["openai.query_rewrite"]["count"] >= 1
@@ -0,0 +1,89 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from conftest import FakeAsyncSearchClient
+from embeddings import HashingEmbedder
+from localsearch import LocalSearchClient, LocalSearchIndex, LocalSearchIndexBuilder
+from vectorstore import RRF_K, AsyncHybridSearchClient, HybridSearchClient, VectorStore, VectorStoreBuilder, fuse
+
+def docs(*ids, **fields):
+    return [{"id": i, "@search.score": 1.0, **fields} for i in ids]
+
+def test_fuse_sums_reciprocal_ranks():
+    fused = fuse([docs("a", "b", "c"), docs("c", "d")], top=10)
+    assert [d["id"] for d in fused] == ["c", "a", "b", "d"]
+    scores = {d["id"]: d["@search.score"] for d in fused}
+    assert scores["c"] == pytest.approx(1 / (RRF_K + 3) + 1 / (RRF_K + 1))
+    assert scores["a"] == pytest.approx(1 / (RRF_K + 1))
+    assert scores["d"] == pytest.approx(1 / (RRF_K + 2))
+
+def test_fuse_keeps_fields_of_first_list_and_top():
+    fused = fuse([docs("a", "b", source="keyword"), docs("b", "c", source="vector")], top=2)
+    assert [d["id"] for d in fused] == ["b", "a"]
+    assert fused[0]["source"] == "keyword"
+    assert fuse([docs("x")], top=0) == []
+
+def sections():
+    texts = ["dental coverage for employees", "vision plan and glasses", "parental leave policy", "dental cleaning twice a year"]
+    return [{"id": str(i), "content": text, "category": "handbook" if "leave" in text else None, "sourcepage": f"p{i}.pdf",
+             "sourcefile": "f.pdf"} for i, text in enumerate(texts)]
+
+def build(tmp_path, dtype):
+    embedder = HashingEmbedder(64)
+    builder = VectorStoreBuilder(embedder.name, dtype=dtype)
+    builder.add(sections(), embedder.embed([s["content"] for s in sections()]))
+    builder.save(str(tmp_path))
+    return VectorStore.load(str(tmp_path))
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_saved_store_finds_closest_sections(tmp_path, dtype):
+    store = build(tmp_path, dtype)
+    queries = store.embedder.embed(["parental leave policy", "dental coverage"])
+    hits = store.search_vectors(queries, top=2)
+    assert hits[0][0] == (2, pytest.approx(1.0, abs=0.02))
+    assert hits[1][0][0] == 0
+    assert {d["id"] for d in store.search(queries[:1], top=4, filter="category eq null")[0]} == {"0", "1", "3"}
+
+def test_builder_updates_existing_store(tmp_path):
+    build(tmp_path, "int8")
+    builder = VectorStoreBuilder("hashing-64", str(tmp_path), "int8")
+    assert builder.remove("category eq 'handbook'") == 1
+    builder.delete(["1"])
+    builder.save(str(tmp_path))
+    store = VectorStore.load(str(tmp_path))
+    assert store.count == 2
+    assert {store.document(row)["id"] for row in range(store.count)} == {"0", "3"}
+    with pytest.raises(ValueError):
+        VectorStore.load(str(tmp_path), HashingEmbedder(32))
+
+def test_hybrid_search_fuses_keyword_and_vector_results(tmp_path):
+    store = build(tmp_path / "vectors", "float16")
+    builder = LocalSearchIndexBuilder()
+    builder.upload_documents(sections())
+    builder.save(str(tmp_path / "index"))
+    index = LocalSearchIndex.load(str(tmp_path / "index"))
+    try:
+        client = HybridSearchClient(LocalSearchClient(index), store)
+        results = list(client.search("dental coverage", top=3, query_caption="extractive"))
+        assert results[0]["id"] == "0"
+        assert len(results) == 3
+        assert all(d["@search.captions"] for d in results)
+        # Listings and counts only come from the keyword search
+        listing = client.search("dental", select=["id"], include_total_count=True)
+        assert listing.get_count() == 2
+    finally:
+        index.close()
+
+def test_async_hybrid_search_fuses_results(tmp_path):
+    store = build(tmp_path, "float16")
+    keyword = FakeAsyncSearchClient([sections()[3]])
+    client = AsyncHybridSearchClient(keyword, store)
+
+    async def search():
+        return [d async for d in await client.search("parental leave", top=2)]
+
+    results = asyncio.run(search())
+    assert {d["id"] for d in results} == {"2", "3"}
+    assert keyword.queries == [("parental leave", {"top": 2})]